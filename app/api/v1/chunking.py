@@ -0,0 +1,132 @@
+import asyncio
+import multiprocessing
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+
+from app.core.config import config
+
+# Words and single punctuation marks, close to what word_tokenize counts
+_token = re.compile(r"\w+|[^\w\s]")
+# Whitespace after sentence-ending punctuation, or a paragraph break
+_sentence_break = re.compile(r"(?<=[.!?])\s+|\s*\n\s*\n\s*")
+
+
+class Chunk(NamedTuple):
+    text: str
+    start: int
+    end: int
+
+
+def count_tokens(text: str, start: int = 0, end: Optional[int] = None) -> int:
+    return len(_token.findall(text, start, len(text) if end is None else end))
+
+
+def _sentences(text: str) -> Iterator[Tuple[int, int, int]]:
+    """(start, end, tokens) of each sentence, without surrounding whitespace."""
+    end = len(text.rstrip())
+    position = len(text) - len(text.lstrip())
+    for match in _sentence_break.finditer(text, position, end):
+        tokens = count_tokens(text, position, match.start())
+        if tokens:
+            yield position, match.start(), tokens
+        position = match.end()
+    tokens = count_tokens(text, position, end)
+    if tokens:
+        yield position, end, tokens
+
+
+def _split_sentence(text: str, start: int, end: int, chunk_size: int, overlap: int) -> Iterator[Chunk]:
+    # A sentence longer than a chunk is cut at token boundaries
+    spans = [match.span() for match in _token.finditer(text, start, end)]
+    step = chunk_size - overlap
+    for first in range(0, len(spans), step):
+        last = min(first + chunk_size, len(spans)) - 1
+        yield Chunk(text[spans[first][0]:spans[last][1]], spans[first][0], spans[last][1])
+        if last == len(spans) - 1:
+            break
+
+
+def iter_chunks(text: str, chunk_size: int = 128, overlap: int = config.CHUNK_OVERLAP) -> Iterator[Chunk]:
+    """
+    Splits `text` in a single pass into chunks of at most `chunk_size` tokens.
+
+    Chunks are made of whole sentences where possible and consecutive chunks
+    share up to `overlap` tokens of trailing sentences. Each chunk's text is
+    exactly `text[start:end]`.
+    """
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be at least 1")
+    overlap = max(0, min(overlap, chunk_size // 2))
+    window: deque = deque()
+    window_tokens = 0
+    fresh = False
+
+    for start, end, tokens in _sentences(text):
+        if tokens > chunk_size:
+            if fresh:
+                yield Chunk(text[window[0][0]:window[-1][1]], window[0][0], window[-1][1])
+            yield from _split_sentence(text, start, end, chunk_size, overlap)
+            window.clear()
+            window_tokens, fresh = 0, False
+            continue
+
+        if window and window_tokens + tokens > chunk_size:
+            if fresh:
+                yield Chunk(text[window[0][0]:window[-1][1]], window[0][0], window[-1][1])
+            # Keep trailing sentences as overlap, as long as the next one still fits
+            while window and (window_tokens > overlap or window_tokens + tokens > chunk_size):
+                window_tokens -= window.popleft()[2]
+        window.append((start, end, tokens))
+        window_tokens += tokens
+        fresh = True
+
+    if fresh:
+        yield Chunk(text[window[0][0]:window[-1][1]], window[0][0], window[-1][1])
+
+
+def chunk_text(text: str, chunk_size: int = 128, overlap: int = config.CHUNK_OVERLAP) -> List[Chunk]:
+    return list(iter_chunks(text, chunk_size, overlap))
+
+
+class Chunker:
+    """
+    Chunks documents off the event loop.
+
+    Texts shorter than `process_threshold` characters are chunked in a
+    thread; longer ones go to a process pool so they do not hold the GIL
+    while other requests are being served.
+    """
+
+    def __init__(
+        self,
+        overlap: int = config.CHUNK_OVERLAP,
+        process_threshold: int = config.CHUNK_PROCESS_THRESHOLD,
+        workers: int = config.CHUNK_WORKERS,
+    ):
+        self.overlap = overlap
+        self.process_threshold = process_threshold
+        self.workers = workers
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._pool
+
+    async def chunk(self, text: str, chunk_size: int = 128) -> List[Chunk]:
+        loop = asyncio.get_running_loop()
+        executor = self.pool if len(text) >= self.process_threshold else None
+        return await loop.run_in_executor(executor, chunk_text, text, chunk_size, self.overlap)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+        self._pool = None
+
+
+chunker = Chunker()
@@ -0,0 +1,126 @@
+import asyncio
+from typing import Dict, NamedTuple, Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+from app.core.config import config
+from app.core.metrics import metrics
+
+
+class DownloadError(Exception):
+    pass
+
+
+class Download(NamedTuple):
+    content: bytes
+    etag: Optional[str]
+    last_modified: Optional[str]
+
+
+class Downloader:
+    """
+    Pooled async HTTP client for fetching files to ingest.
+
+    A single `httpx.AsyncClient` is shared by every request on the worker so
+    connections are reused, and a semaphore per host caps how many downloads
+    hit the same server at once. Bodies are streamed and abandoned as soon as
+    they exceed `max_bytes`.
+    """
+
+    def __init__(
+        self,
+        timeout: float = config.DOWNLOAD_TIMEOUT,
+        total_timeout: float = config.DOWNLOAD_TOTAL_TIMEOUT,
+        max_bytes: int = config.DOWNLOAD_MAX_BYTES,
+        max_connections: int = config.DOWNLOAD_MAX_CONNECTIONS,
+        max_connections_per_host: int = config.DOWNLOAD_MAX_CONNECTIONS_PER_HOST,
+    ):
+        self.timeout = timeout
+        self.total_timeout = total_timeout
+        self.max_bytes = max_bytes
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.client: Optional[httpx.AsyncClient] = None
+        self._host_limits: Dict[str, asyncio.Semaphore] = {}
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self.client is None or self.client.is_closed:
+            self.client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout),
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                ),
+                follow_redirects=True,
+            )
+        return self.client
+
+    def _host_limit(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).netloc.lower()
+        if host not in self._host_limits:
+            self._host_limits[host] = asyncio.Semaphore(self.max_connections_per_host)
+        return self._host_limits[host]
+
+    async def fetch(self, url: str) -> bytes:
+        """
+        Downloads `url` and returns its body.
+
+        Raises:
+            DownloadError: On a non-200 response, an oversized body or a timeout.
+        """
+        return (await self.fetch_if_changed(url)).content
+
+    async def fetch_if_changed(self, url: str, etag: Optional[str] = None,
+                               last_modified: Optional[str] = None) -> Optional[Download]:
+        """
+        Downloads `url` unless the server reports it unchanged since the
+        response that carried `etag` / `last_modified`, in which case None
+        is returned.
+
+        Raises:
+            DownloadError: On an unexpected status, an oversized body or a timeout.
+        """
+        if not url:
+            raise DownloadError("file_url is required")
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        try:
+            async with self._host_limit(url):
+                return await asyncio.wait_for(self._fetch(url, headers), self.total_timeout)
+        except asyncio.TimeoutError:
+            raise DownloadError(f"Timed out downloading file from {url}")
+        except httpx.HTTPError as e:
+            raise DownloadError(f"Failed to download file from {url}: {e}")
+
+    async def _fetch(self, url: str, headers: Dict[str, str]) -> Optional[Download]:
+        async with self._get_client().stream("GET", url, headers=headers) as response:
+            if response.status_code == 304 and headers:
+                return None
+            if response.status_code != 200:
+                raise DownloadError(f"Failed to download file from {url}")
+
+            declared = response.headers.get("content-length")
+            if declared and declared.isdigit() and int(declared) > self.max_bytes:
+                raise DownloadError(f"File at {url} exceeds {self.max_bytes} bytes")
+
+            content = bytearray()
+            async for part in response.aiter_bytes():
+                content.extend(part)
+                if len(content) > self.max_bytes:
+                    raise DownloadError(f"File at {url} exceeds {self.max_bytes} bytes")
+            metrics.count("rag_downloaded_bytes_total", len(content), "Bytes of files downloaded")
+            return Download(
+                bytes(content), response.headers.get("etag"), response.headers.get("last-modified")
+            )
+
+    async def aclose(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+
+downloader = Downloader()
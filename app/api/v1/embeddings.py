@@ -0,0 +1,149 @@
+import asyncio
+import random
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import openai
+
+from app.core.config import config
+
+EmbedBatch = Callable[[List[str], str], Awaitable[List[np.ndarray]]]
+
+# Failures worth another attempt; anything else fails the batch right away
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+)
+
+
+def estimate_tokens(text: str) -> int:
+    # Deliberately high (~3 chars per token) so batches stay under API limits
+    return len(text) // 3 + 1
+
+
+class EmbeddingScheduler:
+    """
+    Micro-batches embedding requests across concurrent callers.
+
+    Texts submitted within `window` seconds of each other are grouped per
+    model into batches of at most `max_items` texts and `max_tokens`
+    estimated tokens. At most `max_concurrency` batches are in flight, failed
+    batches are retried with exponential backoff, and every caller gets back
+    the vectors for its own texts only. A batch rejected for its input is
+    bisected until the texts at fault are found, so only their callers fail.
+    """
+
+    def __init__(
+        self,
+        embed_batch: EmbedBatch,
+        window: float = config.EMBEDDING_BATCH_WINDOW_MS / 1000,
+        max_items: int = config.EMBEDDING_BATCH_MAX_ITEMS,
+        max_tokens: int = config.EMBEDDING_BATCH_MAX_TOKENS,
+        max_concurrency: int = config.EMBEDDING_MAX_CONCURRENCY,
+        max_retries: int = config.EMBEDDING_MAX_RETRIES,
+        backoff: float = 0.5,
+    ):
+        self.embed_batch = embed_batch
+        self.window = window
+        self.max_items = max_items
+        self.max_tokens = max_tokens
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._pending: Dict[str, List[Tuple[str, asyncio.Future]]] = {}
+        self._pending_tokens = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._tasks = set()
+
+    @property
+    def pending(self) -> int:
+        """Texts waiting for their batch to be sent."""
+        return sum(map(len, self._pending.values()))
+
+    async def embed(self, texts: List[str], model: str) -> List[np.ndarray]:
+        if not texts:
+            return []
+        loop = asyncio.get_running_loop()
+        futures = []
+        for text in texts:
+            future = loop.create_future()
+            self._pending.setdefault(model, []).append((text, future))
+            self._pending_tokens += estimate_tokens(text)
+            futures.append(future)
+
+        if self._pending_tokens >= self.max_tokens or sum(map(len, self._pending.values())) >= self.max_items:
+            # Enough for a full batch, no reason to wait for the window
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        # Every outcome is collected, a caller with several failed texts
+        # raises the first
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
+
+    def _batches(self, items: List[Tuple[str, asyncio.Future]]):
+        batch, tokens = [], 0
+        for text, future in items:
+            text_tokens = estimate_tokens(text)
+            if batch and (len(batch) >= self.max_items or tokens + text_tokens > self.max_tokens):
+                yield batch
+                batch, tokens = [], 0
+            batch.append((text, future))
+            tokens += text_tokens
+        if batch:
+            yield batch
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending, self._pending_tokens = self._pending, {}, 0
+        for model, items in pending.items():
+            for batch in self._batches(items):
+                task = asyncio.ensure_future(self._run(model, batch))
+                # Keep a reference until the task is done
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, model: str, batch: List[Tuple[str, asyncio.Future]]):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+        # The same text asked for by several callers is sent once
+        unique = list(dict.fromkeys(text for text, _ in batch))
+        try:
+            async with self._slots:
+                vectors = await self._with_retries(unique, model)
+        except Exception as e:
+            if len(unique) > 1 and isinstance(e, openai.BadRequestError):
+                # A bad input fails the whole request; each half is sent on
+                # its own so the other callers' texts still get embedded.
+                # Any other error, e.g. a bad key, would fail every half too
+                first = set(unique[:len(unique) // 2])
+                await asyncio.gather(
+                    self._run(model, [item for item in batch if item[0] in first]),
+                    self._run(model, [item for item in batch if item[0] not in first]),
+                )
+                return
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        by_text = dict(zip(unique, vectors))
+        for text, future in batch:
+            if not future.done():
+                future.set_result(by_text[text])
+
+    async def _with_retries(self, texts: List[str], model: str) -> List[np.ndarray]:
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await self.embed_batch(texts, model)
+            except RETRYABLE_ERRORS:
+                if attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(self.backoff * 2 ** attempt * (0.5 + random.random()))
@@ -0,0 +1,184 @@
+import asyncio
+import multiprocessing
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
+
+from app.core.config import config
+from app.core.metrics import metrics, span
+from app.core.startup import lazy_import
+
+# Imported on first use, in the server and in each worker process
+fitz = lazy_import("fitz")
+
+
+class ExtractionTimeout(Exception):
+    pass
+
+
+def page_needs_ocr(page, text: str) -> bool:
+    # A page without a text layer that still draws images is a scan
+    return not text.strip() and bool(page.get_images(full=False))
+
+
+def _page_count(path: str) -> int:
+    with fitz.open(path) as pdf_document:
+        return len(pdf_document)
+
+
+def _check_deadline(deadline: float):
+    # Wall clock, the deadline is set in the server and checked in workers
+    if time.time() > deadline:
+        raise ExtractionTimeout("PDF extraction ran past its deadline")
+
+
+def _extract_page_range(path: str, start: int, stop: int, deadline: float) -> List[Tuple[int, Optional[str]]]:
+    """
+    Extracts the native text of pages [start, stop). Runs in a worker process
+    and stops between pages once `deadline` has passed.
+
+    Returns:
+        (page_num, text) pairs where text is None for pages that need OCR.
+    """
+    pages = []
+    with fitz.open(path) as pdf_document:
+        for page_num in range(start, stop):
+            _check_deadline(deadline)
+            page = pdf_document.load_page(page_num)
+            text = page.get_text()
+            pages.append((page_num, None if page_needs_ocr(page, text) else text))
+    return pages
+
+
+def _ocr_page(path: str, page_num: int, dpi: int, deadline: float) -> str:
+    """OCRs a single page. Runs in a worker process, unless `deadline` has passed."""
+    _check_deadline(deadline)
+    with fitz.open(path) as pdf_document:
+        pix = pdf_document.load_page(page_num).get_pixmap(dpi=dpi)
+    # OCR the image, make a 1-page PDF from it. MuPDF errors cannot be
+    # pickled back to the server, so only their message is sent
+    try:
+        pdfdata = pix.pdfocr_tobytes()
+    except Exception as e:
+        raise RuntimeError(f"OCR of page {page_num} failed: {e}") from None
+    with fitz.open("pdf", pdfdata) as ocrpdf:
+        return ocrpdf[0].get_text()
+
+
+class PdfExtractionEngine:
+    """
+    Extracts PDF text page by page across two process pools.
+
+    Documents are split into ranges of `pages_per_task` pages which go to the
+    text pool; pages without a text layer found in a range are sent to the
+    separate OCR pool as soon as that range finishes. Each document may only
+    have `max_tasks_per_document` tasks in flight per pool, so a large scan
+    queues behind itself rather than in front of smaller documents.
+    """
+
+    def __init__(
+        self,
+        text_workers: int = config.PDF_TEXT_WORKERS,
+        ocr_workers: int = config.PDF_OCR_WORKERS,
+        pages_per_task: int = config.PDF_PAGES_PER_TASK,
+        max_tasks_per_document: int = config.PDF_MAX_TASKS_PER_DOCUMENT,
+        ocr_dpi: int = config.PDF_OCR_DPI,
+        time_budget: float = config.PDF_TIME_BUDGET,
+    ):
+        self.text_workers = text_workers
+        self.ocr_workers = ocr_workers
+        self.pages_per_task = pages_per_task
+        self.max_tasks_per_document = max_tasks_per_document
+        self.ocr_dpi = ocr_dpi
+        self.time_budget = time_budget
+        self._text_pool: Optional[ProcessPoolExecutor] = None
+        self._ocr_pool: Optional[ProcessPoolExecutor] = None
+
+    def _pool(self, workers: int) -> ProcessPoolExecutor:
+        # Spawned workers do not inherit the server's threads or event loop
+        return ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        )
+
+    @property
+    def text_pool(self) -> ProcessPoolExecutor:
+        if self._text_pool is None:
+            self._text_pool = self._pool(self.text_workers)
+        return self._text_pool
+
+    @property
+    def ocr_pool(self) -> ProcessPoolExecutor:
+        if self._ocr_pool is None:
+            self._ocr_pool = self._pool(self.ocr_workers)
+        return self._ocr_pool
+
+    async def extract_pages(self, file_content: bytes, time_budget: Optional[float] = None) -> List[str]:
+        """
+        Extracts the text of every page of a PDF, in page order.
+
+        Workers check the budget between pages and give up once it is spent,
+        so at most the pages they were on when it ran out outlive it.
+
+        Raises:
+            ExtractionTimeout: If the document is not done within the time budget.
+        """
+        # Workers open the document from disk instead of receiving a pickled
+        # copy of the bytes with every task
+        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
+            tmp.write(file_content)
+            path = tmp.name
+        budget = self.time_budget if time_budget is None else time_budget
+        try:
+            return await asyncio.wait_for(self._extract(path, time.time() + budget), budget)
+        except asyncio.TimeoutError:
+            raise ExtractionTimeout(f"PDF extraction exceeded its {budget}s budget")
+        finally:
+            os.remove(path)
+
+    async def _extract(self, path: str, deadline: float) -> List[str]:
+        loop = asyncio.get_running_loop()
+        page_count = await loop.run_in_executor(self.text_pool, _page_count, path)
+        texts: List[str] = [""] * page_count
+        text_slots = asyncio.Semaphore(self.max_tasks_per_document)
+        ocr_slots = asyncio.Semaphore(self.max_tasks_per_document)
+
+        async def ocr(page_num: int):
+            async with ocr_slots:
+                with span("ocr"):
+                    texts[page_num] = await loop.run_in_executor(
+                        self.ocr_pool, _ocr_page, path, page_num, self.ocr_dpi, deadline
+                    )
+
+        async def extract_range(start: int, stop: int):
+            async with text_slots:
+                with span("pdf_text"):
+                    pages = await loop.run_in_executor(
+                        self.text_pool, _extract_page_range, path, start, stop, deadline
+                    )
+            ocr_pages = []
+            for page_num, text in pages:
+                if text is None:
+                    ocr_pages.append(page_num)
+                else:
+                    texts[page_num] = text
+            metrics.count("rag_pages_total", len(pages) - len(ocr_pages), "PDF pages extracted", method="text")
+            metrics.count("rag_pages_total", len(ocr_pages), "PDF pages extracted", method="ocr")
+            await asyncio.gather(*(ocr(page_num) for page_num in ocr_pages))
+
+        await asyncio.gather(*(
+            extract_range(start, min(start + self.pages_per_task, page_count))
+            for start in range(0, page_count, self.pages_per_task)
+        ))
+        return texts
+
+    def shutdown(self):
+        for pool in (self._text_pool, self._ocr_pool):
+            if pool is not None:
+                pool.shutdown(wait=False, cancel_futures=True)
+        self._text_pool = None
+        self._ocr_pool = None
+
+
+pdf_engine = PdfExtractionEngine()
@@ -0,0 +1,25 @@
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse, PlainTextResponse
+
+from app.core.metrics import metrics
+from app.core.startup import warmup
+
+router = APIRouter()
+
+@router.get("/health/live")
+async def live():
+    """Liveness: the worker is up and serving requests."""
+    return {"status": "alive"}
+
+@router.get("/health/ready")
+async def ready():
+    """
+    Readiness: warm-up has finished and the worker is not shutting down.
+    Responds 503 with the warm-up report until then.
+    """
+    return JSONResponse(warmup.report(), status_code=200 if warmup.ready else 503)
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """Stage latencies, volume counters, index size, cache and queue state in Prometheus text format."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
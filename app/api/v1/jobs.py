@@ -0,0 +1,188 @@
+import asyncio
+import json
+import logging
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from app.core.config import config
+from app.db.job_store import JobStore, mark_failed
+
+# process_file(user_id, file, chunk_size, progress) -> per-file result
+ProcessFile = Callable[[str, Dict, int, Callable[[str], None]], Awaitable[Dict]]
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class IngestionQueue:
+    """
+    Runs upload jobs in the background.
+
+    Jobs wait in a bounded queue and `submit` refuses new ones while it is
+    full. `workers` jobs run at a time, each processing at most
+    `file_concurrency` of its files at once. Job and per-file progress is
+    written to a JobStore so any worker can report it. Writes go through
+    one thread, in order and off the event loop. Every `heartbeat` seconds
+    the jobs this worker holds are marked alive, and jobs of any worker
+    that has been silent for `orphan_timeout` seconds are marked failed.
+    """
+
+    def __init__(
+        self,
+        process_file: ProcessFile,
+        store: JobStore,
+        workers: int = config.INGESTION_WORKERS,
+        max_queued: int = config.INGESTION_MAX_QUEUED_JOBS,
+        file_concurrency: int = config.INGESTION_FILE_CONCURRENCY,
+        heartbeat: float = config.JOB_HEARTBEAT,
+        orphan_timeout: float = config.JOB_ORPHAN_TIMEOUT,
+    ):
+        self.process_file = process_file
+        self.store = store
+        self.workers = workers
+        self.max_queued = max_queued
+        self.file_concurrency = file_concurrency
+        self.heartbeat = heartbeat
+        self.orphan_timeout = orphan_timeout
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._writer: Optional[ThreadPoolExecutor] = None
+        # Queued and running jobs of this worker
+        self._held: Dict[str, Dict] = {}
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def start(self):
+        """Starts the workers and the heartbeat, at the latest on the first submit."""
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_queued)
+            self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job-store")
+            self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+            self._tasks.append(asyncio.create_task(self._keep_alive()))
+
+    def _store(self, method: Callable, *args) -> asyncio.Future:
+        future = asyncio.get_running_loop().run_in_executor(self._writer, method, *args)
+        future.add_done_callback(_log_store_error)
+        return future
+
+    def _save(self, job: Dict) -> asyncio.Future:
+        # Serialised now, so the record is the job as it is at this point
+        return self._store(self.store.write, job["job_id"], json.dumps(job), job.get("finished_at"))
+
+    async def submit(self, user_id: str, files: List[Dict], chunk_size: int) -> Dict:
+        """
+        Queues a job and returns its record once it is stored.
+
+        Raises:
+            JobQueueFull: If `max_queued` jobs are already waiting.
+        """
+        self.start()
+        job = {
+            "job_id": uuid.uuid4().hex,
+            "user_id": user_id,
+            "chunk_size": chunk_size,
+            "status": "queued",
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "files": [
+                {
+                    "file_id": file.get("file_id"),
+                    "file_url": file.get("file_url"),
+                    "status": "queued",
+                    "message": None,
+                    "error": None,
+                }
+                for file in files
+            ],
+        }
+        try:
+            self._queue.put_nowait((job, files))
+        except asyncio.QueueFull:
+            raise JobQueueFull(f"{self.max_queued} ingestion jobs are already queued")
+        self._held[job["job_id"]] = job
+        await self._save(job)
+        return job
+
+    async def _keep_alive(self):
+        while True:
+            try:
+                if self._held:
+                    await self._store(self.store.touch, list(self._held))
+                failed = await self._store(self.store.fail_orphans, self.orphan_timeout)
+                if failed:
+                    logging.warning(f"Marked {failed} interrupted ingestion jobs as failed")
+            except Exception:
+                pass  # Logged by _store, tried again on the next beat
+            await asyncio.sleep(self.heartbeat)
+
+    async def _work(self):
+        while True:
+            job, files = await self._queue.get()
+            try:
+                await self._run(job, files)
+            except Exception as e:
+                logging.exception(f"Ingestion job {job['job_id']} failed")
+                job.update(status="failed", error=str(e), finished_at=time.time())
+                self._save(job)
+            finally:
+                self._queue.task_done()
+            self._held.pop(job["job_id"], None)
+
+    async def _run(self, job: Dict, files: List[Dict]):
+        job.update(status="running", started_at=time.time())
+        self._save(job)
+        slots = asyncio.Semaphore(self.file_concurrency)
+
+        async def run_file(entry: Dict, file: Dict):
+            def progress(stage: str):
+                entry["status"] = stage
+                self._save(job)
+
+            async with slots:
+                result = await self.process_file(job["user_id"], file, job["chunk_size"], progress)
+            if "error" in result:
+                entry.update(status="error", error=result["error"])
+            else:
+                entry.update(status="done", message=result.get("message"))
+            self._save(job)
+
+        await asyncio.gather(*(run_file(entry, file) for entry, file in zip(job["files"], files)))
+
+        failed = sum(entry["status"] == "error" for entry in job["files"])
+        if not failed:
+            status = "completed"
+        elif failed == len(job["files"]):
+            status = "failed"
+        else:
+            status = "completed_with_errors"
+        job.update(status=status, finished_at=time.time())
+        self._save(job)
+        self._store(self.store.prune)
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._writer is not None:
+            # Jobs still held will not finish, say so instead of leaving
+            # them to time out
+            now = time.time()
+            for job in self._held.values():
+                self._save(mark_failed(job, "Interrupted by a server shutdown", now))
+            # Waits for the writes already queued
+            await asyncio.get_running_loop().run_in_executor(None, self._writer.shutdown)
+            self._writer = None
+        self._held = {}
+        self._queue = None
+
+
+def _log_store_error(future: asyncio.Future):
+    if not future.cancelled() and future.exception() is not None:
+        logging.error(f"Job store write failed: {future.exception()}")
@@ -0,0 +1,187 @@
+import bisect
+import re
+from typing import List, NamedTuple, Optional, Tuple
+
+from app.core.config import config
+
+# The answer's highlighted quote
+_quote = re.compile(r"\*\*\*(.*?)\*\*\*", re.DOTALL)
+_whitespace = re.compile(r"\s+")
+# Typographic characters models tend to swap for plain ones, folded one to
+# one so offsets are kept
+_typography = str.maketrans({
+    "‘": "'", "’": "'", "‚": "'", "‛": "'",
+    "“": '"', "”": '"', "„": '"', "‟": '"',
+    "‐": "-", "‑": "-", "‒": "-", "–": "-", "—": "-", "−": "-",
+})
+
+
+def quote_span(answer: str) -> Optional[Tuple[int, int]]:
+    """Start and end of the text between the first pair of `***` in an answer."""
+    match = _quote.search(answer)
+    return match.span(1) if match else None
+
+
+def _lower(text: str) -> str:
+    lowered = text.lower()
+    if len(lowered) == len(text):
+        return lowered
+    # A few characters lower to two, those are left as they are
+    return "".join(c.lower() if len(c.lower()) == 1 else c for c in text)
+
+
+def fold(text: str) -> Tuple[str, List[int], List[int]]:
+    """
+    Lowercases `text`, folds typographic quotes and dashes and collapses
+    whitespace runs into one space.
+
+    Returns:
+        The folded text and the breakpoints of its offset map: from
+        folded_starts[i] on, folded offsets map linearly to original
+        offsets from original_starts[i] on.
+    """
+    text = _lower(text).translate(_typography)
+    parts, folded_starts, original_starts = [], [0], [0]
+    position = length = 0
+    for match in _whitespace.finditer(text):
+        start, end = match.span()
+        if end - start == 1 and text[start] == " ":
+            continue
+        parts.append(text[position:start])
+        parts.append(" ")
+        length += start - position + 1
+        folded_starts.append(length)
+        original_starts.append(end)
+        position = end
+    parts.append(text[position:])
+    return "".join(parts), folded_starts, original_starts
+
+
+def _word(c: str) -> bool:
+    return c.isalnum() or c == "_"
+
+
+def _best_end(pattern: str, text: str) -> Tuple[int, int]:
+    """
+    Edit distance between `pattern` and the closest substring of `text`, and
+    where the first such substring ends. Where the best score holds for a run
+    of consecutive ends the last one is taken, so a quote missing its final
+    letters still spans the whole word.
+
+    Myers' bit-parallel algorithm: one column of the edit distance matrix
+    is a pair of bit vectors over the pattern, so each text character costs
+    a few integer operations however long the pattern is.
+    """
+    peq = {}
+    for i, c in enumerate(pattern):
+        peq[c] = peq.get(c, 0) | 1 << i
+    mask = (1 << len(pattern)) - 1
+    high = 1 << (len(pattern) - 1)
+    pv, mv, score = mask, 0, len(pattern)
+    best, best_end = score, 0
+    for j, c in enumerate(text):
+        eq = peq.get(c, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+        if ph & high:
+            score += 1
+        elif mh & high:
+            score -= 1
+        ph = (ph << 1) & mask
+        mh = (mh << 1) & mask
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
+        if score < best or (score == best and best_end == j):
+            best, best_end = score, j + 1
+            if not best:
+                break
+    return best, best_end
+
+
+class QuoteMatch(NamedTuple):
+    # Offsets in the source text
+    start: int
+    end: int
+    # Edits between the folded quote and the folded source passage
+    distance: int
+
+
+class SourceText:
+    """
+    The retrieved chunks as sent to the model, folded once for quote
+    lookups. Quotes are matched case and whitespace insensitively, exactly
+    where possible and otherwise to the closest passage within
+    QUOTE_MAX_EDIT_RATIO edits per character.
+    """
+
+    def __init__(self, chunks: List[str], separator: str = "\n"):
+        self.chunks = chunks
+        self.text = separator.join(chunks)
+        self.chunk_starts = []
+        start = 0
+        for chunk in chunks:
+            self.chunk_starts.append(start)
+            start += len(chunk) + len(separator)
+        self._folded, self._folded_starts, self._original_starts = fold(self.text)
+
+    def _original(self, offset: int) -> int:
+        i = bisect.bisect_right(self._folded_starts, offset) - 1
+        return self._original_starts[i] + offset - self._folded_starts[i]
+
+    def find(self, quote: str, max_edit_ratio: float = config.QUOTE_MAX_EDIT_RATIO) -> Optional[QuoteMatch]:
+        pattern = fold(quote)[0].strip()
+        if not pattern:
+            return None
+        start = self._folded.find(pattern)
+        if start != -1:
+            end, distance = start + len(pattern), 0
+        else:
+            max_distance = int(len(pattern) * max_edit_ratio)
+            if not max_distance:
+                return None
+            distance, end = _best_end(pattern, self._folded)
+            if distance > max_distance:
+                return None
+            # The same alignment run backwards from its end finds its start
+            window = self._folded[max(0, end - len(pattern) - distance):end]
+            length = _best_end(pattern[::-1], window[::-1])[1]
+            start = end - length
+            # A near match covers whole words
+            while start > 0 and _word(self._folded[start - 1]) and _word(self._folded[start]):
+                start -= 1
+            while end < len(self._folded) and _word(self._folded[end - 1]) and _word(self._folded[end]):
+                end += 1
+        # Whitespace at the edges of a near match is not part of the quote
+        while start < end and self._folded[start] == " ":
+            start += 1
+        while end > start and self._folded[end - 1] == " ":
+            end -= 1
+        return QuoteMatch(self._original(start), self._original(end - 1) + 1, distance)
+
+    def chunk_of(self, offset: int) -> Tuple[int, int]:
+        """Index of the chunk holding a source text offset, and the offset in it."""
+        i = max(bisect.bisect_right(self.chunk_starts, offset) - 1, 0)
+        return i, min(offset - self.chunk_starts[i], len(self.chunks[i]))
+
+    def verify(self, answer: str) -> Tuple[Optional[str], Optional[QuoteMatch]]:
+        """
+        Checks the answer's `***` quote against the source.
+
+        Returns:
+            The answer and where its quote is, or (None, None) when it has
+            no quote or the quote is not in the source. A quote that differs
+            from its source passage, in case, whitespace or a few edits, is
+            replaced with the passage.
+        """
+        span = quote_span(answer)
+        if span is None:
+            return None, None
+        match = self.find(answer[span[0]:span[1]])
+        if match is None:
+            return None, None
+        passage = " ".join(self.text[match.start:match.end].split())
+        if passage != answer[span[0]:span[1]]:
+            answer = answer[:span[0]] + passage + answer[span[1]:]
+        return answer, match
@@ -1,11 +1,18 @@
 from fastapi import APIRouter, Body, HTTPException ,Form, File, UploadFile
-from fastapi.responses import JSONResponse
-from typing import Dict, List, Optional
+from fastapi.responses import JSONResponse, StreamingResponse
+from typing import Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel, HttpUrl
-import requests
-import magic
+import asyncio
+import hashlib
+import json
 import re
+import openai
 from .services import * 
+from app.core.metrics import metrics, span
+from .downloads import downloader
+from .jobs import IngestionQueue, JobQueueFull
+from app.db.job_store import JobStore
 import traceback
 import logging
 
@@ -26,9 +33,193 @@ class GetFileTextResponse(BaseModel):
 
 class TextRequest(BaseModel):
     query_text: str
+    # Required, checked by the endpoints so a missing one is a 400
+    user_id: Optional[str] = None
+    limit: Optional[int] = None
+    mode: str = "hybrid"
+    nprobe: Optional[int] = None
+    ef_search: Optional[int] = None
+
+class Highlight(BaseModel):
+    user_id: str
+    file_id: str
+    # Page and span of the quote in the file's extracted text, -1 when unknown
+    page: int
+    char_start: int
+    char_end: int
 
 class ChunkResponse(BaseModel):
     response: str
+    highlight: Optional[Highlight] = None
+
+class BatchRequest(BaseModel):
+    queries: List[str]
+    # Required, checked by the endpoint so a missing one is a 400
+    user_id: Optional[str] = None
+    limit: Optional[int] = None
+    mode: str = "hybrid"
+    nprobe: Optional[int] = None
+    ef_search: Optional[int] = None
+    answer: bool = True
+    concurrency: Optional[int] = None
+
+# vector: embeddings only, lexical: BM25 only without an OpenAI call,
+# hybrid: both fused with reciprocal rank fusion
+SEARCH_MODES = ("hybrid", "vector", "lexical")
+
+class Retrieval(NamedTuple):
+    # None for lexical searches, which embed nothing
+    query_embedding: Optional[np.ndarray]
+    chunk_ids: np.ndarray
+    chunks: List[str]
+    snapshot: Snapshot
+
+    def files(self) -> Set[Tuple[str, str]]:
+        return {(row["user_id"], row["file_id"]) for row in self.snapshot.chunks.metadata(self.chunk_ids)}
+
+def check_user_id(user_id: Optional[str]):
+    # Queries only ever search the asking user's files
+    if not user_id:
+        raise HTTPException(status_code=400, detail="user_id is required")
+
+def check_search_options(limit: Optional[int], mode: str):
+    if limit is not None and (not isinstance(limit, int) or not 1 <= limit <= config.SEARCH_MAX_LIMIT):
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {config.SEARCH_MAX_LIMIT}")
+    if mode not in SEARCH_MODES:
+        raise HTTPException(status_code=400, detail=f"mode must be one of {', '.join(SEARCH_MODES)}")
+
+async def retrieve_many(query_texts: List[str], user_id: str, limit: Optional[int] = None,
+                        mode: str = "hybrid", nprobe: Optional[int] = None,
+                        ef_search: Optional[int] = None) -> List[Retrieval]:
+    """
+    Retrieves chunks of `user_id`'s files for several queries at once: their
+    embeddings are requested together and the vector search is one matrix
+    search.
+    """
+    limit = limit or config.SEARCH_TOP_K
+    # Fusion needs candidates beyond the final limit from each side
+    depth = max(limit, config.SEARCH_CANDIDATES) if mode == "hybrid" else limit
+    snapshot = faiss_client.snapshot()
+    query_embeddings = [None] * len(query_texts)
+    rankings = [[] for _ in query_texts]
+    if mode != "lexical":
+        with span("query_embed"):
+            query_embeddings = np.stack(await get_openai_embeddings_async(query_texts))
+        with span("vector_search"):
+            rows = search_vector(snapshot, query_embeddings, user_id, top_k=depth,
+                                 nprobe=nprobe, ef_search=ef_search)
+        for ranking, row in zip(rankings, rows):
+            ranking.append(row)
+        query_embeddings = [embedding.reshape(1, -1) for embedding in query_embeddings]
+    if mode != "vector":
+        with span("lexical_search"):
+            rows = await run_in_threadpool(
+                lambda: [search_lexical(snapshot, query_text, user_id, depth)[0] for query_text in query_texts]
+            )
+        for ranking, row in zip(rankings, rows):
+            ranking.append(row)
+
+    retrievals = []
+    for query_embedding, ranking in zip(query_embeddings, rankings):
+        if len(ranking) > 1:
+            chunk_ids = fuse_rankings(ranking, top_k=limit, k=config.RRF_K)
+        else:
+            chunk_ids = ranking[0][ranking[0] != -1]
+        retrievals.append(Retrieval(query_embedding, chunk_ids, get_chunk_texts(snapshot, chunk_ids), snapshot))
+    return retrievals
+
+async def retrieve(query_text: str, user_id: str, limit: Optional[int] = None,
+                   mode: str = "hybrid", nprobe: Optional[int] = None,
+                   ef_search: Optional[int] = None) -> Retrieval:
+    return (await retrieve_many([query_text], user_id=user_id, limit=limit, mode=mode,
+                                nprobe=nprobe, ef_search=ef_search))[0]
+
+async def find_relevant_chunks(query_text: str, user_id: str, limit: Optional[int] = None,
+                               mode: str = "hybrid", nprobe: Optional[int] = None,
+                               ef_search: Optional[int] = None) -> List[str]:
+    return (await retrieve(query_text, user_id=user_id, limit=limit, mode=mode,
+                           nprobe=nprobe, ef_search=ef_search)).chunks
+
+def cached_answer(retrieval: Retrieval) -> Optional[str]:
+    if retrieval.query_embedding is None:
+        return None
+    return answer_cache.get(retrieval.query_embedding, retrieval.chunk_ids)
+
+def cache_answer(retrieval: Retrieval, answer: str):
+    if retrieval.query_embedding is not None and len(retrieval.chunk_ids):
+        answer_cache.put(retrieval.query_embedding, retrieval.chunk_ids, answer, files=retrieval.files())
+
+def quote_highlight(retrieval: Retrieval, source: SourceText, match: Optional[QuoteMatch]) -> Optional[Dict]:
+    """Where a quote matched in the retrieved chunks is in their files, None without a match."""
+    if match is None:
+        return None
+    start_chunk, start = source.chunk_of(match.start)
+    end_chunk, end = source.chunk_of(match.end - 1)
+    return locate_span(retrieval.snapshot, int(retrieval.chunk_ids[start_chunk]), start,
+                       int(retrieval.chunk_ids[end_chunk]), end + 1)
+
+def sse_event(event: str, data: Dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def ingest_file(user_id: str, file: Dict, chunk_size: int,
+                      progress: Optional[Callable[[str], None]] = None) -> Dict:
+    file_id = file.get("file_id")
+    file_url = file.get("file_url")
+    progress = progress or (lambda stage: None)
+    unchanged = {"file_id": file_id, "file_url": file_url, "user_id": user_id, "message": "Unchanged"}
+
+    try:
+        # What was ingested last time; an identical file is skipped without
+        # extracting or embedding anything
+        previous = faiss_client.snapshot().document(user_id, file_id)
+        if previous and previous.get("chunk_size") != chunk_size:
+            previous = None
+        validators = previous if previous and previous.get("url") == file_url else {}
+
+        progress("downloading")
+        with span("download"):
+            download = await downloader.fetch_if_changed(
+                file_url, validators.get("etag"), validators.get("last_modified")
+            )
+        if download is None:
+            return unchanged
+        content_hash = hashlib.sha256(download.content).hexdigest()
+        if previous and previous.get("content_hash") == content_hash:
+            return unchanged
+
+        progress("extracting")
+        with span("extract"):
+            extracted = await extract_text_async(download.content)
+        if extracted is None:
+            raise ValueError("Unsupported file type")
+
+        progress("embedding")
+        document = {
+            "content_hash": content_hash,
+            "chunk_size": chunk_size,
+            "url": file_url,
+            "etag": download.etag,
+            "last_modified": download.last_modified,
+            "page_starts": extracted.page_starts,
+        }
+        message = await process_documents_async(
+            extracted.text, user_id, file_id, chunk_size=chunk_size, document=document,
+            page_starts=extracted.page_starts
+        )
+        answer_cache.invalidate_file(user_id, file_id)
+        return {
+            "file_id": file_id,
+            "file_url": file_url,
+            "user_id": user_id,
+            "message": message
+        }
+
+    except Exception as e:
+        return {
+            "file_id": file_id,
+            "file_url": file_url,
+            "error": str(e)
+        }
 
 @router.post("/uploadfiles/", response_model=UploadFilesPayload)
 async def upload_files(payload: Dict = Body(..., example={
@@ -44,6 +235,7 @@ async def upload_files(payload: Dict = Body(..., example={
     - **payload**: JSON object containing `user_id` and a list of `files`.
         - **user_id**: User identifier (string, required).
         - **files**: List of dictionaries containing `file_id` (string) and `file_url` (string) for each file to process (required).
+        - **chunk_size**: Maximum tokens per chunk (integer, optional, default 128).
             - Example:
                 ```json
                 {
@@ -52,7 +244,7 @@ async def upload_files(payload: Dict = Body(..., example={
                         {"file_id": "1", "file_url": "https://example.com/file1.pdf"},
                         {"file_id": "2", "file_url": "https://example.com/file2.docx"}
                     ],
-                    chunk_size = 128
+                    "chunk_size": 128
                 }
                 ```
     """
@@ -64,75 +256,96 @@ async def upload_files(payload: Dict = Body(..., example={
         raise HTTPException(status_code=400, detail="user_id is required")
     if not files:
         raise HTTPException(status_code=400, detail="files are required")
-    embedded_chunks = []
-    text_response = []
-    for file in files:
-        file_id = file.get("file_id")
-        file_url = file.get("file_url")
-        
-        try:
-            # Download the file
-            response = requests.get(file_url)
-            print ("Response Code",response.status_code)
-            if response.status_code != 200:
-                raise HTTPException(status_code=400, detail=f"Failed to download file from {file_url}")
-            
-            content = response.content
-            filename = file_url.split("/")[-1]
-            
-            # Determine the file type using python-magic
-            mime = magic.Magic(mime=True)
-            file_mime_type = mime.from_buffer(content)
-            
-            # Process the file based on its MIME type
-            if file_mime_type == 'application/pdf':
-                text_content = extract_whole_text_from_pdf(content)
-            elif file_mime_type.startswith('text/'):
-                text_content = extract_text_from_txt(content)
-            elif file_mime_type == 'application/vnd.openxmlformats-officedocument.wordprocessingml.document':
-                text_content = extract_text_from_docx(content)
-            elif file_mime_type == 'application/vnd.openxmlformats-officedocument.presentationml.presentation':
-                text_content = extract_text_from_pptx(content)
-            else:
-                text_content = None 
- 
-            text_response.append({
-                "file_id": file_id,
-                "text": text_content,
-                "user_id": user_id,
-                "message": "file processed successfully"
-            })
-            embedded_chunks.append(await process_documents_async(text_content, chunk_size=chunk_size))
-            
-
-        except Exception as e:
-            embedded_chunks.append({
-                "file_id": file_id,
-                "file_url": file_url,
-                "error": str(e)
-            })
+    if any(not file.get("file_id") for file in files):
+        raise HTTPException(status_code=400, detail="file_id is required for every file")
+    if not isinstance(chunk_size, int) or chunk_size < 1:
+        raise HTTPException(status_code=400, detail="chunk_size must be a positive integer")
+    # Download every file concurrently; each one is extracted and embedded as
+    # soon as its own download finishes
+    embedded_chunks = await asyncio.gather(*(
+        ingest_file(user_id, file, chunk_size) for file in files
+    ))
     
     return JSONResponse(content=embedded_chunks)
 
+ingestion_queue = IngestionQueue(
+    ingest_file, JobStore(config.JOB_STORE_PATH, retention=config.JOB_RETENTION)
+)
+
+metrics.gauge("rag_ingestion_queue_depth", "Ingestion jobs waiting for a worker",
+              lambda: ingestion_queue.depth)
+
+@router.post("/uploadfiles/async/", status_code=202)
+async def upload_files_async(payload: Dict = Body(..., example={
+    "user_id": "123",
+    "files": [
+        {"file_id": "1", "file_url": "https://example.com/file1.pdf"},
+        {"file_id": "2", "file_url": "https://example.com/file2.docx"}
+    ]
+})):
+    """
+    Queue files for ingestion in the background and return a job id right away.
+
+    Takes the same payload as `/uploadfiles/`. Poll `/jobs/{job_id}` for
+    progress. Responds 429 while the ingestion queue is full.
+    """
+    user_id = payload.get("user_id")
+    files = payload.get("files")
+    chunk_size = payload.get("chunk_size", 128)
+
+    if not user_id:
+        raise HTTPException(status_code=400, detail="user_id is required")
+    if not files:
+        raise HTTPException(status_code=400, detail="files are required")
+    if any(not file.get("file_id") for file in files):
+        raise HTTPException(status_code=400, detail="file_id is required for every file")
+    if not isinstance(chunk_size, int) or chunk_size < 1:
+        raise HTTPException(status_code=400, detail="chunk_size must be a positive integer")
+
+    try:
+        job = await ingestion_queue.submit(user_id, files, chunk_size)
+    except JobQueueFull as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "30"})
+    return {"job_id": job["job_id"], "status": job["status"]}
+
+@router.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """
+    Status of an ingestion job, with the stage or error of each of its files.
+    """
+    job = await run_in_threadpool(ingestion_queue.store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
 @router.post("/getchunks/", response_model=GetQueryResponse)
 async def get_files(payload: Dict = Body(..., example={
     "text" : "text",
+    "user_id": "123",
 
     })):
     """
     Get chunks for a specific query from the faiss in memory database.
 
     - **text**: Query text (string, required).
-    - **limit**: Number of required Chunks
+    - **user_id**: User whose files are searched (string, required).
+    - **limit**: Number of chunks to return (optional, defaults to SEARCH_TOP_K).
+    - **mode**: `hybrid` (default), `vector` or `lexical`. Lexical searches make no OpenAI call.
+    - **nprobe**: Inverted lists to visit when the index is IVF (optional).
+    - **ef_search**: Candidate list size when the index is HNSW (optional).
     """
     query_text = payload.get("text")
     limit = payload.get("limit")
+    mode = payload.get("mode", "hybrid")
     if not payload.get("text"):
         raise HTTPException(status_code=400, detail="text is required")
+    check_user_id(payload.get("user_id"))
+    check_search_options(limit, mode)
     try:
-        query_embedding = np.array(get_openai_embeddings([query_text])[0]).reshape(1, -1)
-        indices = search_vector(faiss_client, query_embedding)
-        most_relevant_chunks = [text_list[i] for i in indices[0]]
+        most_relevant_chunks = await find_relevant_chunks(
+            query_text, user_id=payload.get("user_id"), limit=limit, mode=mode,
+            nprobe=payload.get("nprobe"), ef_search=payload.get("ef_search")
+        )
         
         
         if not most_relevant_chunks:
@@ -140,9 +353,33 @@ async def get_files(payload: Dict = Body(..., example={
 
         return GetQueryResponse(query_text=query_text, chunks=most_relevant_chunks)
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
+@router.post("/deletefile/")
+async def delete_file(payload: Dict = Body(..., example={
+    "user_id": "123",
+    "file_id": "1"
+})):
+    """
+    Remove a file's chunks and vectors.
+
+    - **user_id**: User identifier (string, required).
+    - **file_id**: File identifier used when the file was uploaded (string, required).
+    """
+    user_id = payload.get("user_id")
+    file_id = payload.get("file_id")
+    if not user_id or not file_id:
+        raise HTTPException(status_code=400, detail="user_id and file_id are required")
+
+    removed = await run_in_threadpool(delete_vectors, faiss_client, user_id, file_id)
+    answer_cache.invalidate_file(user_id, file_id)
+    if not removed:
+        raise HTTPException(status_code=404, detail="No chunks found for the given file_id")
+    return {"user_id": user_id, "file_id": file_id, "removed_chunks": removed}
+    
 @router.post("/getfulltext/", response_model=GetFileTextResponse)
 async def get_file_text(
     payload: Dict = Body(..., example={
@@ -162,33 +399,16 @@ async def get_file_text(
     try:
         if file_url:
             # Download the file
-            response = requests.get(file_url)
-            if response.status_code != 200:
-                raise HTTPException(status_code=400, detail=f"Failed to download file from {file_url}")
-            content = response.content
+            content = await downloader.fetch(file_url)
         else:
             content = await file.read()
 
-        # Determine the file type using python-magic
-        mime = magic.Magic(mime=True)
-        file_mime_type = mime.from_buffer(content)
-
-        # Process the file based on its MIME type
-        if file_mime_type == 'application/pdf':
-            text_content = extract_whole_text_from_pdf(content)
-        elif file_mime_type.startswith('text/'):
-            text_content = extract_text_from_txt(content)
-        elif file_mime_type == 'application/vnd.openxmlformats-officedocument.wordprocessingml.document':
-            text_content = extract_text_from_docx(content)
-        elif file_mime_type == 'application/vnd.openxmlformats-officedocument.presentationml.presentation':
-            text_content = extract_text_from_pptx(content)
-        else:
-            text_content = None
+        extracted = await extract_text_async(content)
 
-        if text_content is None:
+        if extracted is None:
             raise HTTPException(status_code=400, detail="Unsupported file type")
 
-        return GetFileTextResponse(text=text_content)
+        return GetFileTextResponse(text=extracted.text)
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -203,18 +423,27 @@ async def search_chunks(request: TextRequest):
 
         if not query_text:
             raise HTTPException(status_code=400, detail="query_text is required")
+        check_user_id(request.user_id)
+        check_search_options(request.limit, request.mode)
 
-        query_embedding = np.array(get_openai_embeddings([query_text])[0]).reshape(1, -1)
-        indices = search_vector(faiss_client, query_embedding)
-        most_relevant_chunks = [text_list[i] for i in indices[0]]
-        relevant_text = '\n'.join([chunk for chunk in most_relevant_chunks])
-        answer =  get_openai_response(query_text, relevant_text)
-
-        if not isinstance(answer, str) or not re.search(r'\*\*\*(.*?)\*\*\*', answer):
-            print (answer)
-            raise HTTPException(status_code=400, detail="No text found within text to quote.")
+        retrieval = await retrieve(
+            query_text, user_id=request.user_id, limit=request.limit, mode=request.mode,
+            nprobe=request.nprobe, ef_search=request.ef_search
+        )
+        source = SourceText(retrieval.chunks)
+        # A near-identical question over the same chunks was already answered
+        answer = cached_answer(retrieval)
+        if answer is not None:
+            match = source.verify(answer)[1]
+        else:
+            try:
+                answer, match = await get_openai_response_async(query_text, source.text, source)
+            except QuoteNotFound as e:
+                logging.warning(f"No verifiable quote in answer: {e}")
+                raise HTTPException(status_code=400, detail="No text found within text to quote.")
+            cache_answer(retrieval, answer)
         
-        response = ChunkResponse(response=answer)
+        response = ChunkResponse(response=answer, highlight=quote_highlight(retrieval, source, match))
         logging.info(f"Response created successfully: {response}")
         return response
 
@@ -222,7 +451,178 @@ async def search_chunks(request: TextRequest):
         logging.error(f"HTTP Exception: {str(e)}")
         raise e
 
+    except openai.APIError as e:
+        logging.error(f"OpenAI request failed: {str(e)}")
+        raise HTTPException(status_code=502, detail="OpenAI request failed")
+
     except Exception as e:
         logging.error(f"Unhandled exception: {str(e)}")
         logging.error(traceback.format_exc())  # Log the full traceback
         raise HTTPException(status_code=500, detail="Internal Server Error")
+
+@router.post("/getresponse/stream/")
+async def stream_search_chunks(request: TextRequest):
+    """
+    Same as `/getresponse/`, streamed as Server-Sent Events.
+
+    Emits a `token` event per piece of the answer as the model generates it,
+    then a `done` event with the full `response`, whether it contains a
+    `***` quote, whether that quote was found in the source text, its
+    `highlight` and whether it came from the answer cache. A quote that was
+    only close to the source is repaired in `response`, so it can differ
+    from the streamed tokens. An `error` event replaces `done` if
+    generation fails.
+    """
+    query_text = request.query_text
+    logging.info(f"Streaming query: query_text={query_text}")
+
+    if not query_text:
+        raise HTTPException(status_code=400, detail="query_text is required")
+    check_user_id(request.user_id)
+    check_search_options(request.limit, request.mode)
+
+    try:
+        retrieval = await retrieve(
+            query_text, user_id=request.user_id, limit=request.limit, mode=request.mode,
+            nprobe=request.nprobe, ef_search=request.ef_search
+        )
+    except openai.APIError as e:
+        logging.error(f"OpenAI request failed: {str(e)}")
+        raise HTTPException(status_code=502, detail="OpenAI request failed")
+    except Exception as e:
+        logging.error(f"Unhandled exception: {str(e)}")
+        logging.error(traceback.format_exc())
+        raise HTTPException(status_code=500, detail="Internal Server Error")
+    source = SourceText(retrieval.chunks)
+    cached = cached_answer(retrieval)
+
+    async def events():
+        if cached is not None:
+            # Checked against this retrieval's text, like a fresh answer
+            match = source.verify(cached)[1]
+            yield sse_event("token", {"token": cached})
+            yield sse_event("done", {
+                "response": cached,
+                "quote_found": bool(re.search(r'\*\*\*(.*?)\*\*\*', cached)),
+                "quote_verified": match is not None,
+                "highlight": quote_highlight(retrieval, source, match),
+                "cached": True
+            })
+            return
+
+        tokens = []
+        try:
+            async for token in stream_openai_response(query_text, source.text):
+                tokens.append(token)
+                yield sse_event("token", {"token": token})
+        except openai.APIError as e:
+            logging.error(f"OpenAI request failed while streaming: {str(e)}")
+            yield sse_event("error", {"detail": "OpenAI request failed"})
+            return
+        except Exception as e:
+            logging.error(f"Unhandled exception while streaming: {str(e)}")
+            logging.error(traceback.format_exc())
+            yield sse_event("error", {"detail": "Internal Server Error"})
+            return
+
+        answer = "".join(tokens)
+        has_quote = bool(re.search(r'\*\*\*(.*?)\*\*\*', answer))
+        repaired, match = verify_answer(answer, source) if has_quote else (None, None)
+        verified = match is not None
+        if verified:
+            answer = repaired
+            cache_answer(retrieval, answer)
+        yield sse_event("done", {
+            "response": answer,
+            "quote_found": has_quote,
+            "quote_verified": verified,
+            "highlight": quote_highlight(retrieval, source, match),
+            "cached": False
+        })
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@router.post("/getresponse/batch/")
+async def batch_search_chunks(request: BatchRequest):
+    """
+    Answers many queries in one request, streamed back as NDJSON.
+
+    The queries are embedded together and searched with one matrix search,
+    then answered with up to `concurrency` LLM calls in flight. One JSON
+    line is written per query as soon as it is done, so lines arrive in
+    completion order; `index` is the query's position in `queries`. With
+    `answer` false only the retrieved `chunks` are returned and no LLM call
+    is made. Answers come with the `highlight` of their quote. A query whose
+    answer fails gets an `error` instead of a `response`.
+    """
+    queries = request.queries
+    if not queries or any(not query_text for query_text in queries):
+        raise HTTPException(status_code=400, detail="queries must be non-empty strings")
+    if len(queries) > config.BATCH_MAX_QUERIES:
+        raise HTTPException(status_code=400, detail=f"At most {config.BATCH_MAX_QUERIES} queries per batch")
+    check_user_id(request.user_id)
+    check_search_options(request.limit, request.mode)
+    concurrency = request.concurrency or config.BATCH_ANSWER_CONCURRENCY
+    if not 1 <= concurrency <= config.BATCH_ANSWER_CONCURRENCY:
+        raise HTTPException(status_code=400,
+                            detail=f"concurrency must be between 1 and {config.BATCH_ANSWER_CONCURRENCY}")
+
+    try:
+        retrievals = await retrieve_many(
+            queries, user_id=request.user_id, limit=request.limit, mode=request.mode,
+            nprobe=request.nprobe, ef_search=request.ef_search
+        )
+    except openai.APIError as e:
+        logging.error(f"OpenAI request failed: {str(e)}")
+        raise HTTPException(status_code=502, detail="OpenAI request failed")
+    except Exception as e:
+        logging.error(f"Unhandled exception: {str(e)}")
+        logging.error(traceback.format_exc())
+        raise HTTPException(status_code=500, detail="Internal Server Error")
+
+    slots = asyncio.Semaphore(concurrency)
+
+    async def answer(index: int, query_text: str, retrieval: Retrieval) -> Dict:
+        result = {"index": index, "query_text": query_text, "chunks": retrieval.chunks}
+        if not request.answer:
+            return result
+        source = SourceText(retrieval.chunks)
+        cached = cached_answer(retrieval)
+        if cached is not None:
+            highlight = quote_highlight(retrieval, source, source.verify(cached)[1])
+            result.update(response=cached, highlight=highlight, cached=True)
+            return result
+        try:
+            async with slots:
+                response, match = await get_openai_response_async(query_text, source.text, source)
+        except QuoteNotFound:
+            result["error"] = "No text found within text to quote."
+            return result
+        except openai.APIError as e:
+            logging.error(f"Batch query {index} failed: {str(e)}")
+            result["error"] = "OpenAI request failed"
+            return result
+        except Exception as e:
+            logging.error(f"Batch query {index} failed: {str(e)}")
+            result["error"] = "Internal Server Error"
+            return result
+        cache_answer(retrieval, response)
+        result.update(response=response, highlight=quote_highlight(retrieval, source, match), cached=False)
+        return result
+
+    async def lines():
+        tasks = [
+            asyncio.ensure_future(answer(index, query_text, retrieval))
+            for index, (query_text, retrieval) in enumerate(zip(queries, retrievals))
+        ]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield json.dumps(await next_done) + "\n"
+        finally:
+            # The client went away, stop paying for answers nobody reads
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
@@ -1,34 +1,74 @@
-from typing import List, Dict, Any, Optional
-import fitz
-import docx
-import re
+from typing import List, Dict, Any, Optional, Tuple
+import base64
+import functools
+import logging
 import io
-from pptx import Presentation
 import os
-from langchain.text_splitter import NLTKTextSplitter, RecursiveCharacterTextSplitter
-import nltk
-from nltk.tokenize import word_tokenize
-import requests
-import faiss
+import time
 import numpy as np
+from fastapi.concurrency import run_in_threadpool
 from app.core.config import config
-from app.db.crud import add_vectors, search_vector
-from openai import OpenAI
+from app.core.metrics import metrics, span
+from app.core.startup import lazy_import
+from app.db.crud import (
+    delete_vectors, fuse_rankings, get_chunk_texts, locate_span, search_lexical, search_vector,
+    sync_vectors
+)
+from app.api.v1.chunking import chunker
+from app.api.v1.embeddings import EmbeddingScheduler
+from app.api.v1.extraction import pdf_engine
+from app.api.v1.quotes import QuoteMatch, SourceText
+from app.api.v1.text import ExtractedText, TextBuilder
+import httpx
+from openai import NOT_GIVEN, AsyncOpenAI
+
+from app.db.answer_cache import AnswerCache
+from app.db.database import FaissSingleton, MissingEmbeddings, Snapshot
+from app.db.embedding_cache import EmbeddingCache
+
+# Extractors are only imported when a file of their type first arrives
+docx = lazy_import("docx")
+pptx = lazy_import("pptx")
+magic = lazy_import("magic")
 
-from app.db.database import FaissSingleton
 faiss_client = FaissSingleton()
-text_list = []
+embedding_cache = EmbeddingCache(config.EMBEDDING_CACHE_PATH, max_items=config.EMBEDDING_CACHE_MEMORY_ITEMS)
+answer_cache = AnswerCache(
+    max_items=config.ANSWER_CACHE_MAX_ITEMS,
+    ttl=config.ANSWER_CACHE_TTL,
+    threshold=config.ANSWER_CACHE_THRESHOLD,
+)
 
-nltk.download('punkt')
-nltk.download('wordnet')
-nltk.download('words')
-nltk.download('punkt_tab')
 os.environ['TESSDATA_PREFIX'] = '/usr/share/tesseract-ocr/4.00/tessdata/'
 os.environ['OPENAI_API_KEY'] = config.OPENAI_API_KEY
 
-client = OpenAI(api_key=config.OPENAI_API_KEY)
-text_splitter_nltk = NLTKTextSplitter(chunk_size=256, chunk_overlap=50)
-text_splitter_recursive = RecursiveCharacterTextSplitter(chunk_size=256*4, chunk_overlap=50)
+_async_client: Optional[AsyncOpenAI] = None
+
+def get_async_client() -> AsyncOpenAI:
+    # Shared by every request on the worker, connections to the API are reused
+    global _async_client
+    if _async_client is None:
+        _async_client = AsyncOpenAI(
+            api_key=config.OPENAI_API_KEY,
+            base_url=config.OPENAI_BASE_URL,
+            timeout=config.OPENAI_TIMEOUT,
+            http_client=httpx.AsyncClient(
+                timeout=config.OPENAI_TIMEOUT,
+                limits=httpx.Limits(
+                    max_connections=config.OPENAI_MAX_CONNECTIONS,
+                    max_keepalive_connections=config.OPENAI_MAX_CONNECTIONS,
+                ),
+            ),
+        )
+    return _async_client
+
+async def close_clients():
+    global _async_client
+    if _async_client is not None:
+        await _async_client.close()
+    _async_client = None
+
+CHAT_MODEL = 'gpt-4o-mini'
 
 system_prompt = '''
 You are a Question Answering and Text Highlighting expert specialized in extracting and highlighting relevant quotes from texts to answer specific questions\
@@ -71,154 +111,243 @@ QUESTION: the question
 TEXT: the text
 '''
 
-def clean_text(text):
-    # Remove consecutive newlines
-    cleaned_text = re.sub(r'\n+', ' ', text)
-    cleaned_text = re.sub(r'\s+', ' ', cleaned_text)
-    cleaned_text = re.sub(r'\xa0', ' ', cleaned_text)
-    cleaned_text = re.sub(r'[\u2022\u2023\u25E6\u2043\u2219\u25AA]', '', cleaned_text)
-    return cleaned_text.strip()
-
-def word_count(text):
-    words = text.split()
-    return len(words)
-
-def page_has_image(page):
-    for block in page.get_text("blocks"):
-        if block[4] == 4:  # 4 means this block is an image
-            return True
-    return False
-
-def extract_text_from_txt(file_content: bytes) -> str:
+def extract_text_from_txt(file_content: bytes) -> ExtractedText:
     text = file_content.decode('latin-1')  # Decode bytes to string using latin-1 encoding
-    cleaned_text = clean_text(text)  # Clean the whole text
-    return cleaned_text
-
-def extract_text_from_pdf(file_content: bytes) -> list:
-    with fitz.open(stream=file_content, filetype="pdf") as pdf_document:
-        text = []
-        for page_num in range(len(pdf_document)):
-            page = pdf_document.load_page(page_num)
-            blocks = page.get_text("blocks")
-            if len(blocks) == 1 and blocks[0][4] == 4:  # check if the page contains only a single image block
-                print(f"Page {page_num} is an image. Performing OCR...")
-                pix = blocks[0][-1]  # get Pixmap object from image block
-                # OCR the image, make a 1-page PDF from it
-                pdfdata = pix.pdfocr_tobytes()  # 1-page PDF in memory
-                ocrpdf = fitz.open("pdf", pdfdata)  # open as PDF document
-                ocrtext = ocrpdf[0].get_text()
-                text.append({"page":page_num, "text":ocrtext})
-            else:
-                text.append({"page":page_num, "text":page.get_text()})
-        return text
-    
-def extract_whole_text_from_pdf(file_content: bytes) -> str:
-    with fitz.open(stream=file_content, filetype="pdf") as pdf_document:
-        full_text = ""
-        for page_num in range(len(pdf_document)):
-            page = pdf_document.load_page(page_num)
-            blocks = page.get_text("blocks")
-            if len(blocks) == 1 and blocks[0][4] == 4:  # Check if the page contains only a single image block
-                print(f"Page {page_num} is an image. Performing OCR...")
-                pix = blocks[0][-1]  # Get Pixmap object from image block
-                # OCR the image, make a 1-page PDF from it
-                pdfdata = pix.pdfocr_tobytes()  # 1-page PDF in memory
-                ocrpdf = fitz.open("pdf", pdfdata)  # Open as PDF document
-                ocrtext = ocrpdf[0].get_text()
-                full_text += ocrtext
-            else:
-                full_text += page.get_text()
-        return (clean_text(full_text))
-
-def extract_text_from_docx(file_content: bytes) -> str:
+    # Form feeds separate pages. Pages are sliced one at a time, and text
+    # without form feeds is normalised as is
+    builder = TextBuilder()
+    start = 0
+    while True:
+        end = text.find("\f", start)
+        builder.page()
+        builder.add(text[start:] if end == -1 else text[start:end])
+        if end == -1:
+            break
+        start = end + 1
+    return builder.build()
+
+async def extract_whole_text_from_pdf_async(file_content: bytes) -> ExtractedText:
+    pages = await pdf_engine.extract_pages(file_content)
+    builder = TextBuilder()
+    for page_num in range(len(pages)):
+        builder.page()
+        builder.add(pages[page_num])
+        # Raw page text is released as soon as it is normalised
+        pages[page_num] = None
+    return builder.build()
+
+def _has_page_break(paragraph) -> bool:
+    # Only explicit page breaks count, pages that overflow are laid out by
+    # the renderer
+    return bool(paragraph._p.xpath('./w:r/w:br[@w:type="page"]'))
+
+def extract_text_from_docx(file_content: bytes) -> ExtractedText:
     document = docx.Document(io.BytesIO(file_content))
-    full_text = []
-    
+    builder = TextBuilder(separator="\n")
+    builder.page()
     for para in document.paragraphs:
-        if para.text.strip():  # Only include non-empty paragraphs
-            full_text.append(clean_text(para.text))
-    
-    return "\n".join(full_text)
+        builder.add(para.text)  # Empty paragraphs are skipped
+        if _has_page_break(para):
+            builder.page()
+    return builder.build()
 
-def extract_text_from_pptx(file_content: bytes) -> str:
-    prs = Presentation(io.BytesIO(file_content))
-    slide_text = []
-    
+def extract_text_from_pptx(file_content: bytes) -> ExtractedText:
+    prs = pptx.Presentation(io.BytesIO(file_content))
+    builder = TextBuilder(separator="\n")
+
+    # One line and one page per slide
     for slide in prs.slides:
-        slide_text_content = []
-        for shape in slide.shapes:
-            if hasattr(shape, "text"):
-                slide_text_content.append(shape.text)
-        if slide_text_content:  # Only include non-empty slides
-            slide_text.append(clean_text("\n".join(slide_text_content)))
-    
-    return "\n".join(slide_text) 
-
-
-def get_chunks(text: str, chunk_size: int = 128) -> List[str]:
-    try:
-        final_chunks = []
-        chunks = text_splitter_nltk.split_text(text)
-        for chunk in chunks:
-            if len(word_tokenize(chunk)) > chunk_size:
-                final_chunks.extend(text_splitter_recursive.split_text(chunk))
-            else:
-                final_chunks.append(chunk)
-        global text_list
-        text_list.extend(final_chunks)
-        return final_chunks
-    except Exception as e:
-        print ("*****************ALARM at get_chunks*****************")
-        return str(e)
-
-async def process_documents_async(text: str, chunk_size: int = 128) -> List[Dict[str, Any]]: 
-    chunks = get_chunks(text)
-    print (text_list)
-    chunk_embeddings = np.array(get_openai_embeddings(chunks)) 
-    resp = add_vectors(faiss_client, chunk_embeddings)
-    print(resp)  
+        builder.page()
+        builder.add(" ".join(shape.text for shape in slide.shapes if hasattr(shape, "text")))
+
+    return builder.build()
+
+@functools.lru_cache(maxsize=None)
+def _mime_detector():
+    # Loading the magic database is slow, one detector is shared (it locks
+    # internally)
+    return magic.Magic(mime=True)
+
+def detect_mime_type(file_content: bytes) -> str:
+    # Determine the file type using python-magic
+    return _mime_detector().from_buffer(file_content)
+
+async def extract_text_async(file_content: bytes) -> Optional[ExtractedText]:
+    # PDFs go to the page-parallel engine, everything else is cheap enough
+    # for a thread
+    with span("mime"):
+        mime_type = detect_mime_type(file_content)
+    if mime_type == 'application/pdf':
+        return await extract_whole_text_from_pdf_async(file_content)
+    elif mime_type.startswith('text/'):
+        extractor = extract_text_from_txt
+    elif mime_type == 'application/vnd.openxmlformats-officedocument.wordprocessingml.document':
+        extractor = extract_text_from_docx
+    elif mime_type == 'application/vnd.openxmlformats-officedocument.presentationml.presentation':
+        extractor = extract_text_from_pptx
+    else:
+        return None
+    return await run_in_threadpool(extractor, file_content)
+
+
+async def process_documents_async(text: str, user_id: str, file_id: str, chunk_size: int = 128,
+                                  document: Optional[Dict[str, Any]] = None,
+                                  page_starts: Optional[List[int]] = None) -> str:
+    # Chunking runs off the event loop so files in the same upload are
+    # processed concurrently
+    with span("chunk"):
+        chunks = await chunker.chunk(text, chunk_size)
+    texts = [chunk.text for chunk in chunks]
+    spans = [(chunk.start, chunk.end) for chunk in chunks]
+    # Each chunk is cited by the page it starts on
+    pages = None
+    if page_starts:
+        pages = np.searchsorted(page_starts, [start for start, _ in spans], side="right") - 1
+    metrics.count("rag_chunks_total", len(chunks), "Chunks produced by ingestion")
+    # Only chunks the file does not already have are embedded and indexed;
+    # the rest keep their vectors and stale ones are removed, all published
+    # together in one snapshot
+    stored = set(await run_in_threadpool(faiss_client.snapshot().file_texts, user_id, file_id))
+    wanted = [text for text in dict.fromkeys(texts) if text not in stored]
+    vectors = {}
+    for attempt in range(3):
+        with span("embed"):
+            vectors.update(zip(wanted, await get_openai_embeddings_async(wanted)))
+        try:
+            with span("index_write"):
+                resp = await run_in_threadpool(
+                    sync_vectors, faiss_client, user_id, file_id, texts, vectors, spans, pages, document
+                )
+            break
+        except MissingEmbeddings as e:
+            # Another worker changed the file since its chunks were read
+            wanted = e.texts
+    else:
+        raise RuntimeError(f"File {file_id} kept changing while it was being indexed")
+    logging.info(f"Indexed file {file_id} of user {user_id}: {resp}")
     return "Uploaded Successfully"
 
 
-def split_full_text(text, chunk_size=250):
-    try:
-        chunks = get_chunks(text, chunk_size=chunk_size)
-        response = [{"text": chunk} for chunk in chunks]
-        return response
-    except Exception as e:
-        print("*****************ALARM at split_full_text*****************")
-        return str(e)
-
-def get_openai_embeddings(texts, model="text-embedding-3-small"):
-    try:
-        texts = [text.replace("\n", " ") for text in texts]
-        response = client.embeddings.create(input=texts, model=model)
-        embeddings = [data.embedding for data in response.data]
-        return embeddings
-    except Exception as e:
-        print ("*****************ALARM at open ai embeddings*****************")
-        return str(e)
-
-def get_openai_response(question, text):
-    try:
-        user_query = f"QUESTION: {question}\nTEXT: {text}"
-        response_text = (client.chat.completions.create(
-        model = 'gpt-4o-mini',
-        messages = [
+def embedding_key(model: str) -> str:
+    # Shortened embeddings of a model must not be served from its full-size cache
+    return f"{model}@{config.EMBEDDING_DIMENSIONS}" if config.EMBEDDING_DIMENSIONS else model
+
+def create_embeddings(client, texts: List[str], model: str):
+    # Requested as base64 so vectors are decoded straight into float32,
+    # without a Python float per dimension
+    return client.embeddings.create(
+        input=texts, model=model, encoding_format="base64",
+        dimensions=config.EMBEDDING_DIMENSIONS or NOT_GIVEN
+    )
+
+def decode_embeddings(response) -> List[np.ndarray]:
+    return [np.frombuffer(base64.b64decode(data.embedding), dtype=np.float32) for data in response.data]
+
+async def _embed_batch(texts: List[str], model: str) -> List[np.ndarray]:
+    with span("embedding_api"):
+        response = await create_embeddings(get_async_client(), texts, model)
+    metrics.count("rag_embedded_texts_total", len(texts), "Texts sent to the embeddings API")
+    if response.usage is not None:
+        metrics.count("rag_tokens_total", response.usage.total_tokens, "Tokens billed by OpenAI", kind="embedding")
+    return decode_embeddings(response)
+
+embedding_scheduler = EmbeddingScheduler(_embed_batch)
+
+metrics.gauge("rag_index_chunks", "Chunks in the published index snapshot",
+              lambda: faiss_client.snapshot().ntotal)
+metrics.gauge("rag_index_users", "Users with a shard in the published index snapshot",
+              lambda: len(faiss_client.snapshot().user_ids))
+metrics.gauge("rag_embedding_cache_lookups", "Embedding cache lookups by result",
+              lambda: {k: v for k, v in embedding_cache.stats().items() if k != "memory_items"}, label="result")
+metrics.gauge("rag_answer_cache_lookups", "Answer cache lookups by result",
+              lambda: {"hit": answer_cache.hits, "miss": answer_cache.misses}, label="result")
+metrics.gauge("rag_answer_cache_items", "Answers held in the answer cache",
+              lambda: answer_cache.stats()["items"])
+metrics.gauge("rag_embedding_queue_depth", "Texts waiting for an embedding batch",
+              lambda: embedding_scheduler.pending)
+
+async def get_openai_embeddings_async(texts: List[str], model: str = "text-embedding-3-small") -> List[np.ndarray]:
+    """
+    Embeds `texts`, answering from the cache where possible. Misses from all
+    concurrent callers are batched together by the embedding scheduler.
+    """
+    texts = [text.replace("\n", " ") for text in texts]
+    # The cache reads and writes SQLite, which can wait on other workers' writes
+    embeddings = await run_in_threadpool(embedding_cache.get_many, embedding_key(model), texts)
+    misses = list({texts[i]: None for i, vector in enumerate(embeddings) if vector is None})
+    if misses:
+        vectors = await embedding_scheduler.embed(misses, model)
+        await run_in_threadpool(embedding_cache.put_many, embedding_key(model), misses, vectors)
+        fetched = dict(zip(misses, vectors))
+        embeddings = [fetched[text] if vector is None else vector for text, vector in zip(texts, embeddings)]
+    return embeddings
+
+def count_llm_tokens(usage):
+    if usage is not None:
+        metrics.count("rag_tokens_total", usage.prompt_tokens, "Tokens billed by OpenAI", kind="prompt")
+        metrics.count("rag_tokens_total", usage.completion_tokens, "Tokens billed by OpenAI", kind="completion")
+
+def chat_messages(question, text):
+    user_query = f"QUESTION: {question}\nTEXT: {text}"
+    return [
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": user_query}
-        ]
-        ).choices[0].message.content)
-        if '\n' in response_text:
-            print (response_text)
-        if response_text[response_text.find('***')+3:response_text.find('***', response_text.find('***')+3)].lower() in text.lower():
-           return response_text
-        else:
-            # text = text.replace('***', '')
-            # highlighted_text = longest_common_substring(text, user_query)
-            return "None"
-        
-    except Exception as e:
-        print ("*****************ALARM at open ai repsonse*****************")
-        return str(e)
+    ]
+
+def verify_answer(response_text, source: SourceText) -> Tuple[Optional[str], Optional[QuoteMatch]]:
+    """See SourceText.verify, with the outcome counted."""
+    answer, match = source.verify(response_text)
+    if match is None:
+        outcome = "missing"
+    elif match.distance or answer != response_text:
+        outcome = "repaired"
+    else:
+        outcome = "exact"
+    metrics.count("rag_quotes_total", 1, "Answer quotes checked against the source", outcome=outcome)
+    return answer, match
+
+class QuoteNotFound(Exception):
+    """The model's answer has no `***` quote that is in the source text."""
+
+async def get_openai_response_async(question, text, source: Optional[SourceText] = None) -> Tuple[str, QuoteMatch]:
+    """
+    Answers `question` from `text`, with its quote checked against the text.
+    `source` is `text` already folded for quote checks, built from it when
+    not given. Returns the answer and where its quote is in the text.
+
+    Raises:
+        QuoteNotFound: If the answer has no quote found in the text.
+        openai.APIError: If the OpenAI request fails.
+    """
+    with span("llm"):
+        response = await get_async_client().chat.completions.create(
+            model=CHAT_MODEL,
+            messages=chat_messages(question, text)
+        )
+    count_llm_tokens(response.usage)
+    response_text = response.choices[0].message.content or ""
+    answer, match = verify_answer(response_text, source or SourceText([text]))
+    if answer is None:
+        raise QuoteNotFound(response_text)
+    return answer, match
 
+async def stream_openai_response(question, text):
+    """Yields the answer's content deltas as the model produces them."""
+    with span("llm_stream"):
+        began = time.perf_counter()
+        first = True
+        stream = await get_async_client().chat.completions.create(
+            model=CHAT_MODEL,
+            messages=chat_messages(question, text),
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        async for event in stream:
+            if event.usage is not None:
+                count_llm_tokens(event.usage)
+            if event.choices and event.choices[0].delta.content:
+                if first:
+                    metrics.observe("rag_llm_first_token_seconds", time.perf_counter() - began,
+                                    "Time until the first streamed answer token")
+                    first = False
+                yield event.choices[0].delta.content
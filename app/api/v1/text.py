@@ -0,0 +1,85 @@
+import re
+from typing import Iterator, List, NamedTuple, Optional
+
+# Bullet characters dropped from extracted text
+_bullets = dict.fromkeys(map(ord, "•‣◦⁃∙▪"))
+_space = re.compile(r"\s")
+# Fragments longer than this are normalised a block at a time, which bounds
+# the temporary word list to one block whatever the size of the document
+BLOCK_SIZE = 1 << 20
+
+
+def normalise(text: str) -> str:
+    """
+    Drops bullets, collapses every run of whitespace (newlines and
+    non-breaking spaces included) into a single space and strips the ends.
+    """
+    return " ".join(text.translate(_bullets).split())
+
+
+def _blocks(text: str, size: int = BLOCK_SIZE) -> Iterator[str]:
+    # Blocks are cut at whitespace so that normalising them separately and
+    # joining them with a space gives the same text as normalising it whole
+    start = 0
+    while len(text) - start > size:
+        end = start + size
+        cut = max(text.rfind(" ", start, end), text.rfind("\n", start, end))
+        if cut <= start:
+            match = _space.search(text, end)
+            if match is None:
+                break
+            cut = match.start()
+        yield text[start:cut]
+        start = cut
+    yield text[start:]
+
+
+class ExtractedText(NamedTuple):
+    text: str
+    # Offset in `text` where each page (or slide) starts, for citations
+    page_starts: List[int]
+
+
+class TextBuilder:
+    """
+    Builds a document's text from fragments (pages, paragraphs, slides).
+
+    Each fragment is normalised on its own as it arrives and kept in a list
+    that is joined once at the end, so the full text is never copied per
+    fragment. Non-empty fragments are separated by `separator`. Calling
+    `page()` starts a new page at the next fragment.
+    """
+
+    def __init__(self, separator: str = " "):
+        self.separator = separator
+        self._parts: List[str] = []
+        self._length = 0
+        self._page_starts: List[Optional[int]] = []
+
+    def page(self):
+        self._page_starts.append(None)
+
+    def add(self, fragment: str):
+        separator = self.separator
+        for block in _blocks(fragment):
+            block = normalise(block)
+            if not block:
+                continue
+            if self._parts:
+                self._parts.append(separator)
+                self._length += len(separator)
+            separator = " "
+            # Pages that were empty so far start here too
+            for i in range(len(self._page_starts) - 1, -1, -1):
+                if self._page_starts[i] is not None:
+                    break
+                self._page_starts[i] = self._length
+            self._parts.append(block)
+            self._length += len(block)
+
+    def build(self) -> ExtractedText:
+        text = "".join(self._parts)
+        self._parts = []
+        # Trailing empty pages start at the end of the text
+        page_starts = [len(text) if start is None else start for start in self._page_starts]
+        return ExtractedText(text, page_starts)
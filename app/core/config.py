@@ -1,8 +1,115 @@
+import os
+from typing import Optional
 from pydantic.v1 import BaseSettings
 
 class Settings(BaseSettings):
     ENV: str
     OPENAI_API_KEY: str
+
+    # File downloads for ingestion
+    DOWNLOAD_TIMEOUT: float = 30.0
+    DOWNLOAD_TOTAL_TIMEOUT: float = 300.0
+    DOWNLOAD_MAX_BYTES: int = 100 * 1024 * 1024
+    DOWNLOAD_MAX_CONNECTIONS: int = 100
+    DOWNLOAD_MAX_CONNECTIONS_PER_HOST: int = 8
+
+    # Page-parallel PDF extraction
+    PDF_TEXT_WORKERS: int = max(1, (os.cpu_count() or 2) // 2)
+    PDF_OCR_WORKERS: int = max(1, (os.cpu_count() or 2) // 2)
+    PDF_PAGES_PER_TASK: int = 16
+    PDF_MAX_TASKS_PER_DOCUMENT: int = 2
+    PDF_OCR_DPI: int = 300
+    PDF_TIME_BUDGET: float = 600.0
+
+    # Chunking; texts longer than CHUNK_PROCESS_THRESHOLD characters are
+    # chunked in a process pool
+    CHUNK_OVERLAP: int = 16
+    CHUNK_PROCESS_THRESHOLD: int = 1_000_000
+    CHUNK_WORKERS: int = 2
+
+    # Vector index snapshots shared by all workers
+    INDEX_DIR: str = "data/index"
+    INDEX_SNAPSHOTS_KEPT: int = 3
+
+    # Index type: flat, hnsw, ivf_flat, ivf_pq or ivf_sq8. The index starts
+    # flat and is rebuilt as INDEX_TYPE once it holds INDEX_PROMOTE_THRESHOLD
+    # vectors
+    INDEX_TYPE: str = "hnsw"
+    INDEX_PROMOTE_THRESHOLD: int = 50000
+    IVF_NLIST: int = 0  # 0 picks ~4 * sqrt(n) at promotion
+    IVF_NPROBE: int = 16
+    PQ_M: int = 64
+    HNSW_M: int = 32
+    HNSW_EF_CONSTRUCTION: int = 200
+    HNSW_EF_SEARCH: int = 64
+    # HNSW shards cannot delete in place: searches skip deleted ids until they
+    # make up INDEX_COMPACT_RATIO of the shard, which is then rebuilt in the
+    # background
+    INDEX_COMPACT_RATIO: float = 0.2
+
+    # How indexes code their vectors: float32, float16 (2x smaller) or sq8
+    # (4x smaller). Lossy indexes return RERANK_FACTOR times the requested
+    # candidates, re-ranked against the full-precision vectors kept on disk.
+    # Applies to shards created or rebuilt after it changes
+    VECTOR_STORAGE: str = "float32"
+    RERANK_FACTOR: int = 4
+    # Shortened embeddings from the text-embedding-3 models; unset keeps the
+    # model's native size (1536). Changing it needs a new INDEX_DIR
+    EMBEDDING_DIMENSIONS: Optional[int] = None
+
+    # Retrieval; hybrid search fuses the best SEARCH_CANDIDATES vector and
+    # lexical matches with reciprocal rank fusion
+    SEARCH_TOP_K: int = 5
+    SEARCH_MAX_LIMIT: int = 100
+    SEARCH_CANDIDATES: int = 50
+    RRF_K: int = 60
+
+    # Requests sending this header with a truthy value get their stage
+    # timings back in a Server-Timing header; empty disables profiling
+    PROFILE_HEADER: str = "X-Profile"
+
+    # Batch queries; answers are generated with at most
+    # BATCH_ANSWER_CONCURRENCY LLM calls in flight per batch
+    BATCH_MAX_QUERIES: int = 1000
+    BATCH_ANSWER_CONCURRENCY: int = 16
+
+    # Embedding cache, in memory and on disk
+    EMBEDDING_CACHE_PATH: str = "data/embedding_cache.sqlite3"
+    EMBEDDING_CACHE_MEMORY_ITEMS: int = 10000
+
+    # Background ingestion jobs
+    INGESTION_WORKERS: int = 2
+    INGESTION_MAX_QUEUED_JOBS: int = 100
+    INGESTION_FILE_CONCURRENCY: int = 8
+    JOB_STORE_PATH: str = "data/jobs.sqlite3"
+    JOB_RETENTION: float = 86400.0
+    # Unfinished jobs whose worker has not sent a heartbeat for
+    # JOB_ORPHAN_TIMEOUT seconds are marked failed
+    JOB_HEARTBEAT: float = 30.0
+    JOB_ORPHAN_TIMEOUT: float = 120.0
+
+    # Answers reused for near-identical questions over the same chunks
+    ANSWER_CACHE_MAX_ITEMS: int = 10000
+    ANSWER_CACHE_TTL: float = 3600.0
+    ANSWER_CACHE_THRESHOLD: float = 0.95
+
+    # A quote that is not in the retrieved text is repaired to the closest
+    # source passage within this many edits per quote character
+    QUOTE_MAX_EDIT_RATIO: float = 0.15
+
+    # OpenAI client; OPENAI_BASE_URL points it at a compatible server, such
+    # as the benchmark stand-in, instead of the OpenAI API
+    OPENAI_BASE_URL: Optional[str] = None
+    OPENAI_TIMEOUT: float = 60.0
+    OPENAI_MAX_CONNECTIONS: int = 100
+
+    # Embedding request batching
+    EMBEDDING_BATCH_WINDOW_MS: float = 5.0
+    EMBEDDING_BATCH_MAX_ITEMS: int = 1024
+    EMBEDDING_BATCH_MAX_TOKENS: int = 200000
+    EMBEDDING_MAX_CONCURRENCY: int = 4
+    EMBEDDING_MAX_RETRIES: int = 5
+
     class Config:
         env_file = ".env"
 
@@ -0,0 +1,145 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+# Seconds; wide enough for both FAISS searches and OCR of large scans
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+GaugeValue = Union[float, Dict[str, float]]
+
+# Stage timings of the current request when it asked to be profiled
+_profile: ContextVar[Optional[List[Tuple[str, float]]]] = ContextVar("profile", default=None)
+
+
+def _labels(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format(labels: Labels, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Metrics:
+    """
+    Counters, histograms and callback gauges rendered in the Prometheus text
+    format. Values are per worker process; Prometheus sums across workers.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help: Dict[str, Tuple[str, str]] = {}
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        self._histograms: Dict[str, Dict[Labels, List[float]]] = {}
+        self._gauges: Dict[str, Tuple[str, Callable[[], GaugeValue]]] = {}
+
+    def _declare(self, name: str, kind: str, help_text: str):
+        if name not in self._help:
+            self._help[name] = (kind, help_text)
+
+    def count(self, name: str, value: float = 1, help_text: str = "", **labels):
+        with self._lock:
+            self._declare(name, "counter", help_text)
+            series = self._counters.setdefault(name, {})
+            key = _labels(labels)
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, help_text: str = "", **labels):
+        with self._lock:
+            self._declare(name, "histogram", help_text)
+            series = self._histograms.setdefault(name, {})
+            # Per-bucket counts, then sum and count
+            buckets = series.setdefault(_labels(labels), [0.0] * (len(BUCKETS) + 3))
+            buckets[bisect.bisect_left(BUCKETS, value)] += 1
+            buckets[-2] += value
+            buckets[-1] += 1
+
+    def gauge(self, name: str, help_text: str, collect: Callable[[], GaugeValue], label: str = ""):
+        """
+        Registers a gauge read when metrics are rendered. `collect` returns a
+        number, or a dict of numbers keyed by the value of `label`.
+        """
+        with self._lock:
+            self._declare(name, "gauge", help_text)
+            self._gauges[name] = (label, collect)
+
+    def render(self) -> str:
+        with self._lock:
+            counters = {name: dict(series) for name, series in self._counters.items()}
+            histograms = {name: {key: list(b) for key, b in series.items()} for name, series in self._histograms.items()}
+            gauges = dict(self._gauges)
+            described = dict(self._help)
+
+        lines = []
+        for name, (kind, help_text) in sorted(described.items()):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "counter":
+                for labels, value in sorted(counters.get(name, {}).items()):
+                    lines.append(f"{name}{_format(labels)} {value:g}")
+            elif kind == "histogram":
+                for labels, buckets in sorted(histograms.get(name, {}).items()):
+                    cumulative = 0.0
+                    for bound, count in zip(BUCKETS + (float("inf"),), buckets):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                        lines.append(f"{name}_bucket{_format(labels, (('le', le),))} {cumulative:g}")
+                    lines.append(f"{name}_sum{_format(labels)} {buckets[-2]:.6f}")
+                    lines.append(f"{name}_count{_format(labels)} {buckets[-1]:g}")
+            else:
+                label, collect = gauges[name]
+                try:
+                    value = collect()
+                except Exception:
+                    continue
+                if isinstance(value, dict):
+                    for label_value, number in sorted(value.items()):
+                        lines.append(f"{name}{_format(((label, str(label_value)),))} {number:g}")
+                else:
+                    lines.append(f"{name} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """
+    Times a pipeline stage into `rag_stage_seconds` and, when the request is
+    being profiled, into its stage breakdown.
+    """
+    began = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - began
+        metrics.observe("rag_stage_seconds", elapsed, "Time spent in each pipeline stage", stage=stage)
+        profile = _profile.get()
+        if profile is not None:
+            profile.append((stage, elapsed))
+
+
+def start_profile() -> List[Tuple[str, float]]:
+    profile: List[Tuple[str, float]] = []
+    _profile.set(profile)
+    return profile
+
+
+def server_timing(profile: List[Tuple[str, float]]) -> str:
+    """A `Server-Timing` header value, stages that ran several times are summed."""
+    totals: Dict[str, List[float]] = {}
+    for stage, elapsed in profile:
+        total = totals.setdefault(stage, [0.0, 0])
+        total[0] += elapsed
+        total[1] += 1
+    return ", ".join(
+        f'{stage};dur={elapsed * 1000:.1f};desc="x{count}"' for stage, (elapsed, count) in totals.items()
+    )
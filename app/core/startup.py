@@ -0,0 +1,105 @@
+import asyncio
+import importlib
+import logging
+import time
+from typing import Callable, Dict
+
+from fastapi.concurrency import run_in_threadpool
+
+
+class LazyModule:
+    """Stands in for a module and imports it the first time it is used."""
+
+    def __init__(self, name: str):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def load(self):
+        if self._module is None:
+            self.__dict__["_module"] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr: str):
+        return getattr(self.load(), attr)
+
+
+_lazy_modules: Dict[str, LazyModule] = {}
+
+
+def lazy_import(name: str) -> LazyModule:
+    """
+    A module that is only imported when one of its attributes is first used,
+    so importing the app does not pay for extractors and faiss up front.
+    """
+    if name not in _lazy_modules:
+        _lazy_modules[name] = LazyModule(name)
+    return _lazy_modules[name]
+
+
+def load_lazy_modules():
+    for module in list(_lazy_modules.values()):
+        module.load()
+
+
+class Warmup:
+    """
+    Runs warm-up steps in the background after the server starts and
+    reports liveness and readiness.
+
+    The worker is live as soon as it answers. It is ready once every step
+    has finished, and stops being ready while it shuts down so load
+    balancers drain it first.
+    """
+
+    def __init__(self):
+        self.state = "starting"
+        self.steps: Dict[str, Dict] = {}
+        self.draining = False
+        self._started = time.monotonic()
+
+    @property
+    def ready(self) -> bool:
+        return self.state == "ready" and not self.draining
+
+    async def run(self, steps: Dict[str, Callable[[], object]]):
+        self.state = "warming"
+        for name, step in steps.items():
+            self.steps[name] = {"status": "running"}
+            began = time.monotonic()
+            try:
+                await run_in_threadpool(step)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.exception(f"Warm-up step {name} failed")
+                self.steps[name] = {"status": "failed", "error": str(e)}
+                self.state = "failed"
+                return
+            self.steps[name] = {"status": "done", "seconds": round(time.monotonic() - began, 3)}
+        self.state = "ready"
+
+    def report(self) -> Dict:
+        return {
+            "state": "draining" if self.draining else self.state,
+            "uptime": round(time.monotonic() - self._started, 3),
+            "steps": self.steps,
+        }
+
+
+warmup = Warmup()
+
+
+if __name__ == "__main__":
+    # Build-time preflight: import everything the app loads lazily and check
+    # that native libraries and their data files are usable, so a broken
+    # image fails the build instead of the first request
+    import app.main  # noqa: F401
+    # Run as a script this file is __main__, the app registered its lazy
+    # modules on the imported copy
+    from app.core import startup
+
+    startup.load_lazy_modules()
+    import magic
+
+    assert magic.Magic(mime=True).from_buffer(b"%PDF-1.4\n") == "application/pdf"
+    print(f"Preflight OK: {', '.join(sorted(startup._lazy_modules))}")
@@ -0,0 +1,113 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+import numpy as np
+
+
+class CachedAnswer(NamedTuple):
+    query_embedding: np.ndarray
+    answer: str
+    created: float
+
+
+class AnswerCache:
+    """
+    Generated answers keyed by the exact set of retrieved chunk ids.
+
+    A lookup hits when a stored question retrieved the same chunks and its
+    embedding is within `threshold` cosine similarity of the new question.
+    Entries expire after `ttl` seconds and the least recently used are
+    evicted past `max_items`.
+
+    Chunk ids are never reused, so once a file is replaced or deleted no
+    retrieval can produce the ids of its old chunks again and their answers
+    become unreachable. `invalidate_file` drops them right away instead of
+    waiting for eviction.
+    """
+
+    def __init__(self, max_items: int = 10000, ttl: float = 3600.0, threshold: float = 0.95):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.threshold = threshold
+        self._entries: "OrderedDict[Tuple[int, ...], List[CachedAnswer]]" = OrderedDict()
+        self._files: Dict[Tuple[str, str], Set[Tuple[int, ...]]] = {}
+        # The other direction, so a dropped key is unlinked from its files
+        self._key_files: Dict[Tuple[int, ...], Set[Tuple[str, str]]] = {}
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(chunk_ids: Iterable[int]) -> Tuple[int, ...]:
+        return tuple(sorted(int(chunk_id) for chunk_id in chunk_ids))
+
+    @staticmethod
+    def _normalise(vector: np.ndarray) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32).ravel()
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _drop(self, key: Tuple[int, ...]) -> int:
+        """Removes a key and its links to files. Returns how many answers it held."""
+        entries = self._entries.pop(key, None) or []
+        self._size -= len(entries)
+        for file_key in self._key_files.pop(key, ()):
+            keys = self._files.get(file_key)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._files[file_key]
+        return len(entries)
+
+    def get(self, query_embedding: np.ndarray, chunk_ids: Iterable[int]) -> Optional[str]:
+        key = self._key(chunk_ids)
+        query = self._normalise(query_embedding)
+        now = time.monotonic()
+        with self._lock:
+            entries = self._entries.get(key)
+            if entries:
+                live = [entry for entry in entries if now - entry.created < self.ttl]
+                if live:
+                    self._size -= len(entries) - len(live)
+                    self._entries[key] = live
+                    self._entries.move_to_end(key)
+                    similarities = np.stack([entry.query_embedding for entry in live]) @ query
+                    best = int(np.argmax(similarities))
+                    if similarities[best] >= self.threshold:
+                        self.hits += 1
+                        return live[best].answer
+                else:
+                    self._drop(key)
+            self.misses += 1
+        return None
+
+    def put(self, query_embedding: np.ndarray, chunk_ids: Iterable[int], answer: str,
+            files: Iterable[Tuple[str, str]] = ()):
+        """Stores an answer. `files` are the (user_id, file_id) the chunks came from."""
+        key = self._key(chunk_ids)
+        with self._lock:
+            self._entries.setdefault(key, []).append(
+                CachedAnswer(self._normalise(query_embedding), answer, time.monotonic())
+            )
+            self._entries.move_to_end(key)
+            self._size += 1
+            for file_key in files:
+                file_key = tuple(file_key)
+                self._files.setdefault(file_key, set()).add(key)
+                self._key_files.setdefault(key, set()).add(file_key)
+            while self._size > self.max_items and self._entries:
+                self._drop(next(iter(self._entries)))
+
+    def invalidate_file(self, user_id: str, file_id: str) -> int:
+        """Drops every answer built from a file's chunks. Returns how many."""
+        removed = 0
+        with self._lock:
+            for key in list(self._files.get((user_id, file_id), ())):
+                removed += self._drop(key)
+        return removed
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "items": self._size}
@@ -0,0 +1,192 @@
+import json
+import os
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+CHUNKS_DIR = "chunks"
+TEXT_FILE = f"{CHUNKS_DIR}/text.bin"
+FILE_KEYS_FILE = f"{CHUNKS_DIR}/files.json"
+
+# Per-chunk columns; `offsets` has one extra trailing entry
+COLUMNS = {
+    "offsets": np.int64,
+    "file_idx": np.int32,
+    "chunk_no": np.int32,
+    "char_start": np.int64,
+    "char_end": np.int64,
+    "page": np.int32,
+    "deleted": np.bool_,
+}
+
+
+def _column_file(name: str) -> str:
+    return f"{CHUNKS_DIR}/{name}.npy"
+
+
+def _map_text(path: str):
+    if not os.path.exists(path) or not os.path.getsize(path):
+        return np.empty(0, dtype=np.uint8)
+    return np.memmap(path, dtype=np.uint8, mode="r")
+
+
+class ChunkStore:
+    """
+    Chunk texts and metadata held in flat arrays, indexed by chunk id.
+
+    All texts are concatenated in one UTF-8 buffer and chunk `i` is the byte
+    range offsets[i]:offsets[i + 1]. The owning file of a chunk is an index
+    into `file_keys`, its (user_id, file_id) pairs. Character spans and pages
+    locate the chunk in its source document, -1 when unknown.
+
+    On disk every column is an `.npy` file and the text buffer a raw file, so
+    readers map them instead of building a Python object per chunk. The text
+    buffer is append-only and shared between snapshots.
+    """
+
+    def __init__(self, text, columns: Dict[str, np.ndarray], file_keys: List[Tuple[str, str]]):
+        self._text = text
+        self.offsets = columns["offsets"]
+        self.file_idx = columns["file_idx"]
+        self.chunk_no = columns["chunk_no"]
+        self.char_start = columns["char_start"]
+        self.char_end = columns["char_end"]
+        self.page = columns["page"]
+        self.deleted = columns["deleted"]
+        self.file_keys = [tuple(key) for key in file_keys]
+        self._file_index = None
+        self._pending: List[bytes] = []
+        self._committed_bytes = int(self.offsets[-1])
+
+    @classmethod
+    def empty(cls) -> "ChunkStore":
+        columns = {name: np.empty(0, dtype=dtype) for name, dtype in COLUMNS.items()}
+        columns["offsets"] = np.zeros(1, dtype=np.int64)
+        return cls(np.empty(0, dtype=np.uint8), columns, [])
+
+    @classmethod
+    def load(cls, path, mmap: bool = True) -> "ChunkStore":
+        """
+        Loads a store from a snapshot. `path(name)` resolves a file name in it.
+        Writers pass `mmap=False` to get arrays they can extend.
+        """
+        if not os.path.exists(path(_column_file("offsets"))):
+            return cls.empty()
+        mode = "r" if mmap else None
+        columns = {name: np.load(path(_column_file(name)), mmap_mode=mode) for name in COLUMNS}
+        with open(path(FILE_KEYS_FILE)) as f:
+            file_keys = json.load(f)
+        return cls(_map_text(path(TEXT_FILE)), columns, file_keys)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __repr__(self) -> str:
+        return f"ChunkStore({len(self)} chunks, {int(self.offsets[-1])} bytes)"
+
+    def texts(self, ids: Sequence[int]) -> List[str]:
+        """Texts of the given chunk ids, in order."""
+        ids = np.asarray(ids, dtype=np.int64)
+        starts = self.offsets[ids].tolist()
+        ends = self.offsets[ids + 1].tolist()
+        text = self._text
+        return [bytes(text[start:end]).decode("utf-8") for start, end in zip(starts, ends)]
+
+    def metadata(self, ids: Sequence[int]) -> List[Dict]:
+        """user_id, file_id, chunk number, page and char span of each chunk id."""
+        ids = np.asarray(ids, dtype=np.int64)
+        rows = zip(
+            self.file_idx[ids].tolist(), self.chunk_no[ids].tolist(), self.page[ids].tolist(),
+            self.char_start[ids].tolist(), self.char_end[ids].tolist(),
+        )
+        return [
+            {
+                "user_id": self.file_keys[file_idx][0],
+                "file_id": self.file_keys[file_idx][1],
+                "chunk_no": chunk_no,
+                "page": page,
+                "char_start": char_start,
+                "char_end": char_end,
+            }
+            for file_idx, chunk_no, page, char_start, char_end in rows
+        ]
+
+    def _file(self, user_id: str, file_id: str, create: bool = True) -> Optional[int]:
+        if self._file_index is None:
+            self._file_index = {key: i for i, key in enumerate(self.file_keys)}
+        key = (user_id, file_id)
+        if not create:
+            return self._file_index.get(key)
+        if key not in self._file_index:
+            self._file_index[key] = len(self.file_keys)
+            self.file_keys.append(key)
+        return self._file_index[key]
+
+    def append(self, texts: List[str], user_id: str, file_id: str,
+               spans: Optional[Sequence[Tuple[int, int]]] = None,
+               pages: Optional[Sequence[int]] = None) -> np.ndarray:
+        """Adds chunks for a file and returns their ids. Written on `save`."""
+        count = len(texts)
+        encoded = [text.encode("utf-8") for text in texts]
+        lengths = np.fromiter((len(data) for data in encoded), dtype=np.int64, count=count)
+        self._pending.append(b"".join(encoded))
+
+        ids = np.arange(len(self), len(self) + count, dtype=np.int64)
+        spans = np.asarray(spans, dtype=np.int64).reshape(-1, 2) if spans is not None else np.full((count, 2), -1)
+        new = {
+            "offsets": self.offsets[-1] + np.cumsum(lengths),
+            "file_idx": np.full(count, self._file(user_id, file_id)),
+            "chunk_no": np.arange(count),
+            "char_start": spans[:, 0],
+            "char_end": spans[:, 1],
+            "page": np.asarray(pages) if pages is not None else np.full(count, -1),
+            "deleted": np.zeros(count, dtype=np.bool_),
+        }
+        for name, dtype in COLUMNS.items():
+            setattr(self, name, np.concatenate([getattr(self, name), new[name].astype(dtype)]))
+        return ids
+
+    def file_chunk_ids(self, user_id: str, file_id: str) -> np.ndarray:
+        """Ids of the live chunks of a file."""
+        file_idx = self._file(user_id, file_id, create=False)
+        if file_idx is None:
+            return np.empty(0, dtype=np.int64)
+        return np.flatnonzero((self.file_idx == file_idx) & ~self.deleted)
+
+    def place(self, ids: Sequence[int], spans: Optional[Sequence[Tuple[int, int]]] = None,
+              pages: Optional[Sequence[int]] = None):
+        """Renumbers a file's chunks in the order of `ids` and sets their spans and pages."""
+        ids = np.asarray(ids, dtype=np.int64)
+        count = len(ids)
+        spans = np.asarray(spans, dtype=np.int64).reshape(-1, 2) if spans is not None else np.full((count, 2), -1)
+        self.chunk_no[ids] = np.arange(count)
+        self.char_start[ids] = spans[:, 0]
+        self.char_end[ids] = spans[:, 1]
+        self.page[ids] = np.asarray(pages) if pages is not None else -1
+
+    def user_chunk_ids(self, user_id: str) -> np.ndarray:
+        """Ids of the live chunks of all of a user's files."""
+        file_idx = [i for i, (key_user_id, _) in enumerate(self.file_keys) if key_user_id == user_id]
+        return np.flatnonzero(np.isin(self.file_idx, file_idx) & ~self.deleted)
+
+    def delete(self, ids: Sequence[int]):
+        self.deleted[np.asarray(ids, dtype=np.int64)] = True
+
+    def save(self, txn):
+        """Writes the store into a snapshot transaction."""
+        if self._pending:
+            path = txn.append(TEXT_FILE)
+            with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+                # Drop anything a failed transaction left past the last
+                # committed chunk
+                f.seek(self._committed_bytes)
+                f.truncate()
+                for data in self._pending:
+                    f.write(data)
+            self._pending = []
+            self._committed_bytes = int(self.offsets[-1])
+            self._text = _map_text(path)
+        for name in COLUMNS:
+            np.save(txn.replace(_column_file(name)), getattr(self, name))
+        with open(txn.replace(FILE_KEYS_FILE), "w") as f:
+            json.dump(self.file_keys, f)
@@ -1,25 +1,151 @@
+import bisect
+
 import numpy as np
 
+from app.core.config import config
+from app.db.indexes import is_lossy, search_params
+
+
+def sync_vectors(faiss_client, user_id, file_id, chunks, vectors, spans=None, pages=None, document=None):
+    """
+    Updates a file's chunks in place, adding and removing only what changed.
+
+    Args:
+        vectors (dict): Embedding of each chunk text the file did not have yet.
+        document (dict): Registry record for the file, see FaissSingleton.sync_file.
+
+    Returns:
+        dict: Number of chunks added, removed and kept.
+
+    Raises:
+        MissingEmbeddings: If a chunk to add has no vector in `vectors`.
+    """
+    return faiss_client.sync_file(user_id, file_id, chunks, vectors, spans=spans, pages=pages, document=document)
+
+
+def delete_vectors(faiss_client, user_id, file_id):
+    """
+    Removes every vector and chunk stored for a file.
+
+    Returns:
+        int: Number of chunks removed, 0 if the file is unknown.
+    """
+    return faiss_client.delete(user_id, file_id)
 
-def add_vectors(faiss_client, embeddings):
-    try:
-        faiss_client.index.add(embeddings)
-        return "Successfully Added"
-    except Exception as e:
-        return str(e)
-        
 
-def search_vector(faiss_client, query_vector, top_k=5):
+def search_vector(snapshot, query_vector, user_id, top_k=5, nprobe=None, ef_search=None):
     """
-    Searches for the top K nearest vectors in the Faiss index.
+    Searches for the top K nearest vectors in a user's Faiss shard.
 
     Args:
-        query_vector (np.ndarray): A single vector to search for, shape (1, dimension).
+        snapshot: A Snapshot taken from the FaissSingleton, the returned ids
+            are ids in its `chunks` store.
+        query_vector (np.ndarray): Vectors to search for, shape (n, dimension).
+            A single vector may also be passed flat.
+        user_id (str): The user whose shard is searched, no other user's
+            chunks are ever returned.
         top_k (int): Number of nearest neighbors to retrieve.
+        nprobe (int): Inverted lists visited by IVF indexes, defaults to IVF_NPROBE.
+        ef_search (int): Candidate list size for HNSW indexes, defaults to HNSW_EF_SEARCH.
+
+    Shards that store compressed vectors return RERANK_FACTOR * top_k
+    candidates, re-ranked by exact distance to their full-precision vectors.
+    Ids an HNSW shard still holds for deleted chunks are skipped.
 
     Returns:
-        (distances, indices): Distances and indices of the nearest neighbors.
+        indices: Chunk ids of the nearest neighbors, shape (n, top_k), padded with -1.
     """
-    query_vector = np.array(query_vector, dtype='float32').reshape(1, -1)
-    distances, indices = faiss_client.index.search(query_vector, top_k)
-    return indices
\ No newline at end of file
+    query_vector = np.ascontiguousarray(np.atleast_2d(np.asarray(query_vector, dtype='float32')))
+    shard = snapshot.shard(user_id)
+    if shard is None:
+        return np.full((len(query_vector), top_k), -1, dtype='int64')
+    params = search_params(shard, nprobe=nprobe, ef_search=ef_search, selector=snapshot.selector(user_id))
+    # Compact codes only shortlist candidates, their exact vectors decide
+    rerank = config.RERANK_FACTOR > 1 and is_lossy(shard) and snapshot.vectors is not None
+    depth = top_k * config.RERANK_FACTOR if rerank else top_k
+    distances, indices = shard.search(query_vector, depth, params=params)
+    if rerank:
+        distances, indices = snapshot.vectors.rerank(query_vector, indices, top_k)
+    return indices
+
+
+def search_lexical(snapshot, query_text, user_id, top_k=5):
+    """
+    Searches a user's lexical (BM25) index for chunks matching the query's words.
+
+    Args:
+        snapshot: A Snapshot taken from the FaissSingleton.
+        query_text (str): The query, tokenized the same way as chunk texts.
+        user_id (str): The user whose chunks are searched.
+        top_k (int): Number of chunks to retrieve.
+
+    Returns:
+        indices: Chunk ids of the best matches, shape (1, top_k), padded with -1.
+    """
+    indices = np.full((1, top_k), -1, dtype='int64')
+    index = snapshot.lexical(user_id)
+    if index is not None:
+        ids, _ = index.search(query_text, top_k)
+        indices[0, :len(ids)] = ids
+    return indices
+
+
+def fuse_rankings(rankings, top_k=5, k=60):
+    """
+    Merges ranked lists of chunk ids with reciprocal rank fusion: a chunk
+    scores 1 / (k + rank) in every list it appears in.
+
+    Args:
+        rankings: Rows of chunk ids, best first, padded with -1.
+        top_k (int): Number of chunk ids to return.
+        k (int): Damping constant, higher values flatten the rank weights.
+
+    Returns:
+        np.ndarray: The `top_k` best chunk ids, best first.
+    """
+    scores = {}
+    for ranking in rankings:
+        ranking = np.asarray(ranking).ravel()
+        for rank, chunk_id in enumerate(ranking[ranking != -1].tolist()):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (k + rank + 1)
+    best = sorted(scores, key=scores.get, reverse=True)[:top_k]
+    return np.array(best, dtype='int64')
+
+
+def locate_span(snapshot, start_chunk, start, end_chunk, end):
+    """
+    Maps a span of retrieved chunk text back to its source document.
+
+    Args:
+        start_chunk, end_chunk (int): Chunk ids holding the first and the last
+            character of the span, the same id when it is within one chunk.
+        start, end (int): Offsets of the span in those chunks' texts.
+
+    Returns:
+        dict: user_id, file_id, page and char span of the text in the
+        extracted document text, -1 when unknown. A span running into a
+        chunk that does not continue the first one is cut at its end.
+    """
+    first, last = snapshot.chunks.metadata([start_chunk, end_chunk])
+    location = {"user_id": first["user_id"], "file_id": first["file_id"], "page": first["page"],
+                "char_start": -1, "char_end": -1}
+    if first["char_start"] == -1:
+        return location
+    location["char_start"] = first["char_start"] + start
+    continued = (
+        (last["user_id"], last["file_id"]) == (first["user_id"], first["file_id"])
+        and first["char_start"] <= last["char_start"] <= first["char_end"] + 1
+    )
+    location["char_end"] = last["char_start"] + end if continued else first["char_end"]
+    # The chunk's page is where it starts, the document's page offsets give
+    # the page the span starts on
+    document = snapshot.document(first["user_id"], first["file_id"]) or {}
+    if document.get("page_starts"):
+        location["page"] = bisect.bisect_right(document["page_starts"], location["char_start"]) - 1
+    return location
+
+
+def get_chunk_texts(snapshot, indices):
+    """Texts of the chunks behind a row of `search_vector` results, skipping padding."""
+    indices = np.asarray(indices).ravel()
+    return snapshot.chunks.texts(indices[indices != -1])
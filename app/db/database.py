@@ -1,11 +1,508 @@
-import faiss
+import hashlib
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+
 import numpy as np
 
+from app.core.config import config
+from app.core.startup import lazy_import
+from app.db.chunk_store import ChunkStore
+from app.db.indexes import (
+    build_index, excluding, index_type_of, index_vectors, needs_exact_vectors, promote_shard, should_promote,
+)
+from app.db.lexical import LexicalIndex
+from app.db.storage import SnapshotGone, SnapshotStore, SnapshotView, read_index_mmap
+from app.db.vector_store import VectorStore
+
+faiss = lazy_import("faiss")
+
+FILES_FILE = "files.json"  # {user_id: {file_id: chunk count}}
+# {user_id: {file_id: {content_hash, chunk_size, url, etag, last_modified, page_starts}}}
+DOCUMENTS_FILE = "documents.json"
+SHARDS_DIR = "shards"
+LEXICAL_DIR = "lexical"
+
+
+class MissingEmbeddings(Exception):
+    """Raised by `sync_file` when chunks it has to add have no vector."""
+
+    def __init__(self, texts: List[str]):
+        super().__init__(f"{len(texts)} chunks have no embedding")
+        self.texts = texts
+
+
+def shard_file(user_id: str) -> str:
+    return f"{SHARDS_DIR}/{hashlib.sha1(user_id.encode()).hexdigest()}.faiss"
+
+
+def deleted_file(user_id: str) -> str:
+    """Ids of deleted chunks that the user's HNSW shard still holds."""
+    return f"{SHARDS_DIR}/{hashlib.sha1(user_id.encode()).hexdigest()}.deleted.npy"
+
+
+def lexical_file(user_id: str, name: str) -> str:
+    return f"{LEXICAL_DIR}/{hashlib.sha1(user_id.encode()).hexdigest()}/{name}"
+
+
+class Snapshot:
+    """
+    One published version of the store: the chunks, the files they belong to
+    and a vector shard per user, all consistent with each other.
+
+    Shards are `IndexIDMap2` indexes whose ids are chunk ids, next to a
+    per-user lexical index over the same chunks. Both are mapped lazily, so
+    a worker only pages in the users it actually serves. When shards keep
+    compressed codes, the full-precision vectors of all chunks are mapped
+    too, for re-ranking. Its view leases the version, so those files are not
+    pruned while a request still holds the snapshot.
+    """
+
+    def __init__(self, version: Optional[str], chunks: ChunkStore,
+                 files: Dict[str, Dict[str, int]], view: Optional[SnapshotView] = None,
+                 documents: Optional[Dict[str, Dict[str, Dict]]] = None):
+        self.version = version
+        self.chunks = chunks
+        self.files = files
+        self.documents = documents or {}
+        self._view = view
+        self._shards: Dict[str, faiss.Index] = {}
+        self._lexical: Dict[str, Optional[LexicalIndex]] = {}
+        self._selectors: Dict[str, Optional["faiss.IDSelector"]] = {}
+        self._vectors: Optional[VectorStore] = None
+        self._vectors_loaded = False
+        self._lock = threading.Lock()
+
+    @property
+    def user_ids(self) -> List[str]:
+        return list(self.files)
+
+    def shard(self, user_id: str) -> Optional["faiss.Index"]:
+        if user_id not in self.files or self._view is None:
+            return None
+        if user_id not in self._shards:
+            with self._lock:
+                if user_id not in self._shards:
+                    self._shards[user_id] = read_index_mmap(self._view.path(shard_file(user_id)))
+        return self._shards[user_id]
+
+    def deleted(self, user_id: str) -> Optional[np.ndarray]:
+        """Ids of deleted chunks still in the user's shard, None if there are none."""
+        if user_id not in self.files or self._view is None:
+            return None
+        path = self._view.path(deleted_file(user_id))
+        return np.load(path) if os.path.exists(path) else None
+
+    def selector(self, user_id: str) -> Optional["faiss.IDSelector"]:
+        """Selects the ids of the user's shard whose chunks were not deleted, None if all are live."""
+        if user_id not in self._selectors:
+            with self._lock:
+                if user_id not in self._selectors:
+                    deleted = self.deleted(user_id)
+                    self._selectors[user_id] = excluding(deleted) if deleted is not None else None
+        return self._selectors[user_id]
+
+    def lexical(self, user_id: str) -> Optional[LexicalIndex]:
+        """
+        The user's lexical index, None for snapshots written before there was one.
+
+        Raises:
+            SnapshotGone: If the snapshot lists the index but its files were deleted.
+        """
+        if user_id not in self.files or self._view is None:
+            return None
+        if user_id not in self._lexical:
+            with self._lock:
+                if user_id not in self._lexical:
+                    index = LexicalIndex.load(lambda name: self._view.path(lexical_file(user_id, name)))
+                    if index is None and self._view.holds(lexical_file(user_id, "")):
+                        # Its files are gone, which is not the same as having none
+                        raise SnapshotGone(self.version)
+                    self._lexical[user_id] = index
+        return self._lexical[user_id]
+
+    @property
+    def vectors(self) -> Optional[VectorStore]:
+        """Full-precision vectors by chunk id, None for snapshots written before they were kept."""
+        if self._view is None:
+            return None
+        if not self._vectors_loaded:
+            with self._lock:
+                if not self._vectors_loaded:
+                    self._vectors = VectorStore.load(self._view.path)
+                    self._vectors_loaded = True
+        return self._vectors
+
+    @property
+    def ntotal(self) -> int:
+        return sum(count for user_files in self.files.values() for count in user_files.values())
+
+    def document(self, user_id: str, file_id: str) -> Optional[Dict]:
+        """What was last ingested for a file: content hash, chunk size, HTTP validators and page offsets."""
+        return self.documents.get(user_id, {}).get(file_id)
+
+    def file_texts(self, user_id: str, file_id: str) -> List[str]:
+        return self.chunks.texts(self.chunks.file_chunk_ids(user_id, file_id))
+
+
+class _WriteState:
+    """A writer's private, writable copy of the latest snapshot."""
+
+    def __init__(self, version: Optional[str], chunks: ChunkStore,
+                 files: Dict[str, Dict[str, int]], documents: Dict[str, Dict[str, Dict]]):
+        self.version = version
+        self.chunks = chunks
+        self.files = files
+        self.documents = documents
+        self.shards: Dict[str, faiss.Index] = {}
+        self.lexical: Dict[str, LexicalIndex] = {}
+        self.deleted: Dict[str, np.ndarray] = {}
+        self.vectors: Optional[VectorStore] = None
+        self.dirty = set()
+
+
 class FaissSingleton:
+    """
+    The per-user vector shards and the chunks their ids point at.
+
+    Everything lives in a SnapshotStore on disk. Reads go through a
+    memory-mapped, read-only copy of the published snapshot which is swapped
+    when another worker publishes a new one; writes are serialised across
+    workers by the store and publish a new snapshot.
+    """
     _instance = None
 
-    def __new__(cls, dimension=1536):
+    def __new__(cls, dimension=config.EMBEDDING_DIMENSIONS or 1536, root=config.INDEX_DIR):
         if cls._instance is None:
             cls._instance = super(FaissSingleton, cls).__new__(cls)
-            cls._instance.index = faiss.IndexFlatL2(dimension)  # L2 distance
+            cls._instance.dimension = dimension
+            cls._instance.store = SnapshotStore(root, keep=config.INDEX_SNAPSHOTS_KEPT)
+            cls._instance._snapshot = Snapshot(None, ChunkStore.empty(), {})
+            cls._instance._writable = None
+            cls._instance._lock = threading.Lock()
+            cls._instance._compactor = None
+            cls._instance._compacting = set()
         return cls._instance
+
+    def snapshot(self) -> Snapshot:
+        """The latest published snapshot."""
+        version = self.store.current_version()
+        if version != self._snapshot.version:
+            with self._lock:
+                while version != self._snapshot.version:
+                    try:
+                        self._snapshot = self._load(version)
+                    except SnapshotGone:
+                        # Pruned since CURRENT was read, a newer one is published
+                        version = self.store.current_version()
+        return self._snapshot
+
+    @property
+    def chunks(self) -> ChunkStore:
+        return self.snapshot().chunks
+
+    def _load(self, version: Optional[str], mmap: bool = True) -> Snapshot:
+        if version is None:
+            return Snapshot(None, ChunkStore.empty(), {})
+        view = self.store.view(version)
+        chunks = ChunkStore.load(view.path, mmap=mmap)
+        with open(view.path(FILES_FILE)) as f:
+            files = json.load(f)
+        documents = {}
+        # Snapshots published before the document registry have no file for it
+        if os.path.exists(view.path(DOCUMENTS_FILE)):
+            with open(view.path(DOCUMENTS_FILE)) as f:
+                documents = json.load(f)
+        return Snapshot(version, chunks, files, view, documents)
+
+    def _new_shard(self, training_vectors: Optional[np.ndarray] = None) -> "faiss.Index":
+        return faiss.IndexIDMap2(build_index("flat", self.dimension, training_vectors))
+
+    def _shard(self, state: _WriteState, txn, user_id: str,
+               training_vectors: Optional[np.ndarray] = None) -> "faiss.Index":
+        """
+        The user's writable shard. A new one is trained on `training_vectors`
+        when its storage needs training.
+        """
+        if user_id not in state.shards:
+            if txn.exists(shard_file(user_id)):
+                shard = faiss.read_index(txn.file(shard_file(user_id)))
+                if shard.d != self.dimension:
+                    raise ValueError(
+                        f"The index holds {shard.d}-dimensional vectors, not {self.dimension}; "
+                        "changing EMBEDDING_DIMENSIONS needs a new INDEX_DIR"
+                    )
+                state.shards[user_id] = shard
+            else:
+                state.shards[user_id] = self._new_shard(training_vectors)
+        return state.shards[user_id]
+
+    def _vectors(self, state: _WriteState, txn) -> Optional[VectorStore]:
+        """
+        The writable full-precision vectors, None while the shards' own
+        vectors are exact and none are kept. Must be taken before new chunks
+        are appended: a store started for an existing index gets every
+        chunk's vector decoded from its shard first.
+        """
+        if state.vectors is None:
+            vectors = VectorStore.load(txn.file)
+            if vectors is None:
+                # Kept once started, shards made lossy meanwhile rely on it
+                if not needs_exact_vectors():
+                    return None
+                vectors = VectorStore.empty(self.dimension)
+            if vectors.dimension != self.dimension:
+                raise ValueError(
+                    f"The index holds {vectors.dimension}-dimensional vectors, not {self.dimension}; "
+                    "changing EMBEDDING_DIMENSIONS needs a new INDEX_DIR"
+                )
+            stored = len(vectors)
+            if len(state.chunks) > stored:
+                # Deleted chunks keep zero rows
+                rows = np.zeros((len(state.chunks) - stored, self.dimension), dtype=np.float32)
+                for user_id in state.files:
+                    shard = self._shard(state, txn, user_id)
+                    ids = faiss.vector_to_array(shard.id_map)
+                    wanted = ids >= stored
+                    if wanted.any():
+                        rows[ids[wanted] - stored] = index_vectors(shard)[wanted]
+                vectors.append(rows)
+            state.vectors = vectors
+        return state.vectors
+
+    def _promoted(self, state: _WriteState, shard: "faiss.Index") -> "faiss.Index":
+        # Rebuilt from the full-precision vectors, not the shard's codes
+        if not should_promote(shard):
+            return shard
+        if state.vectors is None:
+            # The shard's own vectors are exact
+            return promote_shard(shard)
+        ids = faiss.vector_to_array(shard.id_map)
+        return promote_shard(shard, vectors=state.vectors.get(ids))
+
+    def _lexical(self, state: _WriteState, txn, user_id: str) -> LexicalIndex:
+        """
+        The user's writable lexical index. Must be taken before new chunks are
+        appended: a user without one yet gets it built from their stored chunks.
+        """
+        if user_id not in state.lexical:
+            index = LexicalIndex.load(lambda name: txn.file(lexical_file(user_id, name)), mmap=False)
+            if index is None:
+                index = LexicalIndex.empty()
+                ids = state.chunks.user_chunk_ids(user_id)
+                if len(ids):
+                    index.add(ids, state.chunks.texts(ids))
+            state.lexical[user_id] = index
+        return state.lexical[user_id]
+
+    def _deleted(self, state: _WriteState, txn, user_id: str) -> np.ndarray:
+        if user_id not in state.deleted:
+            path = txn.file(deleted_file(user_id))
+            state.deleted[user_id] = np.load(path) if os.path.exists(path) else np.empty(0, dtype=np.int64)
+        return state.deleted[user_id]
+
+    def _remove(self, state: _WriteState, txn, user_id: str, file_id: str) -> int:
+        state.documents.get(user_id, {}).pop(file_id, None)
+        if state.files.get(user_id, {}).pop(file_id, None) is None:
+            return 0
+        remove = state.chunks.file_chunk_ids(user_id, file_id)
+        self._remove_ids(state, txn, user_id, remove)
+        return len(remove)
+
+    def _remove_ids(self, state: _WriteState, txn, user_id: str, remove: np.ndarray):
+        if not len(remove):
+            return
+        shard = self._shard(state, txn, user_id)
+        if index_type_of(shard) == "hnsw":
+            # HNSW cannot delete in place, searches skip the ids until the
+            # shard is compacted
+            state.deleted[user_id] = np.union1d(self._deleted(state, txn, user_id), remove)
+        else:
+            shard.remove_ids(remove)
+        self._lexical(state, txn, user_id).remove(remove)
+        state.chunks.delete(remove)
+        state.dirty.add(user_id)
+
+    def _write(self, operation):
+        """
+        Runs `operation(state, txn)` against a writable copy of the latest
+        snapshot and publishes the result.
+        """
+        try:
+            with self.store.transaction() as txn:
+                # Reuse this worker's in-memory copy unless another worker has
+                # published since
+                state = self._writable
+                if state is None or state.version != txn.parent:
+                    published = self._load(txn.parent, mmap=False)
+                    state = _WriteState(txn.parent, published.chunks, published.files, published.documents)
+                self._writable = None
+
+                result = operation(state, txn)
+
+                to_compact = []
+                for user_id in state.dirty:
+                    if state.files.get(user_id):
+                        shard = state.shards[user_id]
+                        faiss.write_index(shard, txn.replace(shard_file(user_id)))
+                        if user_id in state.lexical:
+                            state.lexical[user_id].save(
+                                lambda name: txn.replace(lexical_file(user_id, name)),
+                                lambda name: txn.remove(lexical_file(user_id, name)),
+                            )
+                        deleted = state.deleted.get(user_id)
+                        if deleted is not None and len(deleted):
+                            np.save(txn.replace(deleted_file(user_id)), deleted)
+                            if len(deleted) >= config.INDEX_COMPACT_RATIO * shard.ntotal:
+                                to_compact.append(user_id)
+                        elif deleted is not None:
+                            txn.remove(deleted_file(user_id))
+                    else:
+                        state.files.pop(user_id, None)
+                        state.documents.pop(user_id, None)
+                        state.shards.pop(user_id, None)
+                        state.deleted.pop(user_id, None)
+                        lexical = state.lexical.pop(user_id, None)
+                        txn.remove(shard_file(user_id))
+                        txn.remove(deleted_file(user_id))
+                        for name in lexical.file_names() if lexical is not None else ():
+                            txn.remove(lexical_file(user_id, name))
+                state.dirty.clear()
+                state.chunks.save(txn)
+                if state.vectors is not None:
+                    state.vectors.save(txn)
+                with open(txn.replace(FILES_FILE), "w") as f:
+                    json.dump(state.files, f)
+                with open(txn.replace(DOCUMENTS_FILE), "w") as f:
+                    json.dump(state.documents, f)
+            state.version = txn.version
+            self._writable = state
+        except BaseException:
+            self._writable = None
+            raise
+        for user_id in to_compact:
+            self._compact_later(user_id)
+        return result
+
+    def compact(self, user_id: str) -> bool:
+        """
+        Rebuilds a user's shard without the ids of deleted chunks it still
+        holds. The rebuild reads the published snapshot outside the store's
+        write lock, and is only published if the shard was not written
+        meanwhile; the next write that deletes from it tries again.
+
+        Returns:
+            Whether a compacted shard was published.
+        """
+        snapshot = self.snapshot()
+        shard = snapshot.shard(user_id)
+        deleted = snapshot.deleted(user_id)
+        if shard is None or deleted is None:
+            return False
+        source = self.store.path(snapshot.version, shard_file(user_id))
+        ids = faiss.vector_to_array(shard.id_map)
+        kept_rows = ~np.isin(ids, deleted)
+        kept_ids = ids[kept_rows]
+        if not len(kept_ids):
+            return False
+        # Rebuilt from the full-precision vectors, not the shard's codes
+        kept = snapshot.vectors.get(kept_ids) if snapshot.vectors is not None else index_vectors(shard)[kept_rows]
+        compacted = self._new_shard(kept)
+        compacted.add_with_ids(kept, kept_ids)
+        if should_promote(compacted):
+            compacted = promote_shard(compacted, vectors=kept)
+
+        def operation(state: _WriteState, txn):
+            if txn.file(shard_file(user_id)) != source:
+                return False
+            state.shards[user_id] = compacted
+            state.deleted[user_id] = np.empty(0, dtype=np.int64)
+            state.dirty.add(user_id)
+            return True
+        return self._write(operation)
+
+    def _compact_later(self, user_id: str):
+        with self._lock:
+            if user_id in self._compacting:
+                return
+            self._compacting.add(user_id)
+            if self._compactor is None:
+                self._compactor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shard-compaction")
+        self._compactor.submit(self._compact_in_background, user_id)
+
+    def _compact_in_background(self, user_id: str):
+        try:
+            self.compact(user_id)
+        except Exception:
+            logging.exception(f"Compacting the shard of user {user_id} failed")
+        finally:
+            with self._lock:
+                self._compacting.discard(user_id)
+
+    def sync_file(self, user_id: str, file_id: str, chunks: List[str], vectors: Dict[str, np.ndarray],
+                  spans: Optional[Sequence[Tuple[int, int]]] = None, pages: Optional[Sequence[int]] = None,
+                  document: Optional[Dict] = None) -> Dict[str, int]:
+        """
+        Makes a file's stored chunks match `chunks`, touching only what changed.
+
+        Chunks whose text is already stored for the file keep their id and
+        vector and only get their position updated; new texts are added with
+        their vector from `vectors`, and stored chunks that are no longer
+        present are removed. `document` is recorded in the registry.
+
+        Returns:
+            How many chunks were added, removed and kept.
+
+        Raises:
+            MissingEmbeddings: If a chunk to add has no vector in `vectors`,
+                e.g. because another worker changed the file meanwhile.
+                Nothing is written.
+        """
+        def operation(state: _WriteState, txn):
+            stored = state.chunks.file_chunk_ids(user_id, file_id)
+            by_text: Dict[str, List[int]] = {}
+            for chunk_id, text in zip(stored.tolist(), state.chunks.texts(stored)):
+                by_text.setdefault(text, []).append(chunk_id)
+
+            placed: List[Optional[int]] = []
+            for text in chunks:
+                placed.append(by_text[text].pop() if by_text.get(text) else None)
+            added = [i for i, chunk_id in enumerate(placed) if chunk_id is None]
+            missing = list(dict.fromkeys(chunks[i] for i in added if chunks[i] not in vectors))
+            if missing:
+                raise MissingEmbeddings(missing)
+
+            removed = np.array([chunk_id for ids in by_text.values() for chunk_id in ids], dtype=np.int64)
+            self._remove_ids(state, txn, user_id, removed)
+            if added:
+                lexical = self._lexical(state, txn, user_id)
+                stored_vectors = self._vectors(state, txn)
+                ids = state.chunks.append([chunks[i] for i in added], user_id, file_id)
+                lexical.add(ids, [chunks[i] for i in added])
+                embeddings = np.stack([vectors[chunks[i]] for i in added], dtype=np.float32)
+                if stored_vectors is not None:
+                    stored_vectors.append(embeddings)
+                shard = self._shard(state, txn, user_id, embeddings)
+                shard.add_with_ids(embeddings, ids)
+                state.shards[user_id] = self._promoted(state, shard)
+                for i, chunk_id in zip(added, ids.tolist()):
+                    placed[i] = chunk_id
+                state.dirty.add(user_id)
+            state.chunks.place(np.array(placed, dtype=np.int64), spans=spans, pages=pages)
+
+            if chunks:
+                state.files.setdefault(user_id, {})[file_id] = len(chunks)
+                if document is not None:
+                    state.documents.setdefault(user_id, {})[file_id] = document
+            else:
+                state.files.get(user_id, {}).pop(file_id, None)
+                state.documents.get(user_id, {}).pop(file_id, None)
+            return {"added": len(added), "removed": len(removed), "kept": len(chunks) - len(added)}
+        return self._write(operation)
+
+    def delete(self, user_id: str, file_id: str) -> int:
+        """Removes a file's chunks. Returns how many were removed."""
+        return self._write(lambda state, txn: self._remove(state, txn, user_id, file_id))
@@ -0,0 +1,113 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+_whitespace = re.compile(r"\s+")
+
+
+def normalise(text: str) -> str:
+    return _whitespace.sub(" ", text).strip()
+
+
+def cache_key(model: str, text: str) -> bytes:
+    return hashlib.sha256(f"{model}\0{normalise(text)}".encode("utf-8")).digest()
+
+
+class EmbeddingCache:
+    """
+    Embeddings keyed by (model, sha256 of the whitespace-normalised text).
+
+    Lookups go to an in-memory LRU first and then to a SQLite table shared by
+    every worker on the host; disk hits are promoted into memory. Vectors are
+    stored as float32 bytes.
+    """
+
+    def __init__(self, path: str, max_items: int = 10000):
+        self.path = path
+        self.max_items = max_items
+        self._memory: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            db = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vector BLOB NOT NULL)")
+            self._db = db
+        return self._db
+
+    def open(self):
+        """Opens the database ahead of the first lookup."""
+        with self._lock:
+            self._connection()
+
+    def _remember(self, key: bytes, vector: np.ndarray):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+
+    def get_many(self, model: str, texts: Sequence[str]) -> List[Optional[np.ndarray]]:
+        """Cached vectors for `texts`, None where the text has not been embedded."""
+        keys = [cache_key(model, text) for text in texts]
+        found: List[Optional[np.ndarray]] = [None] * len(keys)
+        with self._lock:
+            missing: Dict[bytes, List[int]] = {}
+            for i, key in enumerate(keys):
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    found[i] = self._memory[key]
+                    self.hits_memory += 1
+                else:
+                    missing.setdefault(key, []).append(i)
+
+            if missing:
+                db = self._connection()
+                lookup = list(missing)
+                # Stay under SQLite's bound parameter limit
+                for start in range(0, len(lookup), 500):
+                    batch = lookup[start:start + 500]
+                    rows = db.execute(
+                        f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})",
+                        batch,
+                    ).fetchall()
+                    for key, blob in rows:
+                        vector = np.frombuffer(blob, dtype=np.float32)
+                        self._remember(key, vector)
+                        for i in missing.pop(key):
+                            found[i] = vector
+                            self.hits_disk += 1
+                self.misses += sum(len(positions) for positions in missing.values())
+        return found
+
+    def put_many(self, model: str, texts: Sequence[str], vectors: Sequence[np.ndarray]):
+        rows = []
+        with self._lock:
+            for text, vector in zip(texts, vectors):
+                key = cache_key(model, text)
+                vector = np.asarray(vector, dtype=np.float32)
+                self._remember(key, vector)
+                rows.append((key, vector.tobytes()))
+            db = self._connection()
+            with db:
+                db.executemany("INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)", rows)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits_memory": self.hits_memory,
+            "hits_disk": self.hits_disk,
+            "misses": self.misses,
+            "memory_items": len(self._memory),
+        }
@@ -0,0 +1,294 @@
+import argparse
+import json
+import math
+import time
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from app.core.config import config
+from app.core.startup import lazy_import
+
+faiss = lazy_import("faiss")
+
+INDEX_TYPES = ("flat", "hnsw", "ivf_flat", "ivf_pq", "ivf_sq8")
+VECTOR_STORAGES = ("float32", "float16", "sq8")
+
+
+def _nlist(n_vectors: int) -> int:
+    if config.IVF_NLIST:
+        return config.IVF_NLIST
+    # ~4 * sqrt(n) lists, with enough points per list to train k-means
+    return max(1, min(int(4 * math.sqrt(n_vectors)), n_vectors // 39))
+
+
+def _quantizer_type(storage: str) -> int:
+    if storage == "float16":
+        return faiss.ScalarQuantizer.QT_fp16
+    return faiss.ScalarQuantizer.QT_8bit
+
+
+def build_index(index_type: str, dimension: int, training_vectors: Optional[np.ndarray] = None,
+                storage: str = config.VECTOR_STORAGE) -> "faiss.Index":
+    """
+    Creates an empty index of the given type, trained on `training_vectors`
+    when the type needs training.
+
+    `storage` is how flat, HNSW and IVF-flat indexes code their vectors:
+    float32, float16 or sq8 (8 bits per dimension). IVF-PQ and IVF-SQ8 are
+    compact already and ignore it.
+    """
+    if storage not in VECTOR_STORAGES:
+        raise ValueError(f"Unknown vector storage {storage!r}, expected one of {VECTOR_STORAGES}")
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type {index_type!r}, expected one of {INDEX_TYPES}")
+    needs_training = index_type.startswith("ivf") or storage == "sq8"
+    if needs_training and (training_vectors is None or not len(training_vectors)):
+        raise ValueError(f"{index_type} indexes with {storage} storage need training vectors")
+    if training_vectors is not None:
+        training_vectors = np.ascontiguousarray(training_vectors, dtype='float32')
+
+    if index_type == "flat":
+        if storage == "float32":
+            return faiss.IndexFlatL2(dimension)
+        if storage == "float16":
+            return faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_fp16)
+        # Flat shards grow from their first file, so a single range for all
+        # dimensions with headroom is safer than per-dimension ranges fitted
+        # to a few vectors
+        index = faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_8bit_uniform)
+        index.sq.rangestat = faiss.ScalarQuantizer.RS_minmax
+        index.sq.rangestat_arg = 0.2
+        index.train(training_vectors)
+        return index
+    if index_type == "hnsw":
+        if storage == "float32":
+            index = faiss.IndexHNSWFlat(dimension, config.HNSW_M)
+        else:
+            index = faiss.IndexHNSWSQ(dimension, _quantizer_type(storage), config.HNSW_M)
+            if storage == "sq8":
+                index.train(training_vectors)
+        index.hnsw.efConstruction = config.HNSW_EF_CONSTRUCTION
+        index.hnsw.efSearch = config.HNSW_EF_SEARCH
+        return index
+
+    nlist = _nlist(len(training_vectors))
+    quantizer = faiss.IndexFlatL2(dimension)
+    if index_type == "ivf_flat" and storage == "float32":
+        index = faiss.IndexIVFFlat(quantizer, dimension, nlist)
+    elif index_type == "ivf_flat":
+        index = faiss.IndexIVFScalarQuantizer(quantizer, dimension, nlist, _quantizer_type(storage))
+    elif index_type == "ivf_pq":
+        index = faiss.IndexIVFPQ(quantizer, dimension, nlist, config.PQ_M, 8)
+    else:
+        index = faiss.IndexIVFScalarQuantizer(quantizer, dimension, nlist, faiss.ScalarQuantizer.QT_8bit)
+    index.train(training_vectors)
+    index.nprobe = config.IVF_NPROBE
+    return index
+
+
+def _unwrap(index: "faiss.Index") -> "faiss.Index":
+    # Callers must keep `index` bound: downcast wrappers do not own the index
+    concrete = faiss.downcast_index(index)
+    if isinstance(concrete, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        concrete = faiss.downcast_index(concrete.index)
+    return concrete
+
+
+def index_type_of(index: "faiss.Index") -> str:
+    concrete = _unwrap(index)
+    if isinstance(concrete, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(concrete, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(concrete, faiss.IndexIVFScalarQuantizer):
+        return "ivf_flat" if concrete.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else "ivf_sq8"
+    if isinstance(concrete, faiss.IndexIVF):
+        return "ivf_flat"
+    return "flat"
+
+
+def storage_of(index: "faiss.Index") -> str:
+    """How `index` codes its vectors: float32, float16, sq8 or pq."""
+    concrete = _unwrap(index)
+    if isinstance(concrete, faiss.IndexHNSW):
+        return storage_of(concrete.storage)
+    if isinstance(concrete, faiss.IndexIVFPQ):
+        return "pq"
+    if isinstance(concrete, (faiss.IndexScalarQuantizer, faiss.IndexIVFScalarQuantizer)):
+        return "float16" if concrete.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else "sq8"
+    return "float32"
+
+
+def is_lossy(index: "faiss.Index") -> bool:
+    """Whether the distances `index` returns are approximated from compressed codes."""
+    return storage_of(index) != "float32"
+
+
+def needs_exact_vectors(index_type: str = config.INDEX_TYPE, storage: str = config.VECTOR_STORAGE) -> bool:
+    """Whether shards built with these settings only keep compressed codes of their vectors."""
+    return storage != "float32" or index_type in ("ivf_pq", "ivf_sq8")
+
+
+def index_vectors(index: "faiss.Index") -> np.ndarray:
+    """
+    All vectors stored in `index` in insertion order, decoded to float32
+    (lossy for PQ/SQ). For id-mapped indexes the rows line up with `id_map`.
+    """
+    concrete = _unwrap(index)
+    if isinstance(concrete, faiss.IndexIVF):
+        concrete.make_direct_map()
+    return concrete.reconstruct_n(0, concrete.ntotal)
+
+
+def should_promote(index: "faiss.Index", index_type: str = config.INDEX_TYPE,
+                   threshold: int = config.INDEX_PROMOTE_THRESHOLD) -> bool:
+    return index_type != "flat" and index_type_of(index) == "flat" and index.ntotal >= threshold
+
+
+def promote(index: "faiss.Index", index_type: str = config.INDEX_TYPE,
+            vectors: Optional[np.ndarray] = None) -> "faiss.Index":
+    """
+    Rebuilds a flat index as `index_type`, training it on the stored vectors.
+    Pass the full-precision `vectors` when the index only holds compact codes.
+    """
+    vectors = index_vectors(index) if vectors is None else vectors
+    promoted = build_index(index_type, index.d, vectors)
+    promoted.add(vectors)
+    return promoted
+
+
+def promote_shard(shard: "faiss.IndexIDMap2", index_type: str = config.INDEX_TYPE,
+                  vectors: Optional[np.ndarray] = None) -> "faiss.IndexIDMap2":
+    """Like `promote`, for an id-mapped shard. The chunk ids are kept."""
+    ids = faiss.vector_to_array(shard.id_map)
+    vectors = index_vectors(shard) if vectors is None else vectors
+    promoted = faiss.IndexIDMap2(build_index(index_type, shard.d, vectors))
+    promoted.add_with_ids(vectors, ids)
+    return promoted
+
+
+def excluding(ids: np.ndarray) -> "faiss.IDSelector":
+    """A selector of every id but `ids`, for `search_params`."""
+    return faiss.IDSelectorNot(faiss.IDSelectorBatch(np.ascontiguousarray(ids, dtype='int64')))
+
+
+def search_params(index: "faiss.Index", nprobe: Optional[int] = None,
+                  ef_search: Optional[int] = None,
+                  selector: Optional["faiss.IDSelector"] = None) -> Optional["faiss.SearchParameters"]:
+    """
+    Per-call search parameters for `index`. Passing them to `search` rather
+    than setting them on the shared index keeps concurrent queries from
+    seeing each other's settings. Only ids `selector` accepts are returned.
+    """
+    index_type = index_type_of(index)
+    if index_type == "hnsw":
+        return faiss.SearchParametersHNSW(efSearch=ef_search or config.HNSW_EF_SEARCH, sel=selector)
+    if index_type.startswith("ivf"):
+        return faiss.SearchParametersIVF(nprobe=nprobe or config.IVF_NPROBE, sel=selector)
+    if selector is not None:
+        return faiss.SearchParameters(sel=selector)
+    return None
+
+
+def recall_report(vectors: np.ndarray, queries: np.ndarray, k: int = 10,
+                  index_types: Sequence[str] = INDEX_TYPES,
+                  nprobe_values: Sequence[int] = (1, 4, 16, 64),
+                  ef_search_values: Sequence[int] = (16, 64, 256),
+                  storages: Sequence[str] = ("float32",),
+                  rerank_factor: int = config.RERANK_FACTOR) -> List[Dict]:
+    """
+    Measures recall@k and latency of each index type and vector storage
+    against exact flat search. Lossy indexes are measured both as they are
+    and re-ranked against `vectors` from `rerank_factor * k` candidates.
+
+    Returns:
+        One row per (index type, storage, search parameter, re-ranked) with
+        recall, mean and p99 per-query latency, build time and serialised
+        index size.
+    """
+    from app.db.vector_store import VectorStore
+
+    vectors = np.ascontiguousarray(vectors, dtype='float32')
+    queries = np.ascontiguousarray(queries, dtype='float32')
+    dimension = vectors.shape[1]
+    exact = VectorStore(dimension, vectors, len(vectors))
+    rows = []
+    truth = None
+
+    for index_type in index_types:
+        for storage in storages:
+            if index_type in ("ivf_pq", "ivf_sq8") and storage != "float32":
+                # Compact already, storage does not apply
+                continue
+            started = time.perf_counter()
+            index = build_index(index_type, dimension, vectors, storage)
+            index.add(vectors)
+            build_s = time.perf_counter() - started
+            size = int(faiss.serialize_index(index).nbytes)
+
+            if index_type == "hnsw":
+                settings = [{"ef_search": ef} for ef in ef_search_values]
+            elif index_type.startswith("ivf"):
+                settings = [{"nprobe": nprobe} for nprobe in nprobe_values]
+            else:
+                settings = [{}]
+
+            for setting in settings:
+                params = search_params(index, **setting)
+                for rerank in ((False, True) if is_lossy(index) and rerank_factor > 1 else (False,)):
+                    depth = k * rerank_factor if rerank else k
+                    latencies = []
+                    found = []
+                    for query in queries:
+                        started = time.perf_counter()
+                        _, ids = index.search(query.reshape(1, -1), depth, params=params)
+                        if rerank:
+                            _, ids = exact.rerank(query.reshape(1, -1), ids, k)
+                        latencies.append(time.perf_counter() - started)
+                        found.append(ids[0])
+                    if truth is None:
+                        _, truth = faiss.knn(queries, vectors, k)
+                    recall = np.mean([len(set(f) & set(t)) / k for f, t in zip(found, truth)])
+                    rows.append({
+                        "index_type": index_type,
+                        "storage": storage_of(index),
+                        **setting,
+                        "reranked": rerank,
+                        "recall_at_k": round(float(recall), 4),
+                        "latency_ms_mean": round(1000 * float(np.mean(latencies)), 4),
+                        "latency_ms_p99": round(1000 * float(np.percentile(latencies, 99)), 4),
+                        "build_s": round(build_s, 3),
+                        "index_bytes": size,
+                    })
+    return rows
+
+
+if __name__ == "__main__":
+    from app.db.database import FaissSingleton, shard_file
+
+    parser = argparse.ArgumentParser(description="Recall vs latency of each index type and storage on the stored corpus")
+    parser.add_argument("--queries", type=int, default=200, help="corpus vectors sampled as queries")
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--types", nargs="+", default=list(INDEX_TYPES), choices=INDEX_TYPES)
+    parser.add_argument("--storages", nargs="+", default=list(VECTOR_STORAGES), choices=VECTOR_STORAGES)
+    args = parser.parse_args()
+
+    faiss_client = FaissSingleton()
+    snapshot = faiss_client.snapshot()
+    if not snapshot.ntotal:
+        raise SystemExit("The index is empty")
+    if snapshot.vectors is not None:
+        live = np.concatenate([snapshot.chunks.user_chunk_ids(user_id) for user_id in snapshot.user_ids])
+        vectors = snapshot.vectors.get(live)
+    else:
+        # Private, writable copies: decoding IVF lists needs a direct map
+        vectors = np.concatenate([
+            index_vectors(faiss.read_index(faiss_client.store.path(snapshot.version, shard_file(user_id))))
+            for user_id in snapshot.user_ids
+        ])
+    rng = np.random.default_rng(0)
+    sample = rng.choice(len(vectors), size=min(args.queries, len(vectors)), replace=False)
+    # Perturb the samples so queries are near, not on, stored vectors
+    queries = vectors[sample] + rng.normal(0, 0.01, size=(len(sample), vectors.shape[1])).astype('float32')
+    print(json.dumps(recall_report(vectors, queries, args.k, args.types, storages=args.storages), indent=2))
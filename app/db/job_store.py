@@ -0,0 +1,112 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, Optional
+
+
+def mark_failed(job: Dict, error: str, now: float) -> Dict:
+    """Marks a job that will never finish, and its unfinished files, as failed."""
+    job.update(status="failed", error=error, finished_at=now)
+    for entry in job["files"]:
+        if entry["status"] not in ("done", "error"):
+            entry.update(status="error", error=error)
+    return job
+
+
+class JobStore:
+    """
+    Ingestion job records in SQLite, so a job's status can be read from any
+    worker whichever one is running it. Records are JSON documents replaced
+    on every update; finished jobs are dropped after `retention` seconds.
+
+    The worker holding a job refreshes its heartbeat; an unfinished job
+    whose heartbeat stops died with its worker and is marked failed by
+    `fail_orphans`.
+    """
+
+    def __init__(self, path: str, retention: float = 86400.0):
+        self.path = path
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            db = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs "
+                "(id TEXT PRIMARY KEY, record TEXT NOT NULL, finished REAL, heartbeat REAL)"
+            )
+            # Stores created before jobs had a heartbeat
+            if "heartbeat" not in {row[1] for row in db.execute("PRAGMA table_info(jobs)")}:
+                db.execute("ALTER TABLE jobs ADD COLUMN heartbeat REAL")
+            self._db = db
+        return self._db
+
+    def save(self, job: Dict):
+        self.write(job["job_id"], json.dumps(job), job.get("finished_at"))
+
+    def write(self, job_id: str, record: str, finished: Optional[float]):
+        """Stores a job record already serialised to JSON."""
+        with self._lock:
+            db = self._connection()
+            with db:
+                db.execute(
+                    "INSERT OR REPLACE INTO jobs (id, record, finished, heartbeat) VALUES (?, ?, ?, ?)",
+                    (job_id, record, finished, time.time()),
+                )
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT record FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def touch(self, job_ids: Iterable[str]):
+        """Refreshes the heartbeat of jobs this worker still holds."""
+        job_ids = list(job_ids)
+        with self._lock:
+            db = self._connection()
+            with db:
+                db.executemany(
+                    "UPDATE jobs SET heartbeat = ? WHERE id = ?",
+                    [(time.time(), job_id) for job_id in job_ids],
+                )
+
+    def fail_orphans(self, stale_after: float) -> int:
+        """
+        Marks unfinished jobs without a heartbeat for `stale_after` seconds
+        as failed. Returns how many.
+        """
+        now = time.time()
+        with self._lock:
+            db = self._connection()
+            rows = db.execute(
+                "SELECT id, record FROM jobs WHERE finished IS NULL AND (heartbeat IS NULL OR heartbeat < ?)",
+                (now - stale_after,),
+            ).fetchall()
+            with db:
+                for job_id, record in rows:
+                    job = mark_failed(json.loads(record), "Interrupted by a server restart", now)
+                    # Unless its worker saved it since it was read
+                    db.execute(
+                        "UPDATE jobs SET record = ?, finished = ? "
+                        "WHERE id = ? AND finished IS NULL AND (heartbeat IS NULL OR heartbeat < ?)",
+                        (json.dumps(job), now, job_id, now - stale_after),
+                    )
+        return len(rows)
+
+    def prune(self):
+        with self._lock:
+            db = self._connection()
+            with db:
+                db.execute(
+                    "DELETE FROM jobs WHERE finished IS NOT NULL AND finished < ?",
+                    (time.time() - self.retention,),
+                )
@@ -0,0 +1,303 @@
+import hashlib
+import json
+import os
+import re
+from collections import Counter
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+# A new segment is merged into the one before it while that one holds at
+# most MERGE_RATIO times its postings, so segment sizes grow geometrically
+MERGE_RATIO = 2
+# Everything is merged into one segment past this many segments, or once
+# deleted chunks make up this share of the indexed ones
+MAX_SEGMENTS = 16
+MAX_DELETED_SHARE = 0.25
+
+MANIFEST_FILE = "segments.json"
+DELETED_FILE = "deleted.npy"
+
+_word = re.compile(r"\w+")
+
+# Postings of a segment are grouped by term: the postings of terms[i] are
+# docs[offsets[i]:offsets[i + 1]] with term frequencies in `tfs`. Documents
+# are chunk ids, their token counts are in doc_lengths, aligned with doc_ids.
+ARRAYS = {
+    "terms": np.uint64,
+    "offsets": np.int64,
+    "docs": np.int64,
+    "tfs": np.int32,
+    "doc_ids": np.int64,
+    "doc_lengths": np.int32,
+}
+
+
+def tokenize(text: str) -> List[str]:
+    return _word.findall(text.lower())
+
+
+def term_hashes(terms: Iterable[str]) -> np.ndarray:
+    """Stable 64-bit hashes of terms, so the index stores no vocabulary."""
+    digests = b"".join(hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest() for term in terms)
+    return np.frombuffer(digests, dtype=np.uint64)
+
+
+class Segment:
+    """
+    Immutable postings of some chunks in flat CSR arrays. Its files are
+    named with `prefix`, which is empty for indexes written before there
+    were segments.
+    """
+
+    def __init__(self, prefix: str, arrays: Dict[str, np.ndarray]):
+        self.prefix = prefix
+        for name in ARRAYS:
+            setattr(self, name, arrays[name])
+
+    @classmethod
+    def build(cls, prefix: str, terms: np.ndarray, docs: np.ndarray, tfs: np.ndarray,
+              doc_ids: np.ndarray, doc_lengths: np.ndarray) -> "Segment":
+        order = np.lexsort((docs, terms))
+        terms = terms[order]
+        unique_terms, starts = np.unique(terms, return_index=True)
+        doc_order = np.argsort(doc_ids, kind="stable")
+        return cls(prefix, {
+            "terms": unique_terms,
+            "offsets": np.append(starts, len(terms)).astype(np.int64),
+            "docs": docs[order],
+            "tfs": tfs[order],
+            "doc_ids": doc_ids[doc_order],
+            "doc_lengths": doc_lengths[doc_order],
+        })
+
+    @classmethod
+    def load(cls, prefix: str, path: Callable[[str], str], mmap: bool) -> "Segment":
+        mode = "r" if mmap else None
+        return cls(prefix, {name: np.load(path(f"{prefix}{name}.npy"), mmap_mode=mode) for name in ARRAYS})
+
+    def save(self, path: Callable[[str], str]):
+        for name in ARRAYS:
+            np.save(path(f"{self.prefix}{name}.npy"), getattr(self, name))
+
+    def file_names(self) -> List[str]:
+        return [f"{self.prefix}{name}.npy" for name in ARRAYS]
+
+    def expanded_terms(self) -> np.ndarray:
+        return np.repeat(np.asarray(self.terms), np.diff(self.offsets))
+
+    def lengths_of(self, ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Which of `ids` are in the segment, and the token counts of those that are."""
+        if not len(self.doc_ids):
+            return np.zeros(len(ids), dtype=bool), np.empty(0, dtype=np.int32)
+        positions = np.minimum(np.searchsorted(self.doc_ids, ids), len(self.doc_ids) - 1)
+        found = self.doc_ids[positions] == ids
+        return found, self.doc_lengths[positions[found]]
+
+    def postings(self, hashes: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Postings of the query term hashes: the term's index in `hashes`, doc, tf and doc length."""
+        empty = np.empty(0, dtype=np.int64)
+        if not len(self.terms):
+            return empty, empty, empty.astype(np.int32), empty.astype(np.int32)
+        positions = np.minimum(np.searchsorted(self.terms, hashes), len(self.terms) - 1)
+        matched = np.flatnonzero(self.terms[positions] == hashes)
+        positions = positions[matched]
+        starts, ends = self.offsets[positions], self.offsets[positions + 1]
+        if not len(positions):
+            return empty, empty, empty.astype(np.int32), empty.astype(np.int32)
+        docs = np.concatenate([self.docs[start:end] for start, end in zip(starts, ends)])
+        tfs = np.concatenate([self.tfs[start:end] for start, end in zip(starts, ends)])
+        lengths = self.doc_lengths[np.searchsorted(self.doc_ids, docs)]
+        return np.repeat(matched, ends - starts), docs, tfs, lengths
+
+
+class LexicalIndex:
+    """
+    An inverted index over chunk texts, scored with BM25.
+
+    Terms are stored as 64-bit hashes with their postings in immutable
+    segments of flat CSR arrays, so a snapshot's index can be memory-mapped
+    like the chunk store. Adding chunks writes a new segment holding only
+    them; removing chunks records their ids as deleted. Small segments are
+    merged into larger ones as they accumulate, dropping deleted chunks, so
+    an upload costs about the size of its own chunks rather than the user's
+    whole corpus. Saving only writes segments that are not on disk yet.
+    """
+
+    def __init__(self, segments: List[Segment], deleted: np.ndarray, next_segment: int,
+                 doc_count: int, total_length: int):
+        self.segments = segments
+        self.deleted = deleted
+        self.next_segment = next_segment
+        # Live chunks and their total token count
+        self.doc_count = doc_count
+        self.total_length = total_length
+        # Segments written since the index was loaded, and files to remove
+        self._unsaved = set()
+        self._dropped: List[str] = []
+        self._deleted_changed = False
+
+    @classmethod
+    def empty(cls) -> "LexicalIndex":
+        return cls([], np.empty(0, dtype=np.int64), 1, 0, 0)
+
+    @classmethod
+    def load(cls, path: Callable[[str], str], mmap: bool = True) -> Optional["LexicalIndex"]:
+        """
+        Loads an index from a snapshot, None if it has none. `path(name)`
+        resolves a file name in it.
+        """
+        if os.path.exists(path(MANIFEST_FILE)):
+            with open(path(MANIFEST_FILE)) as f:
+                manifest = json.load(f)
+            segments = [Segment.load(prefix, path, mmap) for prefix in manifest["segments"]]
+            deleted = np.load(path(DELETED_FILE)) if os.path.exists(path(DELETED_FILE)) else np.empty(0, np.int64)
+            return cls(segments, deleted, manifest["next_segment"], manifest["doc_count"], manifest["total_length"])
+        if os.path.exists(path("terms.npy")):
+            # Written before segments, its arrays are one segment
+            segment = Segment.load("", path, mmap)
+            return cls([segment], np.empty(0, dtype=np.int64), 1,
+                       len(segment.doc_ids), int(np.sum(segment.doc_lengths, dtype=np.int64)))
+        return None
+
+    def save(self, path: Callable[[str], str], remove: Callable[[str], None]):
+        """
+        Writes what changed since the index was loaded. `path(name)` gives
+        the file to write for each array, `remove(name)` deletes a file of
+        a segment that was merged away.
+        """
+        for segment in self.segments:
+            if segment.prefix in self._unsaved:
+                segment.save(path)
+        for name in self._dropped:
+            remove(name)
+        if self._deleted_changed:
+            np.save(path(DELETED_FILE), self.deleted)
+        with open(path(MANIFEST_FILE), "w") as f:
+            json.dump({
+                "segments": [segment.prefix for segment in self.segments],
+                "next_segment": self.next_segment,
+                "doc_count": self.doc_count,
+                "total_length": self.total_length,
+            }, f)
+        self._unsaved.clear()
+        self._dropped = []
+        self._deleted_changed = False
+
+    def file_names(self) -> List[str]:
+        """Every file of the index as saved."""
+        names = [name for segment in self.segments for name in segment.file_names()]
+        return names + self._dropped + [DELETED_FILE, MANIFEST_FILE]
+
+    def __len__(self) -> int:
+        return self.doc_count
+
+    def _new_prefix(self) -> str:
+        prefix = "seg%06d." % self.next_segment
+        self.next_segment += 1
+        self._unsaved.add(prefix)
+        return prefix
+
+    def add(self, ids: Sequence[int], texts: Sequence[str]):
+        vocabulary: Dict[str, int] = {}
+        term_idx: List[int] = []
+        docs: List[int] = []
+        tfs: List[int] = []
+        lengths: List[int] = []
+        for chunk_id, text in zip(ids, texts):
+            tokens = tokenize(text)
+            lengths.append(len(tokens))
+            for term, count in Counter(tokens).items():
+                term_idx.append(vocabulary.setdefault(term, len(vocabulary)))
+                docs.append(int(chunk_id))
+                tfs.append(count)
+        if not lengths:
+            return
+
+        hashes = term_hashes(vocabulary)
+        self.segments.append(Segment.build(
+            self._new_prefix(),
+            hashes[np.asarray(term_idx, dtype=np.int64)],
+            np.asarray(docs, dtype=np.int64),
+            np.asarray(tfs, dtype=np.int32),
+            np.asarray(ids, dtype=np.int64),
+            np.asarray(lengths, dtype=np.int32),
+        ))
+        self.doc_count += len(lengths)
+        self.total_length += sum(lengths)
+        if len(self.segments) > MAX_SEGMENTS:
+            self._merge(0)
+        while len(self.segments) > 1 and len(self.segments[-2].docs) <= MERGE_RATIO * len(self.segments[-1].docs):
+            self._merge(len(self.segments) - 2)
+
+    def remove(self, ids: Sequence[int]):
+        ids = np.unique(np.asarray(ids, dtype=np.int64))
+        ids = ids[~np.isin(ids, self.deleted)]
+        removed = np.zeros(len(ids), dtype=bool)
+        for segment in self.segments:
+            found, lengths = segment.lengths_of(ids)
+            removed |= found
+            self.total_length -= int(np.sum(lengths, dtype=np.int64))
+        if not removed.any():
+            return
+        self.doc_count -= int(removed.sum())
+        self.deleted = np.union1d(self.deleted, ids[removed])
+        self._deleted_changed = True
+        indexed = self.doc_count + len(self.deleted)
+        if len(self.deleted) > MAX_DELETED_SHARE * indexed:
+            self._merge(0)
+
+    def _merge(self, first: int):
+        """Merges segments[first:] into one, dropping deleted chunks."""
+        merged = self.segments[first:]
+        terms = np.concatenate([segment.expanded_terms() for segment in merged])
+        docs = np.concatenate([segment.docs for segment in merged])
+        tfs = np.concatenate([segment.tfs for segment in merged])
+        doc_ids = np.concatenate([segment.doc_ids for segment in merged])
+        doc_lengths = np.concatenate([segment.doc_lengths for segment in merged])
+        kept = ~np.isin(docs, self.deleted)
+        kept_docs = ~np.isin(doc_ids, self.deleted)
+        # Deleted chunks of the merged segments are gone for good
+        self.deleted = self.deleted[~np.isin(self.deleted, doc_ids)]
+        self._deleted_changed = True
+        for segment in merged:
+            if segment.prefix in self._unsaved:
+                self._unsaved.discard(segment.prefix)
+            else:
+                self._dropped.extend(segment.file_names())
+        self.segments[first:] = [Segment.build(
+            self._new_prefix(), terms[kept], docs[kept], tfs[kept], doc_ids[kept_docs], doc_lengths[kept_docs]
+        )]
+
+    def search(self, query: str, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """The `k` best chunk ids for `query` and their BM25 scores, best first."""
+        hashes = np.unique(term_hashes(set(tokenize(query))))
+        if not self.doc_count or not len(hashes):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        postings = [segment.postings(hashes) for segment in self.segments]
+        term_idx, docs, tfs, lengths = (np.concatenate(parts) for parts in zip(*postings))
+        if len(self.deleted):
+            live = ~np.isin(docs, self.deleted)
+            term_idx, docs, tfs, lengths = term_idx[live], docs[live], tfs[live], lengths[live]
+        if not len(docs):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        n = self.doc_count
+        df = np.bincount(term_idx, minlength=len(hashes))
+        idf = np.log1p((n - df + 0.5) / (df + 0.5))
+        tfs = tfs.astype(np.float32)
+        avgdl = self.total_length / n or 1.0
+        parts = idf[term_idx] * tfs * (K1 + 1) / (tfs + K1 * (1 - B + B * lengths / avgdl))
+
+        candidates, inverse = np.unique(docs, return_inverse=True)
+        scores = np.bincount(inverse, weights=parts)
+        if len(scores) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return candidates[top], scores[top].astype(np.float32)
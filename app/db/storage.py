@@ -0,0 +1,379 @@
+import fcntl
+import json
+import os
+import shutil
+import threading
+import weakref
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+from app.core.startup import lazy_import
+
+faiss = lazy_import("faiss")
+
+MANIFEST_FILE = "MANIFEST"
+# Marks a snapshot that is no longer readable, whose directory only holds
+# units newer snapshots still use
+RETIRED_FILE = "RETIRED"
+
+
+class SnapshotGone(Exception):
+    """The snapshot was pruned before it could be read."""
+
+    def __init__(self, version: str):
+        super().__init__(f"Snapshot {version} was pruned")
+        self.version = version
+
+
+def mmap_flags() -> int:
+    # Zero-copy mapping of flat codes where this faiss build supports it
+    return getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+
+
+def unit_of(name: str) -> str:
+    """
+    The unit a snapshot file is shared in: its first two path components,
+    e.g. `lexical/<user>` for a user's lexical index, `shards/<user>.faiss`
+    for their shard or `files.json`.
+    """
+    return "/".join(name.split("/")[:2])
+
+
+def _units_in(path: str) -> Dict[str, str]:
+    # Snapshots written before manifests hold every one of their files
+    units = {}
+    for directory, _, names in os.walk(path):
+        for name in names:
+            relative = os.path.relpath(os.path.join(directory, name), path).replace(os.sep, "/")
+            if relative not in (MANIFEST_FILE, RETIRED_FILE):
+                units[unit_of(relative)] = os.path.basename(path)
+    return units
+
+
+def _delete(path: str):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+
+class SnapshotView:
+    """
+    A published snapshot, for reading. `path(name)` locates its files.
+
+    The view holds a shared lock on the snapshot's lease until it is closed
+    or garbage collected, and pruning skips leased snapshots, so files a
+    reader opens lazily are still there however many snapshots are
+    published meanwhile.
+    """
+
+    def __init__(self, store: "SnapshotStore", version: str, manifest: Dict[str, str], lease: int):
+        self.store = store
+        self.version = version
+        self.manifest = manifest
+        self._release = weakref.finalize(self, os.close, lease)
+
+    def path(self, name: str) -> str:
+        owner = self.manifest.get(unit_of(name), self.version)
+        return os.path.join(self.store.snapshots_dir, owner, name)
+
+    def holds(self, name: str) -> bool:
+        """Whether the snapshot has the unit of `name`."""
+        return unit_of(name) in self.manifest
+
+    def close(self):
+        self._release()
+
+
+class SnapshotTransaction:
+    """
+    A snapshot being written. It starts as its parent's manifest, so every
+    unit is read where an older snapshot wrote it; a unit is hard-linked
+    into the new snapshot only when the transaction first changes it. A
+    write then costs about what it changes, however many users the store
+    holds.
+    """
+
+    def __init__(self, path: str, parent: Optional[str], version: str,
+                 manifest: Dict[str, str], snapshots_dir: str):
+        self.path = path
+        self.parent = parent
+        self.version = version
+        self.manifest = manifest
+        self._snapshots_dir = snapshots_dir
+        self._owned = set()
+
+    def file(self, name: str) -> str:
+        """Path of an existing file in the snapshot, for reading."""
+        unit = unit_of(name)
+        if unit in self._owned or unit not in self.manifest:
+            return os.path.join(self.path, name)
+        return os.path.join(self._snapshots_dir, self.manifest[unit], name)
+
+    def exists(self, name: str) -> bool:
+        return os.path.exists(self.file(name))
+
+    def _own(self, name: str) -> str:
+        """Links the unit holding `name` into this snapshot, returns the file's path in it."""
+        unit = unit_of(name)
+        if unit not in self._owned:
+            source = self.file(unit)
+            target = os.path.join(self.path, unit)
+            if os.path.isdir(source):
+                shutil.copytree(source, target, copy_function=os.link)
+            elif os.path.exists(source):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.link(source, target)
+            self._owned.add(unit)
+            self.manifest[unit] = self.version
+        path = os.path.join(self.path, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def replace(self, name: str) -> str:
+        """
+        Path to write a new version of `name` to.
+
+        Files are hard links shared with older snapshots that readers may have
+        mapped, so they must be replaced and never rewritten in place.
+        """
+        path = self._own(name)
+        if os.path.lexists(path):
+            os.unlink(path)
+        return path
+
+    def append(self, name: str) -> str:
+        """
+        Path of an append-only file, which stays shared with older snapshots.
+        Only bytes past everything those snapshots reference may be written.
+        """
+        return self._own(name)
+
+    def remove(self, name: str):
+        if self.exists(name):
+            os.unlink(self._own(name))
+
+    def finish(self):
+        """Drops units the transaction emptied and writes the manifest."""
+        for unit in self._owned:
+            path = os.path.join(self.path, unit)
+            if os.path.isdir(path) and not any(names for _, _, names in os.walk(path)):
+                shutil.rmtree(path)
+            if not os.path.exists(path):
+                del self.manifest[unit]
+        with open(os.path.join(self.path, MANIFEST_FILE), "w") as f:
+            json.dump(self.manifest, f)
+
+
+class SnapshotStore:
+    """
+    Versioned, publish-by-rename snapshots on local disk.
+
+    Layout under `root`:
+        CURRENT               name of the published snapshot
+        LOCK                  held exclusively by the one writer at a time
+        leases/<version>      share-locked by every reader of a snapshot
+        snapshots/<version>/  the units written by each snapshot, and its
+                              MANIFEST naming the snapshot each of its
+                              units was last written by
+
+    Every uvicorn worker reads the published snapshot, memory-mapped and
+    read-only, so the OS page cache holds a single copy of it. Writers build
+    the next snapshot next to it and publish it by atomically replacing
+    CURRENT; readers pick it up on their next access.
+    """
+
+    def __init__(self, root: str, keep: int = 3):
+        self.root = root
+        self.keep = keep
+        self.snapshots_dir = os.path.join(root, "snapshots")
+        self._current_file = os.path.join(root, "CURRENT")
+        self._lock_file = os.path.join(root, "LOCK")
+        self._leases_dir = os.path.join(root, "leases")
+        self._thread_lock = threading.Lock()
+        self._manifests: Dict[str, Dict[str, str]] = {}
+        self._manifest_lock = threading.Lock()
+        os.makedirs(self.snapshots_dir, exist_ok=True)
+        if not os.path.isdir(self._leases_dir):
+            # Stores written before leases
+            with self._writer_lock():
+                os.makedirs(self._leases_dir, exist_ok=True)
+                for version in self.versions():
+                    if not self._retired(version):
+                        open(self._lease_file(version), "a").close()
+
+    def current_version(self) -> Optional[str]:
+        try:
+            with open(self._current_file) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def manifest(self, version: str) -> Dict[str, str]:
+        """Which snapshot holds each unit of `version`. Manifests never change once published."""
+        with self._manifest_lock:
+            if version in self._manifests:
+                return self._manifests[version]
+        path = os.path.join(self.snapshots_dir, version, MANIFEST_FILE)
+        if os.path.exists(path):
+            with open(path) as f:
+                manifest = json.load(f)
+        else:
+            manifest = _units_in(os.path.join(self.snapshots_dir, version))
+        self._cache_manifest(version, manifest)
+        return manifest
+
+    def _cache_manifest(self, version: str, manifest: Dict[str, str]):
+        # Only the newest few are read again
+        with self._manifest_lock:
+            self._manifests[version] = manifest
+            for old in sorted(self._manifests)[:-(self.keep + 1)]:
+                del self._manifests[old]
+
+    def _lease_file(self, version: str) -> str:
+        return os.path.join(self._leases_dir, version)
+
+    def view(self, version: str) -> SnapshotView:
+        """
+        Opens a published snapshot for reading.
+
+        Raises:
+            SnapshotGone: If it was pruned meanwhile.
+        """
+        path = self._lease_file(version)
+        try:
+            lease = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            raise SnapshotGone(version)
+        try:
+            fcntl.flock(lease, fcntl.LOCK_SH)
+            # Pruning unlinks the lease before it deletes anything
+            if os.fstat(lease).st_ino != os.stat(path).st_ino:
+                raise SnapshotGone(version)
+            return SnapshotView(self, version, self.manifest(version), lease)
+        except BaseException as e:
+            os.close(lease)
+            if isinstance(e, FileNotFoundError):
+                raise SnapshotGone(version)
+            raise
+
+    def path(self, version: str, name: str) -> str:
+        """Path of a file of a snapshot, which must not be pruned while it is used."""
+        owner = self.manifest(version).get(unit_of(name), version)
+        return os.path.join(self.snapshots_dir, owner, name)
+
+    def versions(self) -> List[str]:
+        return sorted(
+            name for name in os.listdir(self.snapshots_dir)
+            if not name.startswith(".")
+        )
+
+    @contextmanager
+    def _writer_lock(self):
+        with self._thread_lock, open(self._lock_file, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    @contextmanager
+    def transaction(self) -> Iterator[SnapshotTransaction]:
+        """
+        Opens the next snapshot for writing. It is published when the block
+        exits cleanly and discarded if it raises.
+        """
+        with self._writer_lock():
+            parent = self.current_version()
+            version = "%012d" % (int(parent) + 1 if parent else 1)
+            staging = os.path.join(self.snapshots_dir, f".{version}")
+            shutil.rmtree(staging, ignore_errors=True)
+            os.makedirs(staging)
+            manifest = dict(self.manifest(parent)) if parent else {}
+
+            try:
+                txn = SnapshotTransaction(staging, parent, version, manifest, self.snapshots_dir)
+                yield txn
+                txn.finish()
+            except BaseException:
+                shutil.rmtree(staging, ignore_errors=True)
+                raise
+
+            # A crash between rename and publish can leave this behind
+            shutil.rmtree(os.path.join(self.snapshots_dir, version), ignore_errors=True)
+            os.rename(staging, os.path.join(self.snapshots_dir, version))
+            self._cache_manifest(version, txn.manifest)
+            open(self._lease_file(version), "a").close()
+            self._publish(version)
+            self._prune()
+
+    def _publish(self, version: str):
+        tmp = self._current_file + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(version)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._current_file)
+
+    def _retired(self, version: str) -> bool:
+        return os.path.exists(os.path.join(self.snapshots_dir, version, RETIRED_FILE))
+
+    def _lease_for_pruning(self, version: str) -> Optional[int]:
+        """The lease of a snapshot no reader holds, locked exclusively; None if one does."""
+        # Created again if pruning stopped halfway through retiring it
+        lease = os.open(self._lease_file(version), os.O_RDONLY | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(lease, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(lease)
+            return None
+        return lease
+
+    def _prune(self):
+        """
+        Retires snapshots past the `keep` newest that no reader holds. Units
+        of a retired snapshot that others still use stay in its directory
+        until they are replaced too; the directory goes once it holds none.
+        """
+        # Workers that mapped an older snapshot keep their pages after the
+        # unlink; a few versions are kept for readers that are mid-reload
+        versions = self.versions()
+        retiring = {}
+        for version in versions[:-self.keep]:
+            if not self._retired(version):
+                lease = self._lease_for_pruning(version)
+                if lease is not None:
+                    retiring[version] = lease
+        if not retiring:
+            return
+        try:
+            live = {
+                (unit, owner)
+                for version in versions
+                if version not in retiring and not self._retired(version)
+                for unit, owner in self.manifest(version).items()
+            }
+            touched = set(retiring)
+            for version in retiring:
+                # Readers that open the lease from now on find it gone
+                os.unlink(self._lease_file(version))
+                for unit, owner in self.manifest(version).items():
+                    if (unit, owner) not in live:
+                        path = os.path.join(self.snapshots_dir, owner, unit)
+                        _delete(path)
+                        if "/" in unit and os.path.isdir(os.path.dirname(path)) and not os.listdir(os.path.dirname(path)):
+                            os.rmdir(os.path.dirname(path))
+                        touched.add(owner)
+                open(os.path.join(self.snapshots_dir, version, RETIRED_FILE), "w").close()
+                _delete(os.path.join(self.snapshots_dir, version, MANIFEST_FILE))
+            for version in touched:
+                path = os.path.join(self.snapshots_dir, version)
+                if self._retired(version) and not _units_in(path):
+                    shutil.rmtree(path, ignore_errors=True)
+        finally:
+            for lease in retiring.values():
+                os.close(lease)
+
+
+def read_index_mmap(path: str):
+    return faiss.read_index(path, mmap_flags())
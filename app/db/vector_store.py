@@ -0,0 +1,115 @@
+import json
+import os
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+VECTORS_DIR = "vectors"
+VECTORS_FILE = f"{VECTORS_DIR}/float32.bin"
+META_FILE = f"{VECTORS_DIR}/meta.json"
+
+
+def _map_vectors(path: str, dimension: int, rows: int) -> np.ndarray:
+    if not rows:
+        return np.empty((0, dimension), dtype=np.float32)
+    return np.memmap(path, dtype=np.float32, mode="r", shape=(rows, dimension))
+
+
+class VectorStore:
+    """
+    Full-precision embeddings indexed by chunk id, row `i` being chunk `i`.
+
+    Indexes may keep only compact float16 or 8-bit codes of the vectors;
+    the exact vectors stay here for re-ranking their candidates and for
+    rebuilding shards without compounding quantisation error. Like the chunk
+    text buffer the file is append-only and shared between snapshots, and
+    readers map it, so only the rows of re-ranked candidates are paged in.
+    """
+
+    def __init__(self, dimension: int, data: np.ndarray, rows: int):
+        self.dimension = dimension
+        self._data = data
+        self._committed_rows = rows
+        self._pending: List[np.ndarray] = []
+        self._pending_rows = 0
+
+    @classmethod
+    def empty(cls, dimension: int) -> "VectorStore":
+        return cls(dimension, _map_vectors("", dimension, 0), 0)
+
+    @classmethod
+    def load(cls, path) -> Optional["VectorStore"]:
+        """
+        Maps the store of a snapshot, None for snapshots written before it
+        existed. `path(name)` resolves a file name in it.
+        """
+        if not os.path.exists(path(META_FILE)):
+            return None
+        with open(path(META_FILE)) as f:
+            meta = json.load(f)
+        return cls(meta["dimension"], _map_vectors(path(VECTORS_FILE), meta["dimension"], meta["rows"]), meta["rows"])
+
+    def __len__(self) -> int:
+        return self._committed_rows + self._pending_rows
+
+    def append(self, vectors: np.ndarray):
+        """Adds the vectors of the next chunk ids. Written on `save`."""
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(-1, self.dimension)
+        self._pending.append(vectors)
+        self._pending_rows += len(vectors)
+
+    def get(self, ids: Sequence[int]) -> np.ndarray:
+        """The vectors of the given chunk ids, shape (len(ids), dimension)."""
+        ids = np.asarray(ids, dtype=np.int64)
+        if not self._pending:
+            return np.asarray(self._data[ids])
+        if len(self._pending) > 1:
+            self._pending = [np.concatenate(self._pending)]
+        committed = ids < self._committed_rows
+        out = np.empty((len(ids), self.dimension), dtype=np.float32)
+        out[committed] = self._data[ids[committed]]
+        out[~committed] = self._pending[0][ids[~committed] - self._committed_rows]
+        return out
+
+    def rerank(self, queries: np.ndarray, candidates: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Re-scores candidate ids by exact L2 distance and keeps the best `k`.
+
+        Args:
+            queries: Query vectors, shape (n, dimension).
+            candidates: Candidate chunk ids per query, shape (n, c), padded with -1.
+
+        Returns:
+            distances, ids: Both shape (n, k), best first, padded with inf and -1.
+        """
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        for row, (query, found) in enumerate(zip(queries, candidates)):
+            found = found[found != -1]
+            if not len(found):
+                continue
+            # One query at a time, so only c rows are gathered into memory
+            exact = self.get(found)
+            exact -= query
+            scores = np.einsum("ij,ij->i", exact, exact)
+            best = np.argsort(scores, kind="stable")[:k]
+            distances[row, :len(best)] = scores[best]
+            ids[row, :len(best)] = found[best]
+        return distances, ids
+
+    def save(self, txn):
+        """Writes the store into a snapshot transaction."""
+        if self._pending:
+            path = txn.append(VECTORS_FILE)
+            with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+                # Drop anything a failed transaction left past the last
+                # committed row
+                f.seek(self._committed_rows * self.dimension * 4)
+                f.truncate()
+                for vectors in self._pending:
+                    f.write(vectors.tobytes())
+            self._committed_rows += self._pending_rows
+            self._pending, self._pending_rows = [], 0
+            self._data = _map_vectors(path, self.dimension, self._committed_rows)
+        with open(txn.replace(META_FILE), "w") as f:
+            json.dump({"dimension": self.dimension, "rows": self._committed_rows}, f)
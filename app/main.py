@@ -1,5 +1,14 @@
-from fastapi import FastAPI
-from .api.v1 import router
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
+from .api.v1 import health, router
+from .api.v1.chunking import chunker
+from .api.v1.downloads import downloader
+from .api.v1.extraction import pdf_engine
+from .api.v1.services import close_clients, embedding_cache, faiss_client
+from .core.config import config
+from .core.metrics import server_timing, start_profile
+from .core.startup import load_lazy_modules, warmup
 import sys
 import os
 
@@ -7,6 +16,37 @@ import os
 project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(project_root)
 
-app = FastAPI(debug=True)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Warm up in the background so the worker answers liveness probes at once
+    warming = asyncio.create_task(warmup.run({
+        "modules": load_lazy_modules,
+        "index": faiss_client.snapshot,
+        "embedding_cache": embedding_cache.open,
+    }))
+    # Also marks jobs left unfinished by a previous run as failed
+    router.ingestion_queue.start()
+    yield
+    warmup.draining = True
+    warming.cancel()
+    # Stop ingestion, then release pooled connections and worker processes
+    await router.ingestion_queue.stop()
+    await downloader.aclose()
+    await close_clients()
+    pdf_engine.shutdown()
+    chunker.shutdown()
 
-app.include_router(router.router)
\ No newline at end of file
+app = FastAPI(debug=True, lifespan=lifespan)
+
+@app.middleware("http")
+async def profile_request(request: Request, call_next):
+    if not config.PROFILE_HEADER or request.headers.get(config.PROFILE_HEADER, "").lower() not in ("1", "true", "yes"):
+        return await call_next(request)
+    profile = start_profile()
+    response = await call_next(request)
+    # Streaming responses only include the stages that ran before the body
+    response.headers["Server-Timing"] = server_timing(profile)
+    return response
+
+app.include_router(router.router)
+app.include_router(health.router)
@@ -0,0 +1,84 @@
+import argparse
+import json
+from typing import Dict, Optional
+
+# Metrics whose name ends with one of these get better as they grow; the
+# rest of the compared metrics get better as they shrink
+HIGHER_IS_BETTER = ("_per_s", "_rps", "recall", "recall_text_pages", "recall_ocr_pages")
+LOWER_IS_BETTER = ("_ms", "_bytes", "errors", "failed_files", "startup_s")
+
+
+def flatten(results: Dict, prefix: str = "") -> Dict[str, float]:
+    values = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            values.update(flatten(value, f"{name}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[name] = float(value)
+    return values
+
+
+def direction(name: str) -> Optional[int]:
+    """1 if the metric should grow, -1 if it should shrink, None if it is not compared."""
+    leaf = name.rsplit(".", 1)[-1]
+    if name.startswith("settings.") or leaf in ("requests", "concurrency", "k", "queries"):
+        return None
+    if leaf.endswith(HIGHER_IS_BETTER):
+        return 1
+    if leaf.endswith(LOWER_IS_BETTER):
+        return -1
+    return None
+
+
+def compare(base: Dict, head: Dict, threshold: float = 0.1) -> Dict:
+    """
+    Metrics of two benchmark results side by side. A metric regressed when
+    it moved the wrong way by more than `threshold` of its base value.
+    """
+    if base.get("settings") != head.get("settings"):
+        different = sorted(
+            key for key in set(base.get("settings", {})) | set(head.get("settings", {}))
+            if base.get("settings", {}).get(key) != head.get("settings", {}).get(key)
+        )
+        print(f"Warning: the runs used different settings: {', '.join(different)}")
+    base_values, head_values = flatten(base), flatten(head)
+    rows = []
+    for name in sorted(set(base_values) & set(head_values)):
+        sign = direction(name)
+        if sign is None:
+            continue
+        old, new = base_values[name], head_values[name]
+        change = (new - old) / abs(old) if old else (0.0 if new == old else float("inf"))
+        rows.append({
+            "metric": name,
+            "base": old,
+            "head": new,
+            "change": change,
+            "regressed": sign * change < -threshold,
+        })
+    return {"base": base.get("commit"), "head": head.get("commit"), "rows": rows}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare two benchmark results")
+    parser.add_argument("base", help="results of the reference commit")
+    parser.add_argument("head", help="results of the commit under test")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative change counted as a regression")
+    parser.add_argument("--all", action="store_true", help="also list metrics within the threshold")
+    args = parser.parse_args()
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.head) as f:
+        head = json.load(f)
+    report = compare(base, head, args.threshold)
+
+    print(f"{(report['base'] or '?')[:12]} -> {(report['head'] or '?')[:12]}")
+    for row in report["rows"]:
+        if args.all or row["regressed"] or abs(row["change"]) > args.threshold:
+            flag = "REGRESSED" if row["regressed"] else ""
+            print(f"{row['metric']:<55} {row['base']:>14.2f} {row['head']:>14.2f} {row['change']:>+8.1%} {flag}")
+    regressions = sum(row["regressed"] for row in report["rows"])
+    print(f"{regressions} regression(s) beyond {args.threshold:.0%}")
+    raise SystemExit(1 if regressions else 0)
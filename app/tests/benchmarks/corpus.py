@@ -0,0 +1,175 @@
+import argparse
+import datetime
+import json
+import os
+import random
+import string
+from typing import Dict, List, Sequence, Tuple
+
+import docx
+import fitz
+import pptx
+from pptx.util import Inches, Pt
+
+# Pages (slides for PPTX) per generated document
+SIZES = {"small": 2, "medium": 20, "large": 100}
+KINDS = ("pdf", "docx", "pptx", "txt")
+PARAGRAPHS_PER_PAGE = 3
+SENTENCES_PER_PARAGRAPH = 5
+
+_syllables = ["ka", "lo", "mi", "ne", "ru", "ta", "ve", "so", "di", "pa", "gu", "be", "zo", "fi", "ha", "ju"]
+_fixed_date = datetime.datetime(2024, 1, 1)
+
+
+def _words(rng: random.Random, count: int, syllables: Sequence[int] = (2, 3)) -> List[str]:
+    words = set()
+    while len(words) < count:
+        words.add("".join(rng.choice(_syllables) for _ in range(rng.choice(syllables))))
+    return sorted(words)
+
+
+class _Writer:
+    """Deterministic filler text with one retrievable fact per page."""
+
+    def __init__(self, seed: int):
+        self.rng = random.Random(seed)
+        self.filler = _words(self.rng, 2000)
+        # Facts share a small vocabulary so queries partly match many of them
+        self.adjectives = _words(self.rng, 40, (3,))
+        self.nouns = _words(self.rng, 40, (4,))
+        self.places = _words(self.rng, 40, (5,))
+        self.codes = set()
+
+    def sentence(self) -> str:
+        words = self.rng.choices(self.filler, k=self.rng.randint(8, 16))
+        return " ".join(words).capitalize() + "."
+
+    def fact(self) -> Dict:
+        code = None
+        while code is None or code in self.codes:
+            code = "".join(self.rng.choices(string.ascii_uppercase, k=2)) + str(self.rng.randint(10000, 99999))
+        self.codes.add(code)
+        adjective, noun, place = (self.rng.choice(words) for words in (self.adjectives, self.nouns, self.places))
+        return {
+            "code": code,
+            "sentence": f"The {adjective} {noun} of {place} is filed under {code}.",
+            "query": f"Under which code is the {adjective} {noun} of {place} filed?",
+        }
+
+    def page(self) -> Tuple[List[str], Dict]:
+        """The paragraphs of a page and the fact hidden in one of them."""
+        fact = self.fact()
+        paragraphs = [[self.sentence() for _ in range(SENTENCES_PER_PARAGRAPH)] for _ in range(PARAGRAPHS_PER_PAGE)]
+        paragraph = self.rng.choice(paragraphs)
+        paragraph.insert(self.rng.randint(0, len(paragraph)), fact["sentence"])
+        return [" ".join(sentences) for sentences in paragraphs], fact
+
+
+def _write_pdf(path: str, pages: List[List[str]], image_pages: Sequence[bool]):
+    document = fitz.open()
+    for paragraphs, as_image in zip(pages, image_pages):
+        text = "\n\n".join(paragraphs)
+        if as_image:
+            # A scan: the page is only a picture of its text
+            scratch = fitz.open()
+            scratch.new_page().insert_textbox(fitz.Rect(50, 50, 545, 792), text, fontsize=10)
+            pixmap = scratch[0].get_pixmap(dpi=150)
+            scratch.close()
+            page = document.new_page()
+            page.insert_image(page.rect, pixmap=pixmap)
+        else:
+            document.new_page().insert_textbox(fitz.Rect(50, 50, 545, 792), text, fontsize=10)
+    document.set_metadata({})
+    document.save(path, garbage=3, deflate=True, no_new_id=True)
+    document.close()
+
+
+def _write_docx(path: str, pages: List[List[str]]):
+    document = docx.Document()
+    for number, paragraphs in enumerate(pages):
+        if number:
+            document.add_page_break()
+        for paragraph in paragraphs:
+            document.add_paragraph(paragraph)
+    document.core_properties.created = document.core_properties.modified = _fixed_date
+    document.save(path)
+
+
+def _write_pptx(path: str, pages: List[List[str]]):
+    presentation = pptx.Presentation()
+    blank = presentation.slide_layouts[6]
+    for paragraphs in pages:
+        slide = presentation.slides.add_slide(blank)
+        frame = slide.shapes.add_textbox(Inches(0.5), Inches(0.5), Inches(9), Inches(6.5)).text_frame
+        frame.word_wrap = True
+        frame.text = "\n".join(paragraphs)
+        for paragraph in frame.paragraphs:
+            paragraph.font.size = Pt(8)
+    presentation.core_properties.created = presentation.core_properties.modified = _fixed_date
+    presentation.save(path)
+
+
+def _write_txt(path: str, pages: List[List[str]]):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n\n".join("\n\n".join(paragraphs) for paragraphs in pages) + "\n")
+
+
+def build_corpus(directory: str, sizes: Sequence[str] = ("small", "medium"), files: int = 2,
+                 kinds: Sequence[str] = KINDS, ocr_ratio: float = 0.1, seed: int = 0) -> List[Dict]:
+    """
+    Writes `files` documents of each kind and size to `directory`, with the
+    same content for the same seed, and returns their manifest.
+
+    Every page holds one fact sentence with a unique code and a question
+    answered by it, the ground truth for recall. About `ocr_ratio` of PDF
+    pages are image-only and need OCR; their facts are flagged `ocr`.
+    """
+    os.makedirs(directory, exist_ok=True)
+    writer = _Writer(seed)
+    manifest = []
+    for size in sizes:
+        for kind in kinds:
+            for number in range(files):
+                name = f"{size}-{number}.{kind}"
+                content = [writer.page() for _ in range(SIZES[size])]
+                pages = [paragraphs for paragraphs, _ in content]
+                image_pages = [kind == "pdf" and writer.rng.random() < ocr_ratio for _ in pages]
+                path = os.path.join(directory, name)
+                if kind == "pdf":
+                    _write_pdf(path, pages, image_pages)
+                elif kind == "docx":
+                    _write_docx(path, pages)
+                elif kind == "pptx":
+                    _write_pptx(path, pages)
+                else:
+                    _write_txt(path, pages)
+                manifest.append({
+                    "file_id": name,
+                    "name": name,
+                    "kind": kind,
+                    "size": size,
+                    "pages": len(pages),
+                    "ocr_pages": sum(image_pages),
+                    "bytes": os.path.getsize(path),
+                    "facts": [
+                        {"code": fact["code"], "query": fact["query"], "ocr": as_image}
+                        for (_, fact), as_image in zip(content, image_pages)
+                    ],
+                })
+    with open(os.path.join(directory, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate the benchmark corpus")
+    parser.add_argument("directory")
+    parser.add_argument("--sizes", nargs="+", default=["small", "medium"], choices=list(SIZES))
+    parser.add_argument("--files", type=int, default=2, help="documents of each kind and size")
+    parser.add_argument("--kinds", nargs="+", default=list(KINDS), choices=KINDS)
+    parser.add_argument("--ocr-ratio", type=float, default=0.1, help="share of PDF pages that are image-only")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    manifest = build_corpus(args.directory, args.sizes, args.files, args.kinds, args.ocr_ratio, args.seed)
+    print(f"Wrote {len(manifest)} files, {sum(entry['pages'] for entry in manifest)} pages to {args.directory}")
@@ -0,0 +1,235 @@
+import argparse
+import base64
+import functools
+import hashlib
+import json
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+_word = re.compile(r"\w+")
+_sentence = re.compile(r"(?<=[.!?])\s+|\n+")
+# Each word is hashed into this many signed coordinates of the embedding
+HASHES_PER_WORD = 8
+
+
+@functools.lru_cache(maxsize=200000)
+def _word_features(word: str, dimensions: int):
+    digest = hashlib.blake2b(word.encode("utf-8"), digest_size=4 * HASHES_PER_WORD).digest()
+    values = np.frombuffer(digest, dtype=np.uint32)
+    return (values % dimensions).astype(np.int64), np.where(values & (1 << 31), 1.0, -1.0).astype(np.float32)
+
+
+def embed(text: str, dimensions: int) -> np.ndarray:
+    """
+    A deterministic unit vector for `text`: the feature-hashed bag of its
+    words, so texts sharing words are close, like real embeddings.
+    """
+    vector = np.zeros(dimensions, dtype=np.float32)
+    words = _word.findall(text.lower()) or [text]
+    for word in words:
+        positions, signs = _word_features(word, dimensions)
+        np.add.at(vector, positions, signs)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def count_tokens(text: str) -> int:
+    return len(_word.findall(text))
+
+
+def answer(question: str, text: str) -> str:
+    """Quotes the sentence of `text` sharing the most words with `question`."""
+    wanted = set(_word.findall(question.lower()))
+    sentences = [sentence.strip() for sentence in _sentence.split(text) if sentence.strip()]
+    if not sentences:
+        return "The text does not answer the question."
+    best = max(sentences, key=lambda sentence: len(wanted & set(_word.findall(sentence.lower()))))
+    return f"According to the text, ***{best}***"
+
+
+def _split_prompt(messages: List[Dict]) -> Tuple[str, str]:
+    content = next((m["content"] for m in reversed(messages) if m.get("role") == "user"), "") or ""
+    question, _, text = content.partition("\nTEXT: ")
+    return question.replace("QUESTION: ", "", 1), text
+
+
+class FakeOpenAI:
+    """
+    A local stand-in for the OpenAI embeddings and chat completions APIs.
+
+    Embeddings are hashed bags of words and answers quote the best matching
+    sentence of the prompt's text, so runs are reproducible and retrieval
+    quality can be measured. `latency` is added before each chat answer (its
+    first token when streaming), `token_latency` between answer tokens and
+    `embedding_latency` to each embeddings request.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, dimensions: int = 1536,
+                 latency: float = 0.0, token_latency: float = 0.0, embedding_latency: float = 0.0):
+        self.dimensions = dimensions
+        self.latency = latency
+        self.token_latency = token_latency
+        self.embedding_latency = embedding_latency
+        self.stats = {"embedding_requests": 0, "embedded_texts": 0, "chat_requests": 0, "streamed_requests": 0}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.fake = self
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "FakeOpenAI":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _count(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                self.stats[name] += value
+
+    def embeddings(self, body: Dict) -> Dict:
+        texts = body["input"]
+        if isinstance(texts, str):
+            texts = [texts]
+        dimensions = body.get("dimensions") or self.dimensions
+        time.sleep(self.embedding_latency)
+        self._count(embedding_requests=1, embedded_texts=len(texts))
+        data = []
+        for i, text in enumerate(texts):
+            vector = embed(text, dimensions)
+            if body.get("encoding_format") == "base64":
+                encoded = base64.b64encode(vector.astype("<f4").tobytes()).decode("ascii")
+            else:
+                encoded = vector.tolist()
+            data.append({"object": "embedding", "index": i, "embedding": encoded})
+        tokens = sum(count_tokens(text) for text in texts)
+        return {
+            "object": "list",
+            "data": data,
+            "model": body.get("model"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        }
+
+    def chat(self, body: Dict):
+        """The completion, or a generator of stream chunks when `stream` is set."""
+        question, text = _split_prompt(body.get("messages", []))
+        content = answer(question, text)
+        usage = {
+            "prompt_tokens": sum(count_tokens(m.get("content") or "") for m in body.get("messages", [])),
+            "completion_tokens": count_tokens(content),
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        base = {"id": completion_id, "created": int(time.time()), "model": body.get("model")}
+
+        if not body.get("stream"):
+            self._count(chat_requests=1)
+            time.sleep(self.latency + self.token_latency * usage["completion_tokens"])
+            return {
+                **base,
+                "object": "chat.completion",
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage,
+            }
+
+        self._count(chat_requests=1, streamed_requests=1)
+        include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+
+        def chunks():
+            time.sleep(self.latency)
+            pieces = re.findall(r"\S+\s*", content)
+            for i, piece in enumerate(pieces):
+                if i:
+                    time.sleep(self.token_latency)
+                delta = {"content": piece, **({"role": "assistant"} if not i else {})}
+                yield {**base, "object": "chat.completion.chunk",
+                       "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+            yield {**base, "object": "chat.completion.chunk",
+                   "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+            if include_usage:
+                yield {**base, "object": "chat.completion.chunk", "choices": [], "usage": usage}
+
+        return chunks()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, payload: Dict):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/stats":
+            self._send_json(200, dict(self.server.fake.stats))
+        else:
+            self._send_json(404, {"error": {"message": "Not found"}})
+
+    def do_POST(self):
+        fake: FakeOpenAI = self.server.fake
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.path.endswith("/embeddings"):
+            self._send_json(200, fake.embeddings(body))
+        elif self.path.endswith("/chat/completions"):
+            result = fake.chat(body)
+            if isinstance(result, dict):
+                self._send_json(200, result)
+                return
+            # The stream ends when the connection closes
+            self.close_connection = True
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            for chunk in result:
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+            self.wfile.write(b"data: [DONE]\n\n")
+        else:
+            self._send_json(404, {"error": {"message": f"Unknown endpoint {self.path}"}})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the OpenAI embeddings and chat APIs")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before each answer")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="seconds per answer token")
+    parser.add_argument("--embedding-latency", type=float, default=0.0, help="seconds per embeddings request")
+    args = parser.parse_args()
+
+    fake = FakeOpenAI(args.host, args.port, args.dimensions, args.latency, args.token_latency,
+                      args.embedding_latency)
+    fake.start()
+    print(f"Serving on {fake.url}, set OPENAI_BASE_URL to it")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        fake.stop()
@@ -0,0 +1,488 @@
+import argparse
+import asyncio
+import functools
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import httpx
+import numpy as np
+
+from app.tests.benchmarks.corpus import KINDS, SIZES, build_corpus
+from app.tests.benchmarks.fake_openai import FakeOpenAI
+
+# Bumped whenever the layout of the results changes
+SCHEMA_VERSION = 1
+USER_ID = "benchmark"
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+_sample = re.compile(r"^([a-zA-Z_:][\w:]*)(\{[^}]*\})?\s+(\S+)$")
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _git(*args: str) -> Optional[str]:
+    try:
+        return subprocess.run(["git", *args], cwd=REPO_ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _rss(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def _children(pid: int) -> List[int]:
+    children = []
+    for task in os.listdir(f"/proc/{pid}/task"):
+        with open(f"/proc/{pid}/task/{task}/children") as f:
+            children.extend(int(child) for child in f.read().split())
+    return children + [grandchild for child in children for grandchild in _children(child)]
+
+
+def memory(pid: int) -> Dict[str, Optional[int]]:
+    """Resident memory of the server and of its worker processes, None off Linux."""
+    try:
+        workers = 0
+        for child in _children(pid):
+            try:
+                workers += _rss(child)
+            except OSError:
+                pass
+        return {"server_rss_bytes": _rss(pid), "workers_rss_bytes": workers}
+    except OSError:
+        return {"server_rss_bytes": None, "workers_rss_bytes": None}
+
+
+def disk_usage(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def parse_metrics(text: str) -> Dict[str, float]:
+    """Prometheus text samples keyed by name and labels."""
+    samples = {}
+    for line in text.splitlines():
+        match = _sample.match(line)
+        if match:
+            samples[match.group(1) + (match.group(2) or "")] = float(match.group(3))
+    return samples
+
+
+def metric_delta(before: Dict[str, float], after: Dict[str, float], prefix: str) -> float:
+    return sum(value - before.get(key, 0.0) for key, value in after.items() if key.startswith(prefix))
+
+
+def latency_summary(latencies: List[float], errors: int, elapsed: float, concurrency: int) -> Dict:
+    ms = np.array(latencies) * 1000 if latencies else np.zeros(1)
+    return {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "concurrency": concurrency,
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "mean_ms": round(float(ms.mean()), 2),
+        "p50_ms": round(float(np.percentile(ms, 50)), 2),
+        "p90_ms": round(float(np.percentile(ms, 90)), 2),
+        "p99_ms": round(float(np.percentile(ms, 99)), 2),
+        "max_ms": round(float(ms.max()), 2),
+    }
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_directory(directory: str) -> ThreadingHTTPServer:
+    """Serves the corpus over HTTP, with Last-Modified so re-uploads can be skipped."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(_QuietHandler, directory=directory))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class AppServer:
+    """The app under test, run by uvicorn in its own process."""
+
+    def __init__(self, env: Dict[str, str], log_path: str, workers: int = 1):
+        self.port = _free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.env = env
+        self.log_path = log_path
+        self.workers = workers
+        self.process: Optional[subprocess.Popen] = None
+
+    def start(self, timeout: float = 180.0) -> float:
+        """Starts the server and returns the seconds until it reported ready."""
+        began = time.perf_counter()
+        with open(self.log_path, "ab") as log:
+            self.process = subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1",
+                 "--port", str(self.port), "--workers", str(self.workers), "--log-level", "warning"],
+                cwd=REPO_ROOT, env=self.env, stdout=log, stderr=subprocess.STDOUT,
+            )
+        while time.perf_counter() - began < timeout:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"The app exited during startup, see {self.log_path}")
+            try:
+                if httpx.get(f"{self.url}/health/ready", timeout=1.0).status_code == 200:
+                    return time.perf_counter() - began
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.1)
+        raise RuntimeError(f"The app was not ready after {timeout}s, see {self.log_path}")
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(30)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+
+async def run_load(call: Callable[[int], Awaitable[Optional[float]]], requests: int,
+                   concurrency: int) -> Dict:
+    """
+    Runs `call(i)` for i in range(`requests`) with `concurrency` in flight.
+    A call may return the seconds until its first token, summarised as `ttft`.
+    """
+    latencies: List[float] = []
+    first_tokens: List[float] = []
+    errors = 0
+    next_request = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for i in next_request:
+            began = time.perf_counter()
+            try:
+                first_token = await call(i)
+            except (httpx.HTTPError, ValueError):
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - began)
+            if first_token is not None:
+                first_tokens.append(first_token)
+
+    began = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    summary = latency_summary(latencies, errors, time.perf_counter() - began, concurrency)
+    if first_tokens:
+        summary["ttft"] = latency_summary(first_tokens, 0, time.perf_counter() - began, concurrency)
+    return summary
+
+
+class Benchmark:
+    def __init__(self, args: argparse.Namespace, app: AppServer, manifest: List[Dict],
+                 files_url: str, index_dir: str):
+        self.args = args
+        self.app = app
+        self.manifest = manifest
+        self.files_url = files_url
+        self.index_dir = index_dir
+        facts = [fact for entry in manifest for fact in entry["facts"]]
+        random.Random(args.seed).shuffle(facts)
+        self.facts = facts
+        self.queries = [fact["query"] for fact in facts]
+        self.client: Optional[httpx.AsyncClient] = None
+
+    async def metrics(self) -> Dict[str, float]:
+        response = await self.client.get("/metrics")
+        response.raise_for_status()
+        return parse_metrics(response.text)
+
+    async def upload(self, entries: List[Dict]) -> Dict:
+        files = [{"file_id": entry["file_id"], "file_url": f"{self.files_url}/{entry['name']}"} for entry in entries]
+        before = await self.metrics()
+        began = time.perf_counter()
+        response = await self.client.post("/uploadfiles/", json={
+            "user_id": USER_ID, "files": files, "chunk_size": self.args.chunk_size,
+        })
+        elapsed = time.perf_counter() - began
+        response.raise_for_status()
+        after = await self.metrics()
+
+        results = {result["file_id"]: result for result in response.json()}
+        ok = [entry for entry in entries if "error" not in results[entry["file_id"]]]
+        pages = sum(entry["pages"] for entry in ok)
+        chunks = metric_delta(before, after, "rag_chunks_total")
+        return {
+            "files": len(entries),
+            "failed_files": len(entries) - len(ok),
+            "failed_by_kind": {
+                kind: sum(entry["kind"] == kind for entry in entries if entry not in ok)
+                for kind in sorted({entry["kind"] for entry in entries})
+            },
+            "errors": sorted({results[e["file_id"]]["error"] for e in entries if e not in ok}),
+            "unchanged_files": sum(results[e["file_id"]].get("message") == "Unchanged" for e in ok),
+            "bytes": sum(entry["bytes"] for entry in entries),
+            "pages": pages,
+            "ocr_pages": metric_delta(before, after, 'rag_pages_total{method="ocr"}'),
+            "chunks": chunks,
+            "seconds": round(elapsed, 3),
+            "files_per_s": round(len(ok) / elapsed, 3),
+            "pages_per_s": round(pages / elapsed, 3),
+            "chunks_per_s": round(chunks / elapsed, 3),
+            "mb_per_s": round(sum(entry["bytes"] for entry in ok) / elapsed / 1e6, 3),
+        }
+
+    async def ingestion(self) -> Dict:
+        results = {}
+        for size in self.args.sizes:
+            entries = [entry for entry in self.manifest if entry["size"] == size]
+            results[size] = await self.upload(entries)
+        # The same files again: nothing changed, so nothing is re-embedded
+        results["reupload"] = await self.upload(self.manifest)
+        return results
+
+    async def recall(self) -> Dict:
+        """Share of fact questions whose top `k` chunks contain the fact's code, per search mode."""
+        facts = self.facts[:self.args.recall_queries]
+        results = {}
+        for mode in ("hybrid", "vector", "lexical"):
+            hits = {"text": [], "ocr": []}
+
+            async def search(fact: Dict):
+                response = await self.client.post("/getchunks/", json={
+                    "text": fact["query"], "user_id": USER_ID, "limit": self.args.k, "mode": mode,
+                })
+                chunks = response.json().get("chunks", []) if response.status_code == 200 else []
+                found = any(fact["code"] in " ".join(chunk.split()) for chunk in chunks)
+                hits["ocr" if fact["ocr"] else "text"].append(found)
+
+            slots = asyncio.Semaphore(self.args.concurrency)
+
+            async def limited(fact: Dict):
+                async with slots:
+                    await search(fact)
+
+            await asyncio.gather(*(limited(fact) for fact in facts))
+            results[mode] = {
+                "k": self.args.k,
+                "queries": len(facts),
+                "recall": round(float(np.mean(hits["text"] + hits["ocr"])), 4) if facts else None,
+                "recall_text_pages": round(float(np.mean(hits["text"])), 4) if hits["text"] else None,
+                "recall_ocr_pages": round(float(np.mean(hits["ocr"])), 4) if hits["ocr"] else None,
+            }
+        return results
+
+    def _query(self, i: int) -> str:
+        return self.queries[i % len(self.queries)]
+
+    async def _post(self, path: str, payload: Dict) -> None:
+        response = await self.client.post(path, json=payload)
+        response.raise_for_status()
+
+    async def _stream(self, i: int) -> float:
+        began = time.perf_counter()
+        first_token = None
+        async with self.client.stream("POST", "/getresponse/stream/", json={
+            "query_text": self._query(i), "user_id": USER_ID,
+        }) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if first_token is None and line == "event: token":
+                    first_token = time.perf_counter() - began
+                elif line == "event: error":
+                    raise ValueError("The stream ended with an error event")
+        return first_token
+
+    async def _batch(self, i: int) -> None:
+        size = self.args.batch_size
+        queries = [self._query(i * size + j) for j in range(size)]
+        async with self.client.stream("POST", "/getresponse/batch/", json={
+            "queries": queries, "user_id": USER_ID,
+        }) as response:
+            response.raise_for_status()
+            async for _ in response.aiter_lines():
+                pass
+
+    async def queries_under_load(self) -> Dict:
+        requests, concurrency = self.args.requests, self.args.concurrency
+        endpoints = {
+            f"getchunks_{mode}": lambda i, mode=mode: self._post("/getchunks/", {
+                "text": self._query(i), "user_id": USER_ID, "mode": mode,
+            })
+            for mode in ("hybrid", "vector", "lexical")
+        }
+        endpoints["getresponse"] = lambda i: self._post("/getresponse/", {
+            "query_text": self._query(i), "user_id": USER_ID,
+        })
+        endpoints["getresponse_stream"] = self._stream
+
+        results = {}
+        for name, call in endpoints.items():
+            results[name] = await run_load(call, requests, concurrency)
+        batches = max(1, requests // self.args.batch_size)
+        results["getresponse_batch"] = await run_load(self._batch, batches, max(1, concurrency // 4))
+        results["getresponse_batch"]["queries_per_batch"] = self.args.batch_size
+        return results
+
+    async def run(self) -> Dict:
+        async with httpx.AsyncClient(base_url=self.app.url, timeout=self.args.timeout) as self.client:
+            memory_before = memory(self.app.process.pid)
+            ingestion = await self.ingestion()
+            # Let freed buffers settle before reading the server's footprint
+            await asyncio.sleep(1.0)
+            memory_after = memory(self.app.process.pid)
+            after = await self.metrics()
+            index = {
+                "chunks": after.get("rag_index_chunks"),
+                "disk_bytes": disk_usage(self.index_dir),
+                **{f"{key}_before": value for key, value in memory_before.items()},
+                **memory_after,
+            }
+            if memory_before["server_rss_bytes"] is not None:
+                index["server_rss_growth_bytes"] = memory_after["server_rss_bytes"] - memory_before["server_rss_bytes"]
+            recall = await self.recall()
+            queries = await self.queries_under_load()
+            index["server_rss_after_queries_bytes"] = memory(self.app.process.pid)["server_rss_bytes"]
+        return {"ingestion": ingestion, "index": index, "recall": recall, "queries": queries}
+
+
+def main(args: argparse.Namespace) -> Dict:
+    workdir = args.workdir or tempfile.mkdtemp(prefix="rag-benchmark-")
+    corpus_dir = os.path.join(workdir, "corpus")
+    data_dir = os.path.join(workdir, "data")
+    shutil.rmtree(data_dir, ignore_errors=True)
+    os.makedirs(data_dir)
+
+    began = time.perf_counter()
+    manifest = build_corpus(corpus_dir, args.sizes, args.files, args.kinds, args.ocr_ratio, args.seed)
+    corpus_s = time.perf_counter() - began
+
+    fake = FakeOpenAI(dimensions=args.dimensions, latency=args.latency, token_latency=args.token_latency,
+                      embedding_latency=args.embedding_latency).start()
+    files = serve_directory(corpus_dir)
+    index_dir = os.path.join(data_dir, "index")
+    env = {
+        **os.environ,
+        "ENV": os.environ.get("ENV", "development"),
+        "OPENAI_API_KEY": "benchmark",
+        "OPENAI_BASE_URL": fake.url,
+        "INDEX_DIR": index_dir,
+        "EMBEDDING_CACHE_PATH": os.path.join(data_dir, "embedding_cache.sqlite3"),
+        "JOB_STORE_PATH": os.path.join(data_dir, "jobs.sqlite3"),
+    }
+    if args.vector_storage:
+        env["VECTOR_STORAGE"] = args.vector_storage
+    if args.embedding_dimensions:
+        env["EMBEDDING_DIMENSIONS"] = str(args.embedding_dimensions)
+    if not args.answer_cache:
+        # Every answer goes to the (fake) model, as with distinct questions
+        env["ANSWER_CACHE_TTL"] = "0"
+    app = AppServer(env, os.path.join(workdir, "server.log"), args.workers)
+    try:
+        startup_s = app.start()
+        host, port = files.server_address[:2]
+        measured = asyncio.run(Benchmark(args, app, manifest, f"http://{host}:{port}", index_dir).run())
+    finally:
+        app.stop()
+        files.shutdown()
+        fake.stop()
+        if not args.workdir and not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    commit = _git("rev-parse", "HEAD")
+    return {
+        "schema": SCHEMA_VERSION,
+        "commit": commit,
+        "dirty": bool(_git("status", "--porcelain", "--untracked-files=no")) if commit else None,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "machine": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "settings": {key: value for key, value in vars(args).items() if key not in ("output", "workdir", "keep")},
+        "corpus": {
+            "files": len(manifest),
+            "pages": sum(entry["pages"] for entry in manifest),
+            "ocr_pages": sum(entry["ocr_pages"] for entry in manifest),
+            "bytes": sum(entry["bytes"] for entry in manifest),
+            "generate_s": round(corpus_s, 3),
+        },
+        "startup_s": round(startup_s, 3),
+        **measured,
+        "openai_calls": dict(fake.stats),
+    }
+
+
+def parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Benchmark ingestion, queries, index memory and recall against a local OpenAI stand-in"
+    )
+    parser.add_argument("--sizes", nargs="+", default=["small", "medium"], choices=list(SIZES))
+    parser.add_argument("--kinds", nargs="+", default=list(KINDS), choices=KINDS)
+    parser.add_argument("--files", type=int, default=2, help="documents of each kind and size")
+    parser.add_argument("--ocr-ratio", type=float, default=0.1, help="share of PDF pages that are image-only")
+    parser.add_argument("--chunk-size", type=int, default=128)
+    parser.add_argument("--requests", type=int, default=200, help="requests per query endpoint")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--batch-size", type=int, default=32, help="queries per /getresponse/batch/ request")
+    parser.add_argument("--recall-queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=5, help="chunks retrieved per recall query")
+    parser.add_argument("--dimensions", type=int, default=1536, help="embedding size of the stand-in")
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds before each answer")
+    parser.add_argument("--token-latency", type=float, default=0.005, help="seconds per answer token")
+    parser.add_argument("--embedding-latency", type=float, default=0.05, help="seconds per embeddings request")
+    parser.add_argument("--vector-storage", choices=("float32", "float16", "sq8"),
+                        help="VECTOR_STORAGE of the app, its configured value by default")
+    parser.add_argument("--embedding-dimensions", type=int, help="EMBEDDING_DIMENSIONS of the app")
+    parser.add_argument("--answer-cache", action="store_true", help="leave the answer cache on")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers")
+    parser.add_argument("--timeout", type=float, default=600.0, help="seconds per request")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", help="keep the corpus, index and server log here")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary working directory")
+    parser.add_argument("--output", help="results file, defaults to data/benchmarks/<commit>.json")
+    return parser
+
+
+if __name__ == "__main__":
+    args = parser().parse_args()
+    results = main(args)
+    output = args.output
+    if output is None:
+        name = (results["commit"] or "unknown")[:12] + ("-dirty" if results["dirty"] else "")
+        output = os.path.join(REPO_ROOT, "data", "benchmarks", f"{name}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    for size, result in results["ingestion"].items():
+        print(f"ingest {size:>8}: {result['files_per_s']:8.2f} files/s {result['pages_per_s']:8.2f} pages/s "
+              f"{result['chunks_per_s']:9.2f} chunks/s, {result['failed_files']} failed")
+    for name, result in results["queries"].items():
+        print(f"{name:>20}: p50 {result['p50_ms']:8.1f} ms  p99 {result['p99_ms']:8.1f} ms  "
+              f"{result['throughput_rps']:7.1f} req/s, {result['errors']} errors")
+    for mode, result in results["recall"].items():
+        print(f"recall@{result['k']} {mode:>8}: {result['recall']}")
+    print(f"Results written to {output}")
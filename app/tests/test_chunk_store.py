@@ -0,0 +1,77 @@
+import pytest
+
+from app.db.chunk_store import ChunkStore
+from app.db.storage import SnapshotStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return SnapshotStore(str(tmp_path), keep=2)
+
+
+def load_chunks(store, **kwargs):
+    version = store.current_version()
+    return ChunkStore.load(lambda name: store.path(version, name), **kwargs)
+
+
+def test_chunk_store_round_trip(store):
+    chunks = ChunkStore.empty()
+    first = chunks.append(["héllo", "wörld"], "u1", "f1", spans=[(0, 5), (6, 11)], pages=[0, 1])
+    second = chunks.append(["other"], "u2", "f1")
+    assert first.tolist() == [0, 1] and second.tolist() == [2]
+    with store.transaction() as txn:
+        chunks.save(txn)
+
+    loaded = load_chunks(store)
+    assert len(loaded) == 3
+    assert loaded.texts([2, 0]) == ["other", "héllo"]
+    assert loaded.metadata([1, 2]) == [
+        {"user_id": "u1", "file_id": "f1", "chunk_no": 1, "page": 1, "char_start": 6, "char_end": 11},
+        {"user_id": "u2", "file_id": "f1", "chunk_no": 0, "page": -1, "char_start": -1, "char_end": -1},
+    ]
+    assert loaded.file_chunk_ids("u1", "f1").tolist() == [0, 1]
+    assert loaded.user_chunk_ids("u2").tolist() == [2]
+    assert loaded.file_chunk_ids("u3", "f1").tolist() == []
+
+
+def test_chunk_store_appends_across_snapshots(store):
+    chunks = ChunkStore.empty()
+    chunks.append(["one", "two"], "u1", "f1")
+    with store.transaction() as txn:
+        chunks.save(txn)
+    old = load_chunks(store)
+
+    chunks = load_chunks(store, mmap=False)
+    chunks.append(["three"], "u1", "f2")
+    chunks.delete([0])
+    chunks.place([1], spans=[(0, 3)], pages=[4])
+    with store.transaction() as txn:
+        chunks.save(txn)
+
+    loaded = load_chunks(store)
+    assert loaded.texts([0, 1, 2]) == ["one", "two", "three"]
+    assert loaded.file_chunk_ids("u1", "f1").tolist() == [1]
+    assert loaded.metadata([1])[0]["chunk_no"] == 0
+    assert loaded.metadata([1])[0]["page"] == 4
+    # The older snapshot still reads its own chunks
+    assert len(old) == 2
+    assert old.file_chunk_ids("u1", "f1").tolist() == [0, 1]
+
+
+def test_chunk_store_drops_bytes_of_a_failed_transaction(store):
+    chunks = ChunkStore.empty()
+    chunks.append(["kept"], "u1", "f1")
+    with store.transaction() as txn:
+        chunks.save(txn)
+
+    failed = load_chunks(store, mmap=False)
+    failed.append(["lost"], "u1", "f1")
+    with pytest.raises(RuntimeError):
+        with store.transaction() as txn:
+            failed.save(txn)
+            raise RuntimeError
+    chunks = load_chunks(store, mmap=False)
+    chunks.append(["next"], "u1", "f1")
+    with store.transaction() as txn:
+        chunks.save(txn)
+    assert load_chunks(store).texts([0, 1]) == ["kept", "next"]
@@ -0,0 +1,56 @@
+import pytest
+
+from app.api.v1.chunking import chunk_text, count_tokens, iter_chunks
+
+TEXT = (
+    "The first sentence is short. The second one, with a comma, is longer!\n\n"
+    "A new paragraph starts here? It does.  Spaces   inside   are kept.\n"
+    "Last words"
+)
+
+
+def test_spans_index_the_source_text():
+    for chunk_size in (1, 4, 8, 16, 1000):
+        for chunk in iter_chunks(TEXT, chunk_size=chunk_size, overlap=2):
+            assert TEXT[chunk.start:chunk.end] == chunk.text
+            assert chunk.text == chunk.text.strip()
+
+
+def test_chunks_respect_the_size():
+    for chunk_size in (3, 8, 16):
+        chunks = chunk_text(TEXT, chunk_size=chunk_size, overlap=0)
+        assert all(count_tokens(chunk.text) <= chunk_size for chunk in chunks)
+
+
+def test_chunks_cover_every_token_in_order():
+    chunks = chunk_text(TEXT, chunk_size=8, overlap=0)
+    assert [chunk.start for chunk in chunks] == sorted(chunk.start for chunk in chunks)
+    assert sum(count_tokens(chunk.text) for chunk in chunks) == count_tokens(TEXT)
+
+
+def test_sentences_are_kept_whole_where_they_fit():
+    chunks = chunk_text(TEXT, chunk_size=16, overlap=0)
+    assert chunks[0].text == "The first sentence is short."
+    assert "The second one, with a comma, is longer!" in [chunk.text for chunk in chunks]
+
+
+def test_overlap_repeats_trailing_sentences():
+    text = "One two three. Four five six. Seven eight nine. Ten eleven twelve."
+    chunks = chunk_text(text, chunk_size=8, overlap=4)
+    assert [chunk.text for chunk in chunks] == [
+        "One two three. Four five six.",
+        "Four five six. Seven eight nine.",
+        "Seven eight nine. Ten eleven twelve.",
+    ]
+
+
+def test_long_sentence_is_cut_at_tokens():
+    text = " ".join(f"w{i}" for i in range(10)) + "."
+    chunks = chunk_text(text, chunk_size=4, overlap=1)
+    assert [chunk.text for chunk in chunks] == ["w0 w1 w2 w3", "w3 w4 w5 w6", "w6 w7 w8 w9", "w9."]
+
+
+def test_empty_text_and_bad_size():
+    assert chunk_text("   \n\n  ") == []
+    with pytest.raises(ValueError):
+        chunk_text(TEXT, chunk_size=0)
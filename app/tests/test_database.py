@@ -0,0 +1,97 @@
+import shutil
+
+import faiss
+import numpy as np
+import pytest
+
+from app.core.config import config
+from app.db import crud
+from app.db.database import FaissSingleton, lexical_file
+from app.db.indexes import build_index
+from app.db.storage import SnapshotGone
+
+
+@pytest.fixture
+def index(tmp_path, monkeypatch):
+    monkeypatch.setattr(FaissSingleton, "_instance", None)
+    return FaissSingleton(dimension=4, root=str(tmp_path))
+
+
+def upload(index, user_id, file_id, texts):
+    rng = np.random.default_rng(len(texts))
+    vectors = {text: rng.random(4, dtype=np.float32) for text in texts}
+    return index.sync_file(user_id, file_id, texts, vectors), vectors
+
+
+def test_held_snapshot_survives_pruning(index):
+    _, vectors = upload(index, "u1", "f1", ["alpha one", "beta two"])
+    held = index.snapshot()
+    for i in range(index.store.keep + 2):
+        upload(index, "u2", f"f{i}", [f"gamma {i}"])
+
+    # The shard is only opened now, after its snapshot was superseded
+    found = crud.search_vector(held, vectors["beta two"], "u1", top_k=1)
+    assert crud.get_chunk_texts(held, found) == ["beta two"]
+    index.store.view(held.version).close()
+
+    version = held.version
+    del held, found
+    index.snapshot()  # drops the cached snapshot's lease as well
+    upload(index, "u2", "last", ["delta"])
+    with pytest.raises(SnapshotGone):
+        index.store.view(version)
+
+
+def test_hnsw_deletes_are_filtered_then_compacted(index, monkeypatch):
+    monkeypatch.setattr(
+        FaissSingleton, "_new_shard",
+        lambda self, training_vectors=None: faiss.IndexIDMap2(build_index("hnsw", self.dimension)),
+    )
+    monkeypatch.setattr(config, "INDEX_COMPACT_RATIO", 1.0)
+    _, vectors = upload(index, "u1", "f1", ["alpha one", "beta two"])
+    upload(index, "u1", "f2", ["gamma three"])
+    index.delete("u1", "f1")
+
+    # Below the ratio: the shard keeps the ids, searches skip them
+    snapshot = index.snapshot()
+    assert snapshot.shard("u1").ntotal == 3
+    found = crud.search_vector(snapshot, vectors["beta two"], "u1", top_k=3)
+    assert crud.get_chunk_texts(snapshot, found[0][found[0] != -1]) == ["gamma three"]
+
+    assert index.compact("u1")
+    snapshot = index.snapshot()
+    assert snapshot.shard("u1").ntotal == 1
+    assert snapshot.deleted("u1") is None
+
+
+def test_compaction_runs_in_the_background(index, monkeypatch):
+    monkeypatch.setattr(
+        FaissSingleton, "_new_shard",
+        lambda self, training_vectors=None: faiss.IndexIDMap2(build_index("hnsw", self.dimension)),
+    )
+    upload(index, "u1", "f1", ["alpha one", "beta two"])
+    upload(index, "u1", "f2", ["gamma three"])
+    index.delete("u1", "f1")
+    index._compactor.shutdown(wait=True)
+    assert index.snapshot().shard("u1").ntotal == 1
+
+
+def test_missing_lexical_index_is_not_cached(index):
+    upload(index, "u1", "f1", ["alpha one"])
+    snapshot = index.snapshot()
+    shutil.rmtree(index.store.path(snapshot.version, lexical_file("u1", "")))
+    for _ in range(2):
+        with pytest.raises(SnapshotGone):
+            snapshot.lexical("u1")
+
+
+def test_span_page_comes_from_the_page_offsets(index):
+    index.sync_file(
+        "u1", "f1", ["x" * 200], {"x" * 200: np.ones(4, dtype=np.float32)},
+        spans=[(1800, 2000)], pages=[0], document={"page_starts": [0, 1900, 3800]},
+    )
+    snapshot = index.snapshot()
+    chunk_id = snapshot.chunks.file_chunk_ids("u1", "f1")[0]
+    # The chunk starts on page 0, the span after the page break
+    assert crud.locate_span(snapshot, chunk_id, 99, chunk_id, 110)["page"] == 0
+    assert crud.locate_span(snapshot, chunk_id, 100, chunk_id, 110)["page"] == 1
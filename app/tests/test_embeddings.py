@@ -0,0 +1,49 @@
+import asyncio
+
+import httpx
+import numpy as np
+import openai
+import pytest
+
+from app.api.v1.embeddings import EmbeddingScheduler
+
+
+def api_error(error_type, status):
+    request = httpx.Request("POST", "https://api.openai.com/v1/embeddings")
+    return error_type("rejected", response=httpx.Response(status, request=request), body=None)
+
+
+def embed_all(embed_batch, texts):
+    async def run():
+        scheduler = EmbeddingScheduler(embed_batch, window=0.01, max_retries=0)
+        return await asyncio.gather(
+            *(scheduler.embed([text], "model") for text in texts), return_exceptions=True
+        )
+    return asyncio.run(run())
+
+
+def test_bad_input_fails_only_its_caller():
+    calls = []
+
+    async def embed_batch(texts, model):
+        calls.append(texts)
+        if "bad" in texts:
+            raise api_error(openai.BadRequestError, 400)
+        return [np.full(2, len(text), dtype=np.float32) for text in texts]
+
+    results = embed_all(embed_batch, ["one", "bad", "three", "four"])
+    assert isinstance(results[1], openai.BadRequestError)
+    assert [result[0][0] for i, result in enumerate(results) if i != 1] == [3, 5, 4]
+    assert len(calls) == 5
+
+
+def test_other_errors_fail_the_batch_at_once():
+    calls = []
+
+    async def embed_batch(texts, model):
+        calls.append(texts)
+        raise api_error(openai.AuthenticationError, 401)
+
+    results = embed_all(embed_batch, ["one", "two", "three", "four"])
+    assert all(isinstance(result, openai.AuthenticationError) for result in results)
+    assert len(calls) == 1
@@ -0,0 +1,141 @@
+import math
+import os
+import random
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from app.db import lexical
+from app.db.lexical import LexicalIndex, Segment, term_hashes, tokenize
+
+WORDS = ["alpha", "beta", "gamma", "delta", "epsilon", "zeta", "eta", "theta"]
+
+
+def bm25(corpus, query):
+    """Scores of every chunk of `corpus` ({id: text}) matching `query`, computed directly."""
+    docs = {chunk_id: Counter(tokenize(text)) for chunk_id, text in corpus.items()}
+    avgdl = sum(sum(tf.values()) for tf in docs.values()) / len(docs)
+    scores = {}
+    for term in set(tokenize(query)):
+        df = sum(term in tf for tf in docs.values())
+        idf = math.log1p((len(docs) - df + 0.5) / (df + 0.5))
+        for chunk_id, tf in docs.items():
+            if term in tf:
+                length = sum(tf.values())
+                part = tf[term] * (lexical.K1 + 1) / (tf[term] + lexical.K1 * (1 - lexical.B + lexical.B * length / avgdl))
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * part
+    return scores
+
+
+def assert_matches(index, corpus, query="alpha gamma theta"):
+    expected = bm25(corpus, query)
+    ids, scores = index.search(query, k=len(corpus) + 1)
+    assert len(index) == len(corpus)
+    assert sorted(ids.tolist()) == sorted(expected)
+    assert scores.tolist() == sorted(scores.tolist(), reverse=True)
+    for chunk_id, score in zip(ids.tolist(), scores.tolist()):
+        assert score == pytest.approx(expected[chunk_id], rel=1e-5)
+
+
+def random_texts(rng, count):
+    return [" ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 12))) for _ in range(count)]
+
+
+@pytest.fixture
+def files(tmp_path):
+    def path(name):
+        return str(tmp_path / name)
+
+    def remove(name):
+        os.unlink(path(name))
+
+    return path, remove
+
+
+def test_tokenize():
+    assert tokenize("Hello, World! it's 2024") == ["hello", "world", "it", "s", "2024"]
+    hashes = term_hashes(["alpha", "beta", "alpha"])
+    assert hashes.dtype == np.uint64
+    assert hashes[0] == hashes[2] != hashes[1]
+
+
+def test_search_scores_bm25():
+    corpus = {10: "alpha beta", 11: "gamma gamma delta", 12: "alpha alpha alpha theta", 13: "zeta"}
+    index = LexicalIndex.empty()
+    index.add(list(corpus), list(corpus.values()))
+    assert_matches(index, corpus)
+    assert index.search("alpha", k=1)[0].tolist() == [12]
+    assert len(index.search("unknown", k=3)[0]) == 0
+    assert len(index.search("", k=3)[0]) == 0
+
+
+def test_adds_and_removes_merge_segments(monkeypatch):
+    monkeypatch.setattr(lexical, "MAX_SEGMENTS", 4)
+    rng = random.Random(0)
+    index = LexicalIndex.empty()
+    corpus = {}
+    next_id = 0
+    for _ in range(30):
+        texts = random_texts(rng, rng.randint(1, 5))
+        ids = list(range(next_id, next_id + len(texts)))
+        next_id += len(texts)
+        index.add(ids, texts)
+        corpus.update(zip(ids, texts))
+        removed = rng.sample(sorted(corpus), min(len(corpus) - 1, rng.randint(0, 2)))
+        index.remove(removed)
+        for chunk_id in removed:
+            del corpus[chunk_id]
+        assert len(index.segments) <= lexical.MAX_SEGMENTS
+        assert len(index.deleted) <= lexical.MAX_DELETED_SHARE * (len(corpus) + len(index.deleted))
+        assert_matches(index, corpus)
+    assert index.total_length == sum(len(tokenize(text)) for text in corpus.values())
+
+
+def test_removing_unknown_or_removed_ids_is_a_no_op():
+    index = LexicalIndex.empty()
+    index.add([1, 2, 3, 4], ["alpha", "beta", "gamma", "alpha beta"])
+    index.remove([2])
+    index.remove([2, 99])
+    assert len(index) == 3
+    assert index.deleted.tolist() == [2]
+    assert_matches(index, {1: "alpha", 3: "gamma", 4: "alpha beta"})
+
+
+def test_save_and_load(files):
+    path, remove = files
+    index = LexicalIndex.empty()
+    index.add([0, 1], ["alpha beta", "gamma"])
+    index.save(path, remove)
+    first = LexicalIndex.load(path).segments[0].file_names()
+
+    # The new segment is merged with the saved one, whose files go
+    loaded = LexicalIndex.load(path, mmap=False)
+    loaded.add([2], ["alpha theta theta"])
+    loaded.remove([1])
+    loaded.save(path, remove)
+
+    reloaded = LexicalIndex.load(path)
+    assert_matches(reloaded, {0: "alpha beta", 2: "alpha theta theta"})
+    assert len(reloaded.segments) == 1
+    assert all(os.path.exists(path(name)) for name in reloaded.segments[0].file_names())
+    assert not any(os.path.exists(path(name)) for name in first)
+
+
+def test_load_without_index(files):
+    path, _ = files
+    assert LexicalIndex.load(path) is None
+
+
+def test_load_index_written_before_segments(files):
+    path, _ = files
+    corpus = {5: "alpha gamma", 6: "beta", 7: "theta theta alpha"}
+    index = LexicalIndex.empty()
+    index.add(list(corpus), list(corpus.values()))
+    segment = index.segments[0]
+    Segment("", {name: getattr(segment, name) for name in lexical.ARRAYS}).save(path)
+
+    legacy = LexicalIndex.load(path)
+    assert legacy.segments[0].prefix == ""
+    assert_matches(legacy, corpus)
+    assert np.array_equal(legacy.deleted, np.empty(0, dtype=np.int64))
@@ -0,0 +1,61 @@
+from app.api.v1.quotes import SourceText, fold, quote_span
+
+CHUNKS = [
+    "Revenue grew by twelve percent in the third quarter of the year.",
+    "The quick brown fox jumps over the lazy dog again.",
+]
+
+
+def verify(answer):
+    return SourceText(CHUNKS).verify(answer)
+
+
+def test_quote_span():
+    answer = "It said ***grew by twelve*** and more."
+    start, end = quote_span(answer)
+    assert answer[start:end] == "grew by twelve"
+    assert quote_span("No quote here") is None
+
+
+def test_fold_maps_back_to_original_offsets():
+    folded, folded_starts, original_starts = fold("A  “Quoted”\n\tWord")
+    assert folded == 'a "quoted" word'
+    assert folded_starts == [0, 2, 11]
+    assert original_starts == [0, 3, 13]
+
+
+def test_exact_quote():
+    answer, match = verify("Growth: ***Revenue grew by twelve percent***.")
+    assert answer == "Growth: ***Revenue grew by twelve percent***."
+    assert match.distance == 0
+    assert SourceText(CHUNKS).text[match.start:match.end] == "Revenue grew by twelve percent"
+
+
+def test_folded_quote_is_replaced_with_the_passage():
+    answer, match = verify("***the QUICK  brown fox***")
+    assert answer == "***The quick brown fox***"
+    assert match.distance == 0
+
+
+def test_quote_across_chunks():
+    source = SourceText(CHUNKS)
+    answer, match = source.verify("***of the year. The quick***")
+    assert answer == "***of the year. The quick***"
+    assert source.chunk_of(match.start) == (0, 52)
+    assert source.chunk_of(match.end - 1) == (1, 8)
+
+
+def test_near_match_spans_whole_words():
+    answer, match = verify("It ***grew by twelve percent in the third quartr***.")
+    assert answer == "It ***grew by twelve percent in the third quarter***."
+    assert match.distance == 1
+
+    answer, match = verify("The fox ***jumps ovr the lazy dgo***.")
+    assert answer == "The fox ***jumps over the lazy dog***."
+    assert match.distance == 2
+
+
+def test_quote_not_in_source():
+    assert verify("***Profits fell sharply in every region***") == (None, None)
+    assert verify("No quote at all") == (None, None)
+    assert verify("******") == (None, None)
@@ -0,0 +1,174 @@
+import os
+import shutil
+
+import pytest
+
+from app.db.storage import SnapshotGone, SnapshotStore
+
+
+def write(path, data):
+    with open(path, "w") as f:
+        f.write(data)
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+@pytest.fixture
+def store(tmp_path):
+    return SnapshotStore(str(tmp_path), keep=2)
+
+
+def test_transaction_publishes_a_new_version(store):
+    assert store.current_version() is None
+    with store.transaction() as txn:
+        assert txn.parent is None
+        write(txn.replace("a/file.txt"), "one")
+    assert store.current_version() == "000000000001"
+    assert read(store.path("000000000001", "a/file.txt")) == "one"
+
+    with store.transaction() as txn:
+        assert txn.parent == "000000000001"
+        assert txn.exists("a/file.txt")
+        assert read(txn.file("a/file.txt")) == "one"
+    assert store.current_version() == "000000000002"
+
+
+def test_replaced_files_leave_older_snapshots_alone(store):
+    with store.transaction() as txn:
+        write(txn.replace("kept.txt"), "kept")
+        write(txn.replace("changed.txt"), "old")
+        write(txn.replace("removed.txt"), "gone")
+    first = store.current_version()
+
+    with store.transaction() as txn:
+        write(txn.replace("changed.txt"), "new")
+        txn.remove("removed.txt")
+        txn.remove("never-existed.txt")
+    second = store.current_version()
+
+    assert read(store.path(first, "changed.txt")) == "old"
+    assert read(store.path(second, "changed.txt")) == "new"
+    assert os.path.exists(store.path(first, "removed.txt"))
+    assert not os.path.exists(store.path(second, "removed.txt"))
+    # Untouched files are hard links to the same data
+    assert os.path.samefile(store.path(first, "kept.txt"), store.path(second, "kept.txt"))
+
+
+def test_failed_transaction_is_discarded(store):
+    with store.transaction() as txn:
+        write(txn.replace("file.txt"), "committed")
+    with pytest.raises(ValueError):
+        with store.transaction() as txn:
+            write(txn.replace("file.txt"), "discarded")
+            raise ValueError
+    assert store.current_version() == "000000000001"
+    assert store.versions() == ["000000000001"]
+    assert read(store.path("000000000001", "file.txt")) == "committed"
+
+    with store.transaction() as txn:
+        pass
+    assert store.current_version() == "000000000002"
+
+
+def test_old_versions_are_pruned(store):
+    for i in range(4):
+        with store.transaction() as txn:
+            write(txn.replace("file.txt"), str(i))
+    assert store.versions() == ["000000000003", "000000000004"]
+    assert read(store.path(store.current_version(), "file.txt")) == "3"
+
+
+def test_writes_only_link_the_units_they_change(store):
+    with store.transaction() as txn:
+        write(txn.replace("files.json"), "{}")
+        write(txn.replace("lexical/a/terms.npy"), "a")
+        write(txn.replace("lexical/b/terms.npy"), "b")
+        write(txn.replace("shards/a.faiss"), "a")
+    first = store.current_version()
+
+    with store.transaction() as txn:
+        write(txn.replace("lexical/b/docs.npy"), "b2")
+    second = store.current_version()
+
+    written = os.path.join(store.snapshots_dir, second)
+    assert sorted(os.listdir(written)) == ["MANIFEST", "lexical"]
+    assert os.listdir(os.path.join(written, "lexical")) == ["b"]
+    assert store.path(second, "lexical/a/terms.npy") == store.path(first, "lexical/a/terms.npy")
+    assert read(store.path(second, "lexical/b/terms.npy")) == "b"
+    assert read(store.path(second, "lexical/b/docs.npy")) == "b2"
+    assert not os.path.exists(store.path(first, "lexical/b/docs.npy"))
+
+
+def test_units_emptied_by_a_write_are_dropped(store):
+    with store.transaction() as txn:
+        write(txn.replace("lexical/a/terms.npy"), "a")
+    with store.transaction() as txn:
+        txn.remove("lexical/a/terms.npy")
+        assert not txn.exists("lexical/a/terms.npy")
+    assert "lexical/a" not in store.manifest(store.current_version())
+    assert not os.path.exists(store.path(store.current_version(), "lexical/a/terms.npy"))
+
+
+def test_units_still_in_use_outlive_their_snapshot(store):
+    with store.transaction() as txn:
+        write(txn.replace("shards/a.faiss"), "a")
+        write(txn.replace("files.json"), "1")
+    first = store.current_version()
+    for i in range(2, 5):
+        with store.transaction() as txn:
+            write(txn.replace("files.json"), str(i))
+
+    # Only the first snapshot's shard is left in its directory
+    assert store.versions() == [first, "000000000003", "000000000004"]
+    assert sorted(os.listdir(os.path.join(store.snapshots_dir, first))) == ["RETIRED", "shards"]
+    assert read(store.path(store.current_version(), "shards/a.faiss")) == "a"
+
+    with store.transaction() as txn:
+        write(txn.replace("shards/a.faiss"), "a2")
+    for i in range(2):
+        with store.transaction() as txn:
+            write(txn.replace("files.json"), str(i))
+    assert first not in store.versions()
+    assert read(store.path(store.current_version(), "shards/a.faiss")) == "a2"
+
+
+def test_snapshots_written_before_manifests(store):
+    legacy = os.path.join(store.snapshots_dir, "000000000001")
+    os.makedirs(os.path.join(legacy, "lexical", "a"))
+    write(os.path.join(legacy, "files.json"), "old")
+    write(os.path.join(legacy, "lexical", "a", "terms.npy"), "a")
+    with open(os.path.join(store.root, "CURRENT"), "w") as f:
+        f.write("000000000001")
+    shutil.rmtree(os.path.join(store.root, "leases"))
+
+    store = SnapshotStore(store.root, keep=2)
+    assert read(store.view("000000000001").path("lexical/a/terms.npy")) == "a"
+    with store.transaction() as txn:
+        assert read(txn.file("files.json")) == "old"
+        write(txn.replace("files.json"), "new")
+    second = store.current_version()
+    assert read(store.path(second, "files.json")) == "new"
+    assert store.path(second, "lexical/a/terms.npy") == os.path.join(legacy, "lexical/a/terms.npy")
+
+
+def test_held_snapshots_are_not_pruned(store):
+    with store.transaction() as txn:
+        write(txn.replace("shards/a.faiss"), "a")
+    held = store.view(store.current_version())
+    for i in range(4):
+        with store.transaction() as txn:
+            write(txn.replace("shards/a.faiss"), str(i))
+
+    assert held.version in store.versions()
+    assert read(held.path("shards/a.faiss")) == "a"
+    assert store.view(held.version).path("shards/a.faiss") == held.path("shards/a.faiss")
+
+    held.close()
+    with store.transaction() as txn:
+        write(txn.replace("files.json"), "{}")
+    assert held.version not in store.versions()
+    with pytest.raises(SnapshotGone):
+        store.view(held.version)
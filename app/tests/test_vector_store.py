@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from app.db.chunk_store import ChunkStore
+from app.db.storage import SnapshotStore
+from app.db.vector_store import VectorStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return SnapshotStore(str(tmp_path), keep=2)
+
+
+def load_vectors(store):
+    version = store.current_version()
+    return VectorStore.load(lambda name: store.path(version, name))
+
+
+def test_vector_store(store):
+    rng = np.random.default_rng(0)
+    data = rng.random((5, 4), dtype=np.float32)
+    vectors = VectorStore.empty(4)
+    vectors.append(data[:3])
+    with store.transaction() as txn:
+        vectors.save(txn)
+
+    vectors = load_vectors(store)
+    vectors.append(data[3:])
+    # Pending rows are readable before they are saved
+    assert np.array_equal(vectors.get([4, 0, 3]), data[[4, 0, 3]])
+    with store.transaction() as txn:
+        vectors.save(txn)
+
+    loaded = load_vectors(store)
+    assert len(loaded) == 5
+    assert np.array_equal(loaded.get(range(5)), data)
+
+
+def test_vector_store_rerank():
+    data = np.array([[0, 0], [1, 0], [5, 5], [2, 0]], dtype=np.float32)
+    vectors = VectorStore.empty(2)
+    vectors.append(data)
+    queries = np.array([[1.9, 0], [5, 5]], dtype=np.float32)
+    candidates = np.array([[0, 1, 3, -1], [-1, -1, -1, -1]])
+    distances, ids = vectors.rerank(queries, candidates, k=2)
+    assert ids.tolist() == [[3, 1], [-1, -1]]
+    assert distances[0] == pytest.approx([0.01, 0.81])
+    assert np.isinf(distances[1]).all()
+
+
+def test_snapshot_without_vectors(store):
+    with store.transaction() as txn:
+        ChunkStore.empty().save(txn)
+    assert load_vectors(store) is None